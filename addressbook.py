@@ -21,9 +21,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sqlite3
-import phonenumbers
 import os
 import glob
+import threading
 import imessage_sync_config
 
 sys_ab_base_dir = '~/Library/Application Support/AddressBook'
@@ -44,12 +44,18 @@ class AddressBook:
             config.get('address_book', 'source_dir', fallback=sys_ab_source_dir)
         self._ab_db_file = \
             config.get('address_book', 'db_file', fallback=sys_ab_db_file)
-        self._lu = self.make_lookup_table()
+        # Built on first lookup, so that runs with nothing to upload never
+        # read the address book. Sync jobs running in parallel share one
+        # AddressBook, so the table is built under a lock.
+        self._lu = None
+        self._lu_lock = threading.Lock()
 
     def me(self):
         return self._me
 
     def read_address_db(self, filename = None):
+        # Loading the phone number metadata is slow, so only do so here
+        import phonenumbers
         if(not filename):
             filename = self._ab_base_dir + '/' + self._ab_db_file
         ab = dict()
@@ -131,11 +137,18 @@ class AddressBook:
                         lu[ea]['name'] = name
         return lu
 
+    def lookup_table(self):
+        if(self._lu is None):
+            with self._lu_lock:
+                if(self._lu is None):
+                    self._lu = self.make_lookup_table()
+        return self._lu
+
     def lookup_email(self, handle):
         c = handle['contact']
-        email = self._lu.get(c, dict()).get('email') or c+'@unknown.email.local'
+        email = self.lookup_table().get(c, dict()).get('email') or c+'@unknown.email.local'
         return [self.lookup_name(handle), email]
 
     def lookup_name(self, handle):
         c = handle['contact']
-        return self._lu.get(c, dict()).get('name') or c
+        return self.lookup_table().get(c, dict()).get('name') or c
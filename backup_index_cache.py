@@ -0,0 +1,130 @@
+# backup_index_cache.py - Persistent cache of iPhone backup path indexes
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import sqlite3
+import threading
+
+default_index_db = '~/.imessage_sync_index.db'
+
+class BackupIndexCache:
+    """SQLite side file holding the relative path to fileID index of each
+    iPhone backup that has been opened. Backups do not change once written,
+    so an index is reused for as long as the path, size and modification
+    time of its manifest are unchanged. The variant names what the index
+    covers, such as the domains and paths indexed, so that finders
+    indexing different parts of the same backup do not share an index."""
+
+    def __init__(self, filename = None, config = None, rebuild = False):
+        if(not filename):
+            filename = config.get('cache', 'index_db', fallback=default_index_db) \
+                if config else default_index_db
+        self._filename = os.path.expanduser(filename)
+        self._rebuild = rebuild
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._filename, check_same_thread=False)
+        self._db.execute('PRAGMA mmap_size = 268435456')
+        columns = [ c[1] for c in self._db.execute('PRAGMA table_info(manifest)') ]
+        if(columns and 'variant' not in columns):
+            # Cache written before indexes had variants, start again
+            self._db.execute('DROP TABLE manifest')
+            self._db.execute('DROP TABLE IF EXISTS backup_path')
+        self._db.execute('CREATE TABLE IF NOT EXISTS manifest ('
+            'id INTEGER PRIMARY KEY, path TEXT, variant TEXT, size INTEGER, '
+            'mtime_ns INTEGER, created REAL, UNIQUE (path, variant))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS backup_path ('
+            'manifest_id INTEGER, relative_path TEXT, file_id TEXT, '
+            'PRIMARY KEY (manifest_id, relative_path)) WITHOUT ROWID')
+        self._db.commit()
+
+    def manifest_key(self, manifest):
+        manifest = os.path.abspath(os.path.expanduser(manifest))
+        st = os.stat(manifest)
+        return manifest, st.st_size, st.st_mtime_ns
+
+    def load(self, manifest, variant = ''):
+        """Return the cached index of the variant for the manifest, or None
+        if there is no entry or the manifest has changed since it was
+        cached"""
+        if(self._rebuild):
+            return None
+        path, size, mtime_ns = self.manifest_key(manifest)
+        with self._lock:
+            row = self._db.execute('SELECT id FROM manifest WHERE path=? AND variant=? '
+                'AND size=? AND mtime_ns=?', (path, variant, size, mtime_ns)).fetchone()
+            if(row is None):
+                return None
+            return dict(self._db.execute('SELECT relative_path, file_id '
+                'FROM backup_path WHERE manifest_id=?', (row[0],)))
+
+    def store(self, manifest, index, variant = ''):
+        path, size, mtime_ns = self.manifest_key(manifest)
+        with self._lock:
+            self._delete(path, variant)
+            cursor = self._db.execute('INSERT INTO manifest (path, variant, size, '
+                'mtime_ns, created) VALUES (?,?,?,?,?)',
+                (path, variant, size, mtime_ns, time.time()))
+            manifest_id = cursor.lastrowid
+            self._db.executemany('INSERT OR REPLACE INTO backup_path VALUES (?,?,?)',
+                ((manifest_id, fn, fileID) for fn, fileID in index.items()))
+            self._db.commit()
+
+    def _delete(self, path, variant = None):
+        if(variant is None):
+            rows = self._db.execute('SELECT id FROM manifest WHERE path=?',
+                (path,)).fetchall()
+        else:
+            rows = self._db.execute('SELECT id FROM manifest WHERE path=? AND variant=?',
+                (path, variant)).fetchall()
+        for row in rows:
+            self._db.execute('DELETE FROM backup_path WHERE manifest_id=?', row)
+            self._db.execute('DELETE FROM manifest WHERE id=?', row)
+
+    def invalidate(self, manifest = None):
+        """Remove the cached index for one manifest, or for all of them"""
+        with self._lock:
+            if(manifest is None):
+                self._db.execute('DELETE FROM backup_path')
+                self._db.execute('DELETE FROM manifest')
+            else:
+                self._delete(os.path.abspath(os.path.expanduser(manifest)))
+            self._db.commit()
+
+    def prune(self):
+        """Remove the indexes of manifests that no longer exist or have
+        changed, returning the number removed"""
+        with self._lock:
+            stale = set()
+            for path, size, mtime_ns in self._db.execute(
+                    'SELECT DISTINCT path, size, mtime_ns FROM manifest').fetchall():
+                try:
+                    st = os.stat(path)
+                    if(st.st_size == size and st.st_mtime_ns == mtime_ns):
+                        continue
+                except OSError:
+                    pass
+                stale.add(path)
+            for path in stale:
+                self._delete(path)
+            self._db.commit()
+        if(stale):
+            self._db.execute('VACUUM')
+        return len(stale)
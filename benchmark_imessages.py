@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+# benchmark_imessages.py - Benchmarks for imessage_sync on generated fixtures
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import gc
+import hashlib
+import os
+import random
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import imessage_db_reader
+import imessage_to_mime
+import addressbook
+import file_finder
+import guid_set
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+chat_db_schema = '''
+CREATE TABLE handle (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT,
+    country TEXT, service TEXT, uncanonicalized_id TEXT);
+CREATE TABLE chat (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT,
+    chat_identifier TEXT, service_name TEXT, room_name TEXT, group_id TEXT,
+    last_addressed_handle TEXT);
+CREATE TABLE chat_handle_join (chat_id INTEGER, handle_id INTEGER);
+CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT,
+    text TEXT, handle_id INTEGER, subject TEXT, type INTEGER, service TEXT,
+    account TEXT, account_guid TEXT, date INTEGER, date_read INTEGER,
+    date_delivered INTEGER, is_delivered INTEGER, is_finished INTEGER,
+    is_from_me INTEGER, is_read INTEGER, is_sent INTEGER,
+    is_audio_message INTEGER, other_handle INTEGER);
+CREATE TABLE chat_message_join (chat_id INTEGER, message_id INTEGER);
+CREATE TABLE attachment (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, guid TEXT,
+    created_date INTEGER, start_date INTEGER, filename TEXT, mime_type TEXT,
+    transfer_name TEXT, total_bytes INTEGER);
+CREATE TABLE message_attachment_join (message_id INTEGER,
+    attachment_id INTEGER);
+'''
+
+def make_guid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128))).upper()
+
+def make_chat_db(path, nmessage = 10000, nchat = 50, nhandle = 80,
+        attachment_fraction = 0.05, seed = 1):
+    """Write a synthetic chat.db with the tables and columns read by
+    IMessageDBReader. Dates are in the nanosecond format of recent
+    versions of Messages."""
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.executescript(chat_db_schema)
+    handles = []
+    for ih in range(nhandle):
+        contact = '+1555%07d'%ih if ih%4 else 'person%d@example.com'%ih
+        handles.append((ih+1, contact, 'us', 'iMessage' if ih%3 else 'SMS', contact))
+    db.executemany('INSERT INTO handle VALUES (?,?,?,?,?)', handles)
+    chats = []
+    chat_handles = []
+    for ic in range(nchat):
+        members = rng.sample(range(1, nhandle+1), 1 if ic%5 else 3)
+        chats.append((ic+1, 'iMessage;-;chat%d'%ic, 'chat%d'%ic, 'iMessage',
+            'chat%d'%ic if len(members)>1 else None, make_guid(rng), 'me@example.com'))
+        for ih in members:
+            chat_handles.append((ic+1, ih))
+    db.executemany('INSERT INTO chat VALUES (?,?,?,?,?,?,?)', chats)
+    db.executemany('INSERT INTO chat_handle_join VALUES (?,?)', chat_handles)
+    messages = []
+    chat_messages = []
+    attachments = []
+    message_attachments = []
+    date = 500000000 * 1000000000
+    for im in range(nmessage):
+        date += rng.randint(1, 3600) * 1000000000
+        ic = rng.randint(1, nchat)
+        from_me = rng.random() < 0.4
+        handle = 0 if from_me else rng.choice(
+            [h for c,h in chat_handles if c == ic])
+        messages.append((im+1, make_guid(rng),
+            'Message %d with some text to make it realistic'%im, handle, None,
+            0, 'iMessage', 'e:me@example.com', make_guid(rng), date,
+            date + 60000000000, date + 1000000000, 1, 1, int(from_me), 1, 1, 0, 0))
+        chat_messages.append((ic, im+1))
+        if(rng.random() < attachment_fraction):
+            ia = len(attachments)+1
+            guid = make_guid(rng)
+            attachments.append((ia, guid, date//1000000000, date//1000000000,
+                '~/Library/Messages/Attachments/%02x/%02d/%s/IMG_%04d.jpeg'%(
+                    ia%256, ia%100, guid, ia),
+                'image/jpeg', 'IMG_%04d.jpeg'%ia, rng.randint(10000, 5000000)))
+            message_attachments.append((im+1, ia))
+    db.executemany('INSERT INTO message VALUES (%s)'%','.join('?'*19), messages)
+    db.executemany('INSERT INTO chat_message_join VALUES (?,?)', chat_messages)
+    db.executemany('INSERT INTO attachment VALUES (?,?,?,?,?,?,?,?)', attachments)
+    db.executemany('INSERT INTO message_attachment_join VALUES (?,?)',
+        message_attachments)
+    db.commit()
+    db.close()
+    return path
+
+def make_chat_db_dir(tmpdir, **kwargs):
+    make_chat_db(os.path.join(tmpdir, imessage_db_reader.chat_db), **kwargs)
+    return tmpdir
+
+def make_backup_paths(npath = 200000, nattachment = 10000, seed = 1):
+    """Return (domain, relativePath) pairs resembling an iPhone backup, with
+    the SMS database and attachments buried among app and media files."""
+    rng = random.Random(seed)
+    paths = [('HomeDomain', 'Library/SMS/sms.db')]
+    for ia in range(nattachment):
+        paths.append(('MediaDomain', 'Library/SMS/Attachments/%02x/%02d/%s/IMG_%04d.jpeg'%(
+            ia%256, ia%100, make_guid(rng), ia)))
+    for ip in range(npath - len(paths)):
+        kind = ip%3
+        if kind == 0:
+            paths.append(('CameraRollDomain', 'Media/DCIM/%03dAPPLE/IMG_%04d.JPG'%(ip//1000, ip%10000)))
+        elif kind == 1:
+            paths.append(('AppDomain-com.example.app%d'%(ip%50),
+                'Library/Caches/%s/data%d.bin'%(make_guid(rng), ip)))
+        else:
+            paths.append(('HomeDomain', 'Library/Preferences/com.example.pref%d.plist'%ip))
+    return paths
+
+def mbdb_string(s):
+    if s is None:
+        return b'\xff\xff'
+    if type(s) is str:
+        s = s.encode('utf-8')
+    return struct.pack('>H', len(s)) + s
+
+def make_mbdb(path, backup_paths, nprops = 1):
+    """Write a synthetic Manifest.mbdb containing the given paths"""
+    with open(path, 'wb') as fp:
+        fp.write(b'mbdb\x05\x00')
+        for domain, filename in backup_paths:
+            record = [ mbdb_string(domain), mbdb_string(filename),
+                mbdb_string(None), mbdb_string(hashlib.sha1(filename.encode()).digest()),
+                mbdb_string(None),
+                file_finder.mbdb_fixed.pack(0x81a4, 0, 0, 501, 501,
+                    1400000000, 1400000000, 1400000000, 12345, 4, nprops) ]
+            for ip in range(nprops):
+                record.append(mbdb_string('com.apple.assetsd.UUID'))
+                record.append(mbdb_string(make_guid(random.Random(ip)).encode()))
+            fp.write(b''.join(record))
+    return path
+
+def make_manifest_db(path, backup_paths):
+    """Write a synthetic Manifest.db containing the given paths"""
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, '
+        'relativePath TEXT, flags INTEGER, file BLOB)')
+    db.execute('CREATE INDEX FilesDomainIdx ON Files(domain)')
+    db.execute('CREATE INDEX FilesRelativePathIdx ON Files(relativePath)')
+    db.executemany('INSERT INTO Files VALUES (?,?,?,1,NULL)',
+        ((hashlib.sha1((d+'-'+f).encode()).hexdigest(), d, f) for d, f in backup_paths))
+    db.commit()
+    db.close()
+    return path
+
+def make_address_book(path, nhandle = 80, seed = 1):
+    """Write a synthetic AddressBook-v22.abcddb with cards for most of the
+    handles made by make_chat_db"""
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.executescript('''
+CREATE TABLE ZABCDRECORD (Z_PK INTEGER PRIMARY KEY, ZFIRSTNAME TEXT,
+    ZMIDDLENAME TEXT, ZLASTNAME TEXT, ZNICKNAME TEXT, ZORGANIZATION TEXT);
+CREATE TABLE ZABCDPHONENUMBER (ZOWNER INTEGER, ZORDERINGINDEX INTEGER,
+    ZFULLNUMBER TEXT);
+CREATE TABLE ZABCDEMAILADDRESS (ZOWNER INTEGER, ZORDERINGINDEX INTEGER,
+    ZADDRESS TEXT);
+''')
+    for ih in range(nhandle):
+        if(ih%5 == 4):
+            continue
+        db.execute('INSERT INTO ZABCDRECORD VALUES (?,?,?,?,?,?)', (ih+1,
+            'First%d'%ih, None, 'Last%d'%rng.randint(0, 1000), None, None))
+        if(ih%4):
+            db.execute('INSERT INTO ZABCDPHONENUMBER VALUES (?,0,?)',
+                (ih+1, '(555) %03d-%04d'%(ih//10000, ih%10000)))
+        db.execute('INSERT INTO ZABCDEMAILADDRESS VALUES (?,0,?)',
+            (ih+1, 'person%d@example.com'%ih))
+    db.commit()
+    db.close()
+    return path
+
+def make_attachment_files(base_path, attachment_size = 20000, seed = 1):
+    """Write a file of attachment_size random bytes for each attachment in
+    the chat.db under base_path, where RelocatedDBFilenameFinder finds it"""
+    rng = random.Random(seed)
+    db = sqlite3.connect(os.path.join(base_path, imessage_db_reader.chat_db))
+    for filename, in db.execute('SELECT filename FROM attachment'):
+        fn = os.path.join(base_path, filename[len('~/Library/Messages/'):])
+        os.makedirs(os.path.dirname(fn), exist_ok = True)
+        with open(fn, 'wb') as fp:
+            fp.write(rng.getrandbits(8*attachment_size).to_bytes(attachment_size, 'little'))
+    db.close()
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+def traced_size(fn):
+    """Run fn and return its result and the memory still held afterwards."""
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    result = fn()
+    gc.collect()
+    end, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, end - start, peak - start
+
+def timed(fn, repeat = 3):
+    best = None
+    result = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return result, best
+
+def mb(nbytes):
+    return '%.1f MB'%(nbytes/1048576.0)
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def records_as_dicts(messages):
+    """Convert messages to the nested dictionaries used before the compact
+    record classes were introduced, sharing handles and chats as before."""
+    converted = dict()
+    def conv(r):
+        if id(r) not in converted:
+            converted[id(r)] = dict(r.items())
+        return converted[id(r)]
+    all_dicts = dict()
+    for im, m in messages.items():
+        d = dict(m.items())
+        d['handle'] = m['handle'] and conv(m['handle'])
+        d['other_handle'] = m['other_handle'] and conv(m['other_handle'])
+        if(m['chat']):
+            d['chat'] = conv(m['chat'])
+            d['chat']['handles'] = [conv(h) for h in m['chat']['handles']]
+        d['attachments'] = [conv(a) for a in m['attachments']]
+        all_dicts[im] = d
+    return all_dicts
+
+def bench_message_memory(nmessage = 100000):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        make_chat_db_dir(tmpdir, nmessage = nmessage)
+        reader = imessage_db_reader.IMessageDBReader(tmpdir)
+        messages, t = timed(reader.get_messages, repeat = 1)
+        del messages
+        dicts, dict_size, _ = traced_size(
+            lambda: records_as_dicts(reader.get_messages()))
+        del dicts
+        messages, record_size, _ = traced_size(reader.get_messages)
+        print('Messages: %d, read in %.2f s'%(len(messages), t))
+        print('  dict representation   : %s (%d bytes/message)'%(
+            mb(dict_size), dict_size//len(messages)))
+        print('  record representation : %s (%d bytes/message)'%(
+            mb(record_size), record_size//len(messages)))
+
+def legacy_process_mbdb_file(filename):
+    """Manifest.mbdb parser as it was before MBDBEntry, for comparison"""
+    getint = file_finder.getint
+    getstring = file_finder.getstring
+    getbytes = file_finder.getbytes
+    mbdb = {}
+    data = open(filename,'br').read()
+    offset = 6
+    while offset < len(data):
+        fileinfo = {}
+        fileinfo['start_offset'] = offset
+        fileinfo['domain'], offset = getstring(data, offset)
+        fileinfo['filename'], offset = getstring(data, offset)
+        fileinfo['linktarget'], offset = getbytes(data, offset)
+        fileinfo['datahash'], offset = getbytes(data, offset)
+        fileinfo['unknown1'], offset = getbytes(data, offset)
+        for name, size in zip(file_finder.mbdb_fixed_names,
+                (2, 4, 4, 4, 4, 4, 4, 4, 8, 1, 1)):
+            fileinfo[name], offset = getint(data, offset, size)
+        fileinfo['properties'] = {}
+        for ii in range(fileinfo['numprops']):
+            propname, offset = getstring(data, offset)
+            propval, offset = getbytes(data, offset)
+            fileinfo['properties'][propname] = propval
+        mbdb[fileinfo['start_offset']] = fileinfo
+        fullpath = fileinfo['domain'] + '-' + fileinfo['filename']
+        fileinfo['fileID'] = hashlib.sha1(fullpath.encode()).hexdigest()
+    return mbdb
+
+def bench_mbdb_parse(npath = 200000):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = make_mbdb(os.path.join(tmpdir, 'Manifest.mbdb'), make_backup_paths(npath))
+        finder = file_finder.OldIPhoneBackupFilenameFinder.__new__(
+            file_finder.OldIPhoneBackupFilenameFinder)
+        legacy, t_legacy = timed(lambda: legacy_process_mbdb_file(fn))
+        del legacy
+        mbdb, t_new = timed(lambda: finder.process_mbdb_file(fn))
+        _, size_legacy, _ = traced_size(lambda: legacy_process_mbdb_file(fn))
+        _, size_new, _ = traced_size(lambda: finder.process_mbdb_file(fn))
+        sample = next(iter(mbdb.values()))
+        assert sample['fileID'] == legacy_process_mbdb_file(fn)[sample.start_offset]['fileID']
+        print('Manifest.mbdb entries: %d (%s)'%(len(mbdb), mb(os.path.getsize(fn))))
+        print('  legacy parser : %.3f s, %s'%(t_legacy, mb(size_legacy)))
+        print('  mmap parser   : %.3f s, %s'%(t_new, mb(size_new)))
+
+def legacy_filename(ff, backup_path, f):
+    """Attachment path resolution as it was before the flat suffix index,
+    with ff mapping path length to a dictionary of paths of that length"""
+    len_f = len(f)
+    index = 0 if f[0] == '/' else -1
+    while(True):
+        iff = ff.get(len_f - index - 1)
+        if(iff):
+            fsub = f[(index+1):]
+            for ifn in iff:
+                if(fsub == ifn):
+                    return os.path.expanduser(backup_path + '/' + iff[ifn])
+        index = f.find('/', index+1)
+        if(index < 0):
+            return None
+
+def bench_backup_filename(npath = 200000, nlookup = 2000):
+    backup_paths = make_backup_paths(npath)
+    finder = file_finder.OldIPhoneBackupFilenameFinder.__new__(
+        file_finder.OldIPhoneBackupFilenameFinder)
+    file_finder.BaseIPhoneBackupFilenameFinder.__init__(finder, '/backup')
+    finder._ff = dict()
+    legacy_ff = dict()
+    for domain, fn in backup_paths:
+        fileID = hashlib.sha1((domain+'-'+fn).encode()).hexdigest()
+        finder._ff[fn] = fileID
+        legacy_ff.setdefault(len(fn), dict())[fn] = fileID
+    rng = random.Random(2)
+    lookups = [ '/var/mobile/' + fn for domain, fn in rng.sample(backup_paths,
+        min(nlookup, len(backup_paths))) ]
+    lookups += [ '~/Library/SMS/Attachments/00/00/missing/IMG.jpeg' ] * (nlookup//10)
+    legacy, t_legacy = timed(lambda: [legacy_filename(legacy_ff, '/backup', f) for f in lookups], 1)
+    new, t_new = timed(lambda: [finder.filename(f) for f in lookups])
+    assert legacy == new
+    print('Manifest entries: %d, lookups: %d'%(len(backup_paths), len(lookups)))
+    print('  length-bucketed scan : %.1f us/lookup'%(t_legacy/len(lookups)*1e6))
+    print('  suffix index         : %.1f us/lookup'%(t_new/len(lookups)*1e6))
+
+def bench_guid_set(nguid = 1000000, nlookup = 100000):
+    rng = random.Random(3)
+    guids = [ make_guid(rng) for i in range(nguid) ]
+    guids += [ guids[i] + '-FRAGMENT-1' for i in range(nguid//1000) ]
+    present = rng.sample(guids, min(nlookup//2, len(guids)))
+    absent = [ make_guid(rng) for i in range(nlookup//2) ]
+    # Copy each GUID as the server query would create a new string for it
+    gs, size_set, _ = traced_size(lambda: set((s+' ')[:-1] for s in guids))
+    def make_compact():
+        compact = guid_set.GUIDSet((s+' ')[:-1] for s in guids)
+        len(compact) # merge pending GUIDs into the sorted buffer
+        return compact
+    compact, size_compact, peak_compact = traced_size(make_compact)
+    _, t_set = timed(lambda: [g in gs for g in present+absent])
+    found, t_compact = timed(lambda: [g in compact for g in present+absent])
+    assert found == [True]*len(present) + [False]*len(absent)
+    print('GUIDs: %d, lookups: %d'%(len(guids), len(present+absent)))
+    print('  set of str : %s, %.2f us/lookup'%(mb(size_set), t_set/nlookup*1e6))
+    print('  GUIDSet    : %s (peak %s), %.2f us/lookup'%(mb(size_compact),
+        mb(peak_compact), t_compact/nlookup*1e6))
+
+# Modules that should only be imported by the code paths that use them
+deferred_imports = ('phonenumbers', 'email.mime', 'imaplib', 'mailbox',
+    'concurrent.futures')
+startup_budget_ms = 75
+
+def import_time(module):
+    """Cumulative import time of the module in a fresh interpreter, in
+    microseconds, and the names of all modules it imported"""
+    out = subprocess.run([ sys.executable, '-X', 'importtime', '-c',
+        'import ' + module ], stderr=subprocess.PIPE, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stderr.decode()
+    times = dict()
+    for line in out.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, name = line[12:].split('|')
+            if cumulative_us.strip().isdigit():
+                times[name.strip()] = int(cumulative_us)
+    return times[module], set(times)
+
+def bench_startup(nrun = 5):
+    runs = [ import_time('imessage_sync') for i in range(nrun) ]
+    t = min(us for us, modules in runs)
+    modules = runs[0][1]
+    print('import imessage_sync: %.1f ms (budget %d ms)'%(t/1000, startup_budget_ms))
+    loaded = sorted(m for m in modules
+        if any(m == d or m.startswith(d + '.') for d in deferred_imports))
+    assert not loaded, 'imported at startup: ' + ', '.join(loaded)
+    assert t/1000 <= startup_budget_ms, 'startup over budget'
+
+# ---------------------------------------------------------------------------
+# Microbenchmarks of the per-message hot paths
+# ---------------------------------------------------------------------------
+
+def measure(fn, items, ops_per_item = 1, min_time = 0.2, nsample = 100):
+    """Call fn on each of the items, repeating until min_time has passed,
+    and return the best rate in operations per second together with the
+    peak memory allocated and the memory still held, including the result,
+    per operation in bytes, traced over calls on a sample of the items"""
+    best = None
+    elapsed = 0
+    while(best is None or elapsed < min_time):
+        t0 = time.perf_counter()
+        for item in items:
+            fn(item)
+        dt = time.perf_counter() - t0
+        elapsed += dt
+        best = dt if best is None else min(best, dt)
+    sample = items[0:nsample]
+    peak = 0
+    retained = 0
+    gc.collect()
+    tracemalloc.start()
+    for item in sample:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        result = fn(item)
+        end, top = tracemalloc.get_traced_memory()
+        peak += top - start
+        retained += end - start
+        del result
+    tracemalloc.stop()
+    nop = len(sample)*ops_per_item
+    return dict(ops_per_sec = len(items)*ops_per_item/max(best, 1e-9),
+        peak_bytes = peak//nop, retained_bytes = retained//nop)
+
+def fixed_fields_offset(data, fields_offset):
+    """Offset of the mode, the first of the fixed size fields of an entry"""
+    for i in range(3): # linktarget, datahash, unknown1
+        fields_offset = file_finder.skipstring(data, fields_offset)
+    return fields_offset
+
+def make_micro_fixtures(tmpdir, nmessage = 2000):
+    """Generate a chat.db with attachment files, an address book, and the
+    tables of a large backup, and return what the microbenchmarks use"""
+    import configparser
+    import copy
+    make_chat_db_dir(tmpdir, nmessage = nmessage, attachment_fraction = 0.2)
+    make_attachment_files(tmpdir)
+    make_address_book(os.path.join(tmpdir, addressbook.sys_ab_db_file))
+    config = configparser.ConfigParser()
+    config.read_dict(dict(identity = dict(name = 'Me', address = 'me@example.com')))
+    ab = addressbook.AddressBook(config = config, ab_base_dir = tmpdir)
+    ab.lookup_table()
+    reader = imessage_db_reader.IMessageDBReader(tmpdir)
+    messages = [ m for m in reader.get_messages().values() if imessage_to_mime.is_valid(m) ]
+    attachments = [ a for m in messages for a in m['attachments'] ]
+    with_n = []
+    for im, m in enumerate(messages[0:200]):
+        m = copy.copy(m)
+        m['attachments'] = [ attachments[(im+ia)%len(attachments)] for ia in range(4) ]
+        with_n.append(m)
+    backup_paths = make_backup_paths(100000)
+    finder = file_finder.OldIPhoneBackupFilenameFinder.__new__(
+        file_finder.OldIPhoneBackupFilenameFinder)
+    file_finder.BaseIPhoneBackupFilenameFinder.__init__(finder, '/backup')
+    finder._ff = dict((fn, hashlib.sha1((domain+'-'+fn).encode()).hexdigest())
+        for domain, fn in backup_paths)
+    rng = random.Random(2)
+    lookups = [ '/var/mobile/' + fn for domain, fn in rng.sample(backup_paths, 2000) ]
+    mbdb_fn = make_mbdb(os.path.join(tmpdir, 'Manifest.mbdb'), backup_paths[0:20000])
+    with open(mbdb_fn, 'rb') as fp:
+        mbdb_data = fp.read()
+    mbdb = finder.process_mbdb_file(mbdb_fn)
+    return dict(reader = reader, addressbook = ab, messages = messages,
+        chats = list(dict((id(m['chat']), m['chat']) for m in messages).values()),
+        handles = [ h for m in messages for h in m['chat']['handles'] ],
+        with_0 = [ m for m in messages if not m['attachments'] ],
+        with_1 = [ m for m in messages if len(m['attachments']) == 1 ],
+        with_n = with_n, finder = finder, lookups = lookups,
+        dates = [ d for m in messages for d in (int(m['date'] - 978307200)*1000000000,
+            int(m['date'] - 978307200)) ],
+        mbdb_data = mbdb_data, mbdb_offsets = list(mbdb),
+        mbdb_int_offsets = [ fixed_fields_offset(mbdb_data, e._fields_offset)
+            for e in mbdb.values() ])
+
+def micro_benchmarks(fx):
+    """Dictionary of microbenchmark name to (function, items, operations per
+    item)"""
+    import email.message
+    ab = fx['addressbook']
+    nmessage = len(fx['reader'].get_messages())
+    return dict(
+        make_date = (imessage_db_reader.make_date, fx['dates'], 1),
+        get_messages = (lambda _: fx['reader'].get_messages(), [ None ]*3, nmessage),
+        get_chat_names = (lambda c: imessage_to_mime.get_chat_names(c, ab), fx['chats'], 1),
+        get_chat_id = (lambda c: imessage_to_mime.get_chat_id(c, ab), fx['chats'], 1),
+        set_headers = (lambda m: imessage_to_mime.set_headers(email.message.Message(),
+            m, ab, 1e9), fx['messages'], 1),
+        get_text_msg = (imessage_to_mime.get_text_msg, fx['with_0'], 1),
+        get_email_0 = (lambda m: imessage_to_mime.get_email(m, ab), fx['with_0'], 1),
+        get_email_1 = (lambda m: imessage_to_mime.get_email(m, ab), fx['with_1'], 1),
+        get_email_n = (lambda m: imessage_to_mime.get_email(m, ab), fx['with_n'], 1),
+        lookup_email = (ab.lookup_email, fx['handles'], 1),
+        backup_filename = (fx['finder'].filename, fx['lookups'], 1),
+        mbdb_getstring = (lambda o: file_finder.getstring(fx['mbdb_data'], o),
+            fx['mbdb_offsets'], 1),
+        mbdb_getint = (lambda o: file_finder.getint(fx['mbdb_data'], o, 2),
+            fx['mbdb_int_offsets'], 1),
+        )
+
+def bench_micro(nmessage = 2000, only = None, save = None, baseline = None,
+        tolerance = 0.2):
+    """Run the microbenchmarks, optionally saving the results to a JSON file
+    or comparing them with those saved earlier. Returns the names of those
+    slower than the baseline by more than the tolerance."""
+    import json
+    previous = dict()
+    if(baseline):
+        with open(baseline) as fp:
+            previous = json.load(fp)['results']
+    results = dict()
+    slower = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fx = make_micro_fixtures(tmpdir, nmessage)
+        print('%-16s %14s %12s %12s %9s'%('Benchmark', 'ops/s', 'peak B/op',
+            'held B/op', 'vs base'))
+        for name, (fn, items, ops_per_item) in micro_benchmarks(fx).items():
+            if(only and name not in only):
+                continue
+            r = measure(fn, items, ops_per_item)
+            results[name] = r
+            change = ''
+            if(name in previous):
+                ratio = r['ops_per_sec']/previous[name]['ops_per_sec'] - 1
+                change = '%+8.1f%%'%(ratio*100)
+                if(ratio < -tolerance):
+                    slower.append(name)
+                    change += ' SLOWER'
+            print('%-16s %14.0f %12d %12d %9s'%(name, r['ops_per_sec'],
+                r['peak_bytes'], r['retained_bytes'], change))
+        fx['reader'].close()
+    if(save):
+        with open(save, 'w') as fp:
+            json.dump(dict(python = sys.version.split()[0], created = time.time(),
+                nmessage = nmessage, results = results), fp, indent = 1, sort_keys = True)
+        print('Saved results to', save)
+    return slower
+
+benchmarks = dict(
+    message_memory = bench_message_memory,
+    mbdb_parse = bench_mbdb_parse,
+    backup_filename = bench_backup_filename,
+    guid_set = bench_guid_set,
+    startup = bench_startup,
+    micro = bench_micro,
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run imessage_sync benchmarks on generated fixtures.')
+    parser.add_argument('benchmark', nargs='*',
+                        help='benchmark(s) to run, default is all: ' + ', '.join(sorted(benchmarks)))
+    parser.add_argument('-n', dest='n', type=int, default=None,
+                        help='size of generated fixture')
+    parser.add_argument('--micro', dest='micro', action='append', default=None,
+                        help='run only the given microbenchmark(s) of the micro suite')
+    parser.add_argument('--save', dest='save', default=None,
+                        help='save the micro suite results to the given JSON file')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='compare the micro suite results with those saved in the given JSON file')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='fractional slowdown from the baseline that is reported as a regression')
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error('unknown benchmark: ' + name)
+    slower = []
+    for name in args.benchmark or sorted(benchmarks):
+        print('== %s'%name)
+        kwargs = dict()
+        if name == 'micro':
+            kwargs = dict(only = args.micro, save = args.save,
+                baseline = args.baseline, tolerance = args.tolerance)
+        if args.n:
+            result = benchmarks[name](args.n, **kwargs)
+        else:
+            result = benchmarks[name](**kwargs)
+        if name == 'micro':
+            slower = result
+    if slower:
+        print('Slower than baseline: ' + ', '.join(slower))
+        sys.exit(1)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import argparse
+import time
+import imessage_sync
+import imessage_sync_config
+import outbox
+import uid_index
+
+parser = argparse.ArgumentParser(description='Upload the messages queued in the outbox.')
+parser.add_argument('-v', '--verbose', dest='verbose', action='store_const',
+                    default=False, const=True,
+                    help='print verbose messages')
+parser.add_argument('--outbox', dest='outbox', action='store', default=None,
+                    help='drain the outbox in the given directory')
+parser.add_argument('--max_upload_rate', dest='max_upload_rate', action='store',
+                    type=float, default=None,
+                    help='limit IMAP uploads to the given number of bytes per second')
+parser.add_argument('--wait', dest='wait', action='store', type=float, default=None,
+                    help='keep draining, waiting the given number of seconds between '
+                    'attempts and after errors')
+parser.add_argument('--status', dest='status', action='store_const',
+                    default=False, const=True,
+                    help='print the number of queued messages and exit')
+
+args = parser.parse_args()
+
+config = imessage_sync_config.get_config()
+box = outbox.Outbox(args.outbox, config=config)
+
+def print_status():
+    npending, nbytes, ndelivered = box.status()
+    print('Outbox %s: %d queued (%.1f MB), %d delivered'%(box.path, npending,
+        nbytes/1e6, ndelivered))
+
+if(args.status):
+    print_status()
+    raise SystemExit(0)
+
+uids = uid_index.UIDIndex(config=config)
+while True:
+    if(box.status()[0] or box.pending_seen()):
+        try:
+            backend = imessage_sync.open_imap_backend(config, args.verbose,
+                args.max_upload_rate, uid_index=uids)
+            try:
+                ndelivered, nskipped, nfailed = box.drain(backend, verbose=args.verbose)
+                nseen = box.drain_seen(backend)
+            finally:
+                backend.close()
+            print('Uploaded %d, already on server %d, failed %d, marked read %d'%(
+                ndelivered, nskipped, nfailed, nseen))
+        except Exception as e:
+            if(args.wait is None):
+                raise
+            print('Drain interrupted: %s'%e)
+    print_status()
+    if(args.wait is None):
+        break
+    time.sleep(args.wait)
+box.close()
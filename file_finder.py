@@ -23,9 +23,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import sys
+import mmap
+import struct
 import hashlib
 import sqlite3
+import threading
+import functools
 
 def getint(data, offset, intsize):
     """Retrieve an integer (big-endian) and new offset from the current offset"""
@@ -52,6 +55,69 @@ def getbytes(data, offset):
     value = data[offset:offset+length]
     return value, (offset + length)
 
+mbdb_length = struct.Struct('>H')
+mbdb_fixed = struct.Struct('>HIIIIIIIQBB') # mode ... numprops, see fileinfo()
+mbdb_fixed_names = ('mode', 'unknown2', 'unknown3', 'userid', 'groupid',
+    'mtime', 'atime', 'ctime', 'filelen', 'flag', 'numprops')
+
+def skipstring(data, offset):
+    """Return the offset following the string or bytes at offset"""
+    length, = mbdb_length.unpack_from(data, offset)
+    return offset + 2 if length == 0xFFFF else offset + 2 + length
+
+class MBDBEntry:
+    """Entry from a Manifest.mbdb file. Only the domain, filename and fileID
+    are decoded when the manifest is read, the other fields are decoded from
+    the underlying data when first accessed."""
+    __slots__ = ('start_offset', 'domain', 'filename', 'fileID',
+        '_data', '_fields_offset', '_fileinfo')
+
+    def __init__(self, data, start_offset, domain, filename, fields_offset):
+        self._data          = data
+        self.start_offset   = start_offset
+        self.domain         = domain
+        self.filename       = filename
+        self._fields_offset = fields_offset
+        self._fileinfo      = None
+        fullpath = domain + '-' + filename
+        self.fileID = hashlib.sha1(fullpath.encode()).hexdigest()
+
+    def fileinfo(self):
+        if self._fileinfo is None:
+            data = self._data
+            fileinfo = dict(start_offset = self.start_offset,
+                domain = self.domain, filename = self.filename,
+                fileID = self.fileID)
+            offset = self._fields_offset
+            fileinfo['linktarget'], offset = getbytes(data, offset)
+            fileinfo['datahash'], offset = getbytes(data, offset)
+            fileinfo['unknown1'], offset = getbytes(data, offset)
+            fileinfo.update(zip(mbdb_fixed_names,
+                mbdb_fixed.unpack_from(data, offset)))
+            offset += mbdb_fixed.size
+            fileinfo['properties'] = {}
+            for ii in range(fileinfo['numprops']):
+                propname, offset = getstring(data, offset)
+                propval, offset = getbytes(data, offset)
+                fileinfo['properties'][propname] = propval
+            self._fileinfo = fileinfo
+        return self._fileinfo
+
+    def __getitem__(self, key):
+        if key in MBDBEntry.__slots__ and key[0] != '_':
+            return getattr(self, key)
+        return self.fileinfo()[key]
+
+def path_suffixes(f):
+    """Yield the path f and then each suffix of it that starts after a '/',
+    longest first. A leading '/' is never part of a suffix."""
+    index = 0 if f[0] == '/' else -1
+    while True:
+        yield f[(index+1):]
+        index = f.find('/', index+1)
+        if index < 0:
+            return
+
 class NativeDBFilenameFinder:
     native_db_path = '~/Library/Messages'
     native_chat_db = 'chat.db'
@@ -86,124 +152,165 @@ class BaseIPhoneBackupFilenameFinder:
     native_db_path = 'Library/SMS'
     native_chat_db = 'sms.db'
 
-    def __init__(self, backup_path, db_path = None, chat_db = None):
+    def __init__(self, backup_path, db_path = None, chat_db = None, index_cache = None):
         self._backup_path = backup_path
         self._db_path     = db_path or BaseIPhoneBackupFilenameFinder.native_db_path
         self._chat_db     = chat_db or BaseIPhoneBackupFilenameFinder.native_chat_db
+        self._index_cache = index_cache
         self._ff          = None
 
+    def manifest_path(self):
+        return os.path.expanduser(self._backup_path + '/' + self._manifest)
+
+    def cached_fast_find(self, make_index):
+        """Return the index from the on-disk cache if there is one, otherwise
+        build it with make_index and add it to the cache"""
+        if(self._index_cache is None):
+            return make_index()
+        index = self._index_cache.load(self.manifest_path(), self.index_variant())
+        if(index is None):
+            index = make_index()
+            self._index_cache.store(self.manifest_path(), index, self.index_variant())
+        return index
+
+    def index_variant(self):
+        """Description of what the index covers, besides the manifest"""
+        return ''
+
     def chat_db(self):
         return self.filename(self._db_path + '/' + self._chat_db)
 
     def filename(self, f):
-        len_f = len(f)
-        if(f[0] == '/'):
-            index = 0
-        else:
-            index = -1
-        while(True):
-            iff = self._ff.get(len_f - index - 1)
-            if(iff):
-                fsub = f[(index+1):]
-                for ifn in iff:
-                    if(fsub == ifn):
-                        return os.path.expanduser(self._backup_path + '/' + iff[ifn])
-            index = f.find('/', index+1)
-            if(index < 0):
-                return None
+        # The index maps each relative path in the backup to its fileID, so
+        # resolving a path is one dictionary lookup per candidate suffix
+        for fsub in path_suffixes(f):
+            fileID = self._ff.get(fsub)
+            if(fileID):
+                return os.path.expanduser(self._backup_path + '/' + fileID)
+        return self.lookup_unindexed(f)
+
+    def lookup_unindexed(self, f):
+        return None
 
 class OldIPhoneBackupFilenameFinder(BaseIPhoneBackupFilenameFinder):
     native_manifest = 'Manifest.mbdb'
 
-    def __init__(self, backup_path, manifest = None, db_path = None, chat_db = None):
-        BaseIPhoneBackupFilenameFinder.__init__(self, backup_path, db_path, chat_db)
+    def __init__(self, backup_path, manifest = None, db_path = None, chat_db = None,
+            index_cache = None):
+        BaseIPhoneBackupFilenameFinder.__init__(self, backup_path, db_path, chat_db,
+            index_cache)
         self._manifest    = manifest or OldIPhoneBackupFilenameFinder.native_manifest
-        self._mbdx        = {}
-        self._mbdb        = self.load_manifest()
-        self._ff          = self.make_fast_find(self._mbdb)
+        self._mbdb        = None
+        self._ff          = self.cached_fast_find(self.build_fast_find)
+
+    def build_fast_find(self):
+        self._mbdb = self.load_manifest()
+        return self.make_fast_find(self._mbdb)
 
     def make_fast_find(self, mdbd):
         index = dict()
         for imdbd in mdbd:
-            fn = mdbd[imdbd]['filename']
-            len_fn = len(fn)
-            if(len_fn not in index):
-                index[len_fn] = dict()
-            index[len_fn][fn] = mdbd[imdbd]['fileID']
+            index[mdbd[imdbd]['filename']] = mdbd[imdbd]['fileID']
         return index
 
     def load_manifest(self):
-        mbdb = self.process_mbdb_file(os.path.expanduser( \
-            self._backup_path + '/' + self._manifest))
-        for offset, fileinfo in mbdb.items():
-            if offset in self._mbdx:
-                fileinfo['fileID'] = self._mbdx[offset]
-            else:
-                fileinfo['fileID'] = "<nofileID>"
-                print("No fileID found for %s" % fileinfo['filename'], file=sys.stderr)
-        return mbdb
+        return self.process_mbdb_file(self.manifest_path())
 
     def process_mbdb_file(self, filename):
         mbdb = {} # Map offset of info in this file => file info
-        data = open(filename,'br').read()
+        with open(filename,'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                raise Exception("This does not look like an MBDB file")
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
         if data[0:4] != b'mbdb': raise Exception("This does not look like an MBDB file")
+        unpack_length = mbdb_length.unpack_from
         offset = 4
         offset = offset + 2 # value x05 x00, not sure what this is
-        while offset < len(data):
-            fileinfo = {}
-            fileinfo['start_offset'] = offset
-            fileinfo['domain'], offset = getstring(data, offset)
-            fileinfo['filename'], offset = getstring(data, offset)
-            fileinfo['linktarget'], offset = getbytes(data, offset)
-            fileinfo['datahash'], offset = getbytes(data, offset)
-            fileinfo['unknown1'], offset = getbytes(data, offset)
-            fileinfo['mode'], offset = getint(data, offset, 2)
-            fileinfo['unknown2'], offset = getint(data, offset, 4)
-            fileinfo['unknown3'], offset = getint(data, offset, 4)
-            fileinfo['userid'], offset = getint(data, offset, 4)
-            fileinfo['groupid'], offset = getint(data, offset, 4)
-            fileinfo['mtime'], offset = getint(data, offset, 4)
-            fileinfo['atime'], offset = getint(data, offset, 4)
-            fileinfo['ctime'], offset = getint(data, offset, 4)
-            fileinfo['filelen'], offset = getint(data, offset, 8)
-            fileinfo['flag'], offset = getint(data, offset, 1)
-            fileinfo['numprops'], offset = getint(data, offset, 1)
-            fileinfo['properties'] = {}
-            for ii in range(fileinfo['numprops']):
-                propname, offset = getstring(data, offset)
-                propval, offset = getbytes(data, offset)
-                fileinfo['properties'][propname] = propval
-            mbdb[fileinfo['start_offset']] = fileinfo
-            fullpath = fileinfo['domain'] + '-' + fileinfo['filename']
-            id = hashlib.sha1(fullpath.encode())
-            self._mbdx[fileinfo['start_offset']] = id.hexdigest()
+        data_len = len(data)
+        while offset < data_len:
+            start_offset = offset
+            strings = []
+            for ii in range(2): # domain and filename
+                length, = unpack_length(data, offset)
+                if length == 0xFFFF:
+                    strings.append('')
+                    offset += 2
+                else:
+                    strings.append(data[offset+2:offset+2+length].decode('utf-8'))
+                    offset += 2 + length
+            fields_offset = offset
+            offset = skipstring(data, offset) # linktarget
+            offset = skipstring(data, offset) # datahash
+            offset = skipstring(data, offset) # unknown1
+            offset += mbdb_fixed.size
+            numprops = data[offset-1]
+            for ii in range(numprops):
+                offset = skipstring(data, offset) # property name
+                offset = skipstring(data, offset) # property value
+            mbdb[start_offset] = MBDBEntry(data, start_offset,
+                strings[0], strings[1], fields_offset)
         return mbdb
 
 class NewIPhoneBackupFilenameFinder(BaseIPhoneBackupFilenameFinder):
     native_manifest = 'Manifest.db'
+    # Domains holding the message database and its attachments. Only paths
+    # in these domains under the message database directory are indexed when
+    # the manifest is opened, anything else is looked up on demand.
+    index_domains = ('HomeDomain', 'MediaDomain')
+    lookup_cache_size = 4096
 
-    def __init__(self, backup_path, manifest = None, db_path = None, chat_db = None):
-        BaseIPhoneBackupFilenameFinder.__init__(self, backup_path, db_path, chat_db)
+    def __init__(self, backup_path, manifest = None, db_path = None, chat_db = None,
+            index_cache = None):
+        BaseIPhoneBackupFilenameFinder.__init__(self, backup_path, db_path, chat_db,
+            index_cache)
         self._manifest    = manifest or NewIPhoneBackupFilenameFinder.native_manifest
-        self._ff          = self.make_fast_find()
+        self._db          = sqlite3.connect('file:' + self.manifest_path() + '?mode=ro',
+            uri=True, check_same_thread=False)
+        self._db_lock     = threading.Lock()
+        self._lookup_db_cached = functools.lru_cache(
+            maxsize=NewIPhoneBackupFilenameFinder.lookup_cache_size)(self.lookup_db)
+        self._ff          = self.cached_fast_find(self.make_fast_find)
+
+    def index_prefixes(self):
+        return [ self._db_path + '/' ]
+
+    def index_variant(self):
+        return '%s:%s'%(','.join(self.index_domains), ','.join(self.index_prefixes()))
 
     def make_fast_find(self):
         index = dict()
-        db = sqlite3.connect('file:' + os.path.expanduser( \
-            self._backup_path + '/' + self._manifest) + '?mode=ro', uri=True)
-        query = db.cursor()
-        for entry in query.execute('SELECT relativePath, fileID FROM Files'):
+        where = []
+        args = []
+        for prefix in self.index_prefixes():
+            # Range on relativePath rather than LIKE, which can use an index
+            where.append('(relativePath >= ? AND relativePath < ?)')
+            args += [ prefix, prefix[0:-1] + chr(ord(prefix[-1])+1) ]
+        query = self._db.cursor()
+        for entry in query.execute('SELECT relativePath, fileID FROM Files '
+                'WHERE domain IN (%s) AND (%s)'%(
+                    ','.join('?'*len(self.index_domains)), ' OR '.join(where)),
+                list(self.index_domains) + args):
             fn = entry[0]
             if fn is None:
                 continue
-            len_fn = len(fn)
-            if(len_fn not in index):
-                index[len_fn] = dict()
-            index[len_fn][fn] = entry[1][0:2]+'/'+entry[1]
+            index[fn] = entry[1][0:2]+'/'+entry[1]
         return index
 
+    def lookup_unindexed(self, f):
+        return self._lookup_db_cached(f)
+
+    def lookup_db(self, f):
+        with self._db_lock:
+            query = self._db.cursor()
+            for fsub in path_suffixes(f):
+                for entry in query.execute('SELECT fileID FROM Files '
+                        'WHERE relativePath = ? LIMIT 1', (fsub,)):
+                    return os.path.expanduser(self._backup_path + '/' + \
+                        entry[0][0:2] + '/' + entry[0])
+        return None
+
 class MagicFilenameFinder:
-    def __init__(self, path = NativeDBFilenameFinder.native_db_path):
+    def __init__(self, path = NativeDBFilenameFinder.native_db_path, index_cache = None):
         if type(path) is str and len(path)>1 and path[-1] == '/':
             path = path[0:-1]
         if(path is None or len(path)==0 or path == NativeDBFilenameFinder.native_db_path):
@@ -213,10 +320,12 @@ class MagicFilenameFinder:
             self._deligate = RelocatedDBFilenameFinder(path)
         elif(os.path.isfile(os.path.expanduser(path + '/' + \
                 OldIPhoneBackupFilenameFinder.native_manifest))):
-            self._deligate = OldIPhoneBackupFilenameFinder(path)
+            self._deligate = OldIPhoneBackupFilenameFinder(path,
+                index_cache = index_cache)
         elif(os.path.isfile(os.path.expanduser(path + '/' + \
                 NewIPhoneBackupFilenameFinder.native_manifest))):
-            self._deligate = NewIPhoneBackupFilenameFinder(path)
+            self._deligate = NewIPhoneBackupFilenameFinder(path,
+                index_cache = index_cache)
         else:
             raise Exception('Unknown repository: '+path)
 
@@ -0,0 +1,157 @@
+# guid_set.py - Compact set of message GUIDs
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import heapq
+import bisect
+
+uuid_re = re.compile(r'^[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}$')
+
+def pack_guid(guid):
+    """Return the 16-byte form of a canonical upper-case UUID, or None for
+    any other GUID"""
+    if(len(guid) == 36 and uuid_re.match(guid)):
+        return bytes.fromhex(guid.replace('-', ''))
+    return None
+
+def unpack_guid(packed):
+    h = packed.hex().upper()
+    return '-'.join((h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]))
+
+class _PackedView:
+    """Sequence of the 16-byte records in a buffer, for bisect"""
+    __slots__ = ('_buf',)
+
+    def __init__(self, buf):
+        self._buf = buf
+
+    def __len__(self):
+        return len(self._buf) // 16
+
+    def __getitem__(self, i):
+        return self._buf[i*16:(i+1)*16]
+
+    def __iter__(self):
+        buf = self._buf
+        for i in range(0, len(buf), 16):
+            yield buf[i:i+16]
+
+class GUIDSet:
+    """Set of message GUIDs for deduplication against the server.
+
+    Canonical UUIDs, which is almost all of them, are stored as 16 bytes
+    each in a single sorted buffer and found by binary search, rather than
+    as one str object each in a set. Other GUIDs, such as the
+    '<guid>-FRAGMENT-n' identifiers of split messages, go into an ordinary
+    set. Newly added UUIDs are appended to a pending buffer until the next
+    lookup merges them into the sorted one, so filling the set from the
+    server and then querying it sorts the GUIDs only once. The merge sorts
+    run_size GUIDs at a time to bound the memory it needs."""
+    run_size = 65536
+
+    def __init__(self, guids = None):
+        self._packed = b''
+        self._pending = bytearray()
+        self._other = set()
+        if(guids):
+            self.update(guids)
+
+    def add(self, guid):
+        packed = pack_guid(guid)
+        if(packed is None):
+            self._other.add(guid)
+        else:
+            self._pending += packed
+
+    def update(self, guids):
+        for guid in guids:
+            self.add(guid)
+
+    def _sorted_runs(self):
+        pending = self._pending
+        run_bytes = self.run_size*16
+        for start in range(0, len(pending), run_bytes):
+            run = _PackedView(bytes(pending[start:start+run_bytes]))
+            yield b''.join(sorted(set(run)))
+
+    def _merge(self):
+        runs = list(self._sorted_runs())
+        self._pending = bytearray()
+        view = _PackedView(self._packed)
+        if(len(runs) == 1 and len(runs[0])//16 <= len(view)//16):
+            # Few new records, so splice them into the buffer, copying each
+            # run of existing records only once
+            buf = memoryview(self._packed)
+            parts = []
+            start = 0
+            for packed in _PackedView(runs[0]):
+                i = bisect.bisect_left(view, packed, start)
+                if(i < len(view) and view[i] == packed):
+                    continue
+                parts.append(buf[start*16:i*16])
+                parts.append(packed)
+                start = i
+            parts.append(buf[start*16:])
+            self._packed = b''.join(parts)
+        else:
+            merged = bytearray()
+            last = None
+            for packed in heapq.merge(view, *map(_PackedView, runs)):
+                if(packed != last):
+                    merged += packed
+                    last = packed
+            self._packed = bytes(merged)
+
+    def _contains_packed(self, packed):
+        if(self._pending):
+            self._merge()
+        view = _PackedView(self._packed)
+        i = bisect.bisect_left(view, packed)
+        return i < len(view) and view[i] == packed
+
+    def __contains__(self, guid):
+        packed = pack_guid(guid)
+        if(packed is None):
+            return guid in self._other
+        return self._contains_packed(packed)
+
+    def __len__(self):
+        if(self._pending):
+            self._merge()
+        return len(self._packed)//16 + len(self._other)
+
+    def __bool__(self):
+        return bool(self._packed or self._pending or self._other)
+
+    def __iter__(self):
+        if(self._pending):
+            self._merge()
+        for packed in _PackedView(self._packed):
+            yield unpack_guid(packed)
+        for guid in self._other:
+            yield guid
+
+    def __ior__(self, guids):
+        self.update(guids)
+        return self
+
+    def nbytes(self):
+        """Approximate storage used by the packed GUIDs"""
+        return len(self._packed) + len(self._pending)
@@ -1,11 +1,13 @@
 # imaplib_connect.py
 
-import imaplib
 import os
-import addressbook
 import imessage_sync_config
 
 def open_connection(verbose=False, config=None):
+    # imaplib brings in ssl, socket and subprocess, which are only needed
+    # once there is something to send to the server
+    import imaplib
+
     # Read the config file
     if(not config):
         config = imessage_sync_config.get_config()
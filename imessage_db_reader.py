@@ -22,6 +22,9 @@
 
 import sqlite3
 import os
+import sys
+import time
+import tempfile
 import file_finder
 
 
@@ -35,93 +38,438 @@ def make_date(x):
 sys_base_path = '~/Library/Messages'
 chat_db = 'chat.db'
 
+class Record:
+    """Compact record with dictionary-style access to its fields.
+
+    Large histories hold millions of these, so each record type lists its
+    fields in __slots__ rather than carrying a per-instance __dict__. Fields
+    can be read and written as message['guid'] or message.guid, and
+    copy.copy() and == work as they did for the dictionaries used previously.
+    Subclasses that keep private state in their slots list their public
+    field names in 'fields'."""
+    __slots__ = ()
+    fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'fields' not in cls.__dict__:
+            cls.fields = cls.__slots__
+
+    def __init__(self, *args, **kwargs):
+        fields = self.fields
+        for key, value in zip(fields, args):
+            setattr(self, key, value)
+        for key in fields[len(args):]:
+            setattr(self, key, kwargs.pop(key, None))
+        if kwargs:
+            raise TypeError('Unknown fields: ' + ', '.join(kwargs))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.keys() else default
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%s)'%(type(self).__name__,
+            ', '.join('%s=%r'%(k,v) for k,v in self.items()))
+
+class Handle(Record):
+    __slots__ = ('handle_rowid', 'contact', 'country', 'service',
+        'uncanonicalized_contact')
+
+class Chat(Record):
+    __slots__ = ('handle_rowid', 'guid', 'chat_identifier', 'service', 'room',
+        'group_id', 'last_addressed_handle', 'handles')
+
+class Attachment(Record):
+    """Attachment whose path is only resolved through the finder, and whose
+    dates are only converted, when they are first used. Most attachments
+    belong to messages that are filtered out or already uploaded, and for
+    backups each resolution is a manifest lookup."""
+    __slots__ = ('attachment_rowid', 'guid', 'raw_created_date',
+        'raw_start_date', 'raw_filename', 'mime_type', 'transfer_name',
+        'total_bytes', '_finder', '_filename', '_resolved', '_exists')
+    fields = ('attachment_rowid', 'guid', 'created_date', 'start_date',
+        'filename', 'raw_filename', 'mime_type', 'transfer_name', 'total_bytes')
+
+    def __init__(self, attachment_rowid = None, guid = None,
+            raw_created_date = None, raw_start_date = None, raw_filename = None,
+            mime_type = None, transfer_name = None, total_bytes = None,
+            finder = None):
+        self.attachment_rowid = attachment_rowid
+        self.guid             = guid
+        self.raw_created_date = raw_created_date
+        self.raw_start_date   = raw_start_date
+        self.raw_filename     = raw_filename
+        self.mime_type        = mime_type
+        self.transfer_name    = transfer_name
+        self.total_bytes      = total_bytes
+        self._finder          = finder
+        self._filename        = None
+        self._resolved        = False
+        self._exists          = None
+
+    @property
+    def created_date(self):
+        return make_date(self.raw_created_date) if self.raw_created_date is not None else None
+
+    @property
+    def start_date(self):
+        return make_date(self.raw_start_date) if self.raw_start_date is not None else None
+
+    @property
+    def filename(self):
+        if(not self._resolved):
+            if(self.raw_filename and self._finder):
+                self._filename = self._finder.filename(self.raw_filename)
+            else:
+                self._filename = self.raw_filename and os.path.expanduser(self.raw_filename)
+            self._resolved = True
+        return self._filename
+
+    def is_resolved(self):
+        return self._resolved
+
+    def file_exists(self):
+        if(self._exists is None):
+            fn = self.filename
+            self._exists = bool(fn and os.path.isfile(fn))
+        return self._exists
+
+class Message(Record):
+    __slots__ = ('message_rowid', 'guid', 'text', 'handle_id', 'subject',
+        'type', 'service', 'account', 'account_guid', 'date', 'date_read',
+        'date_delivered', 'is_delivered', 'is_finished', 'is_from_me',
+        'is_read', 'is_sent', 'is_audio_message', 'other_handle_id',
+        'handle', 'other_handle', 'chat', 'attachments', 'reply_to_guid')
+
+def intern_or_none(s):
+    return s if s is None else sys.intern(s)
+
+class MessageIndex(dict):
+    """Dictionary of messages keyed by row id that remembers the order of its
+    keys by message date, so repeated passes over the messages do not need
+    to sort them again."""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._by_date = None
+
+    def __setitem__(self, key, value):
+        self._by_date = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._by_date = None
+        dict.__delitem__(self, key)
+
+    def by_date(self):
+        if(self._by_date is None):
+            self._by_date = sorted(self, key=lambda im: self[im]['date'] or 0)
+        return self._by_date
+
+    def filter(self, predicate):
+        """Return a new index of the messages for which predicate is true,
+        preserving the date ordering without a further sort."""
+        selected = MessageIndex()
+        by_date = []
+        for im in self.by_date():
+            if(predicate(self[im])):
+                dict.__setitem__(selected, im, self[im])
+                by_date.append(im)
+        selected._by_date = by_date
+        return selected
+
+def count_resolved_attachments(messages):
+    """Return the number of attachments whose paths were resolved and the
+    total number of attachments of the messages"""
+    nresolved = 0
+    ntotal = 0
+    for m in messages.values():
+        for a in m['attachments']:
+            ntotal += 1
+            if(a.is_resolved()):
+                nresolved += 1
+    return nresolved, ntotal
+
+def date_sorted_ids(messages):
+    if(isinstance(messages, MessageIndex)):
+        return messages.by_date()
+    return sorted(messages, key=lambda im: messages[im]['date'] or 0)
+
+class MessageFilter:
+    """Selection of the chats whose messages are read, compiled into the
+    WHERE clauses of the queries so that messages in other chats are never
+    read. Chats can be included or excluded by GUID, chat identifier, the
+    contact of any participant, or service, each given as a list of GLOB
+    patterns, and limited to group or one-to-one chats. A chat is read if
+    it matches at least one pattern of each kind of include given, none of
+    the excludes, and the kind. Messages not in any chat are not read when
+    a filter is set."""
+    keys = ('guid', 'identifier', 'contact', 'service')
+    kinds = ('all', 'group', 'direct')
+    columns = dict(guid = 'c.guid', identifier = 'c.chat_identifier',
+        service = 'c.service_name')
+
+    def __init__(self, include = None, exclude = None, kind = 'all'):
+        self.include = dict((k, list(v)) for k, v in (include or {}).items() if v)
+        self.exclude = dict((k, list(v)) for k, v in (exclude or {}).items() if v)
+        self.kind    = kind or 'all'
+        for key in list(self.include) + list(self.exclude):
+            if(key not in self.keys):
+                raise Exception('Unknown message filter: ' + key)
+        if(self.kind not in self.kinds):
+            raise Exception('Unknown chat kind: ' + self.kind)
+
+    @classmethod
+    def from_config(cls, config, include = None, exclude = None, kind = None):
+        """Make a filter from the include_<key>, exclude_<key> and chat_kind
+        options of the [filter] section of the config, whitespace separated
+        lists of patterns, adding the patterns in the include and exclude
+        dictionaries and overriding the kind if given"""
+        get = lambda option: config.get('filter', option, fallback='').split()
+        include_all = dict((k, get('include_' + k) + list((include or {}).get(k, [])))
+            for k in cls.keys)
+        exclude_all = dict((k, get('exclude_' + k) + list((exclude or {}).get(k, [])))
+            for k in cls.keys)
+        return cls(include_all, exclude_all,
+            kind or config.get('filter', 'chat_kind', fallback='all'))
+
+    def is_set(self):
+        return bool(self.include or self.exclude or self.kind != 'all')
+
+    def describe(self):
+        """Canonical description of the filter, empty if it is not set"""
+        terms = [ '+%s=%s'%(k, p) for k in sorted(self.include) for p in sorted(self.include[k]) ]
+        terms += [ '-%s=%s'%(k, p) for k in sorted(self.exclude) for p in sorted(self.exclude[k]) ]
+        if(self.kind != 'all'):
+            terms.append('kind=' + self.kind)
+        return ' '.join(terms)
+
+    def match(self, key, patterns):
+        """SQL condition on chat c and its arguments, true if the chat
+        matches any of the patterns"""
+        if(key == 'contact'):
+            return 'EXISTS (SELECT 1 FROM chat_handle_join fch ' \
+                'JOIN handle fh ON fh.ROWID = fch.handle_id WHERE fch.chat_id = c.ROWID ' \
+                'AND (%s))'%' OR '.join(['fh.id GLOB ?']*len(patterns)), list(patterns)
+        return '(%s)'%' OR '.join(['%s GLOB ?'%self.columns[key]]*len(patterns)), \
+            list(patterns)
+
+    def chat_ids(self):
+        """SQL query selecting the ROWIDs of the chats that are read, and its
+        arguments, or None if the filter is not set"""
+        if(not self.is_set()):
+            return None, []
+        where = []
+        args = []
+        for key, patterns in sorted(self.include.items()):
+            sql, sql_args = self.match(key, patterns)
+            where.append(sql)
+            args += sql_args
+        for key, patterns in sorted(self.exclude.items()):
+            sql, sql_args = self.match(key, patterns)
+            where.append('NOT ' + sql)
+            args += sql_args
+        if(self.kind != 'all'):
+            where.append('(SELECT COUNT(*) FROM chat_handle_join kch '
+                'WHERE kch.chat_id = c.ROWID) %s 1'%('>' if self.kind == 'group' else '<='))
+        return 'SELECT c.ROWID FROM chat c' + \
+            (' WHERE ' + ' AND '.join(where) if where else ''), args
+
+# Ways of getting a consistent view of a database that Messages may be
+# writing to: read it in one transaction, or copy it with the online backup
+# API into memory or a temporary file and read the copy
+snapshot_modes = ('none', 'transaction', 'memory', 'file')
+
 class IMessageDBReader:
-    def __init__(self, finder_or_base_path = None):
+    mmap_size = 268435456
+    cache_size_kb = 65536
+
+    def __init__(self, finder_or_base_path = None, index_cache = None,
+            snapshot = None, message_filter = None):
         if finder_or_base_path is None or type(finder_or_base_path) is str:
-            self._finder = file_finder.MagicFilenameFinder(finder_or_base_path)
+            self._finder = file_finder.MagicFilenameFinder(finder_or_base_path,
+                index_cache = index_cache)
         else:
-            self._finder = finder
+            self._finder = finder_or_base_path
+        self._snapshot = snapshot or 'none'
+        if(self._snapshot not in snapshot_modes):
+            raise Exception('Unknown snapshot mode: ' + self._snapshot)
+        self._snapshot_file = None
+        self._chat_ids, self._chat_ids_args = message_filter.chat_ids() \
+            if message_filter else (None, [])
+        self.snapshot_time = 0.0
+        self.read_time = 0.0
         self._conn = self.get_conn()
 
     def base_path(self):
         return self._base_path if self._base_path else sys_base_path
 
+    def tune_conn(self, conn):
+        conn.execute('PRAGMA mmap_size = %d'%self.mmap_size)
+        conn.execute('PRAGMA cache_size = %d'%-self.cache_size_kb)
+        return conn
+
     def get_conn(self):
         conn = sqlite3.connect('file:' + self._finder.chat_db() + '?mode=ro', uri=True)
-        return conn
+        if(self._snapshot == 'transaction'):
+            # Holds the read transaction, and so the WAL snapshot, open
+            # until close() so that every query sees the same rows
+            conn.execute('BEGIN')
+        elif(self._snapshot in ('memory', 'file')):
+            start = time.time()
+            if(self._snapshot == 'memory'):
+                snapshot = sqlite3.connect(':memory:')
+            else:
+                fd, self._snapshot_file = tempfile.mkstemp(suffix='.db',
+                    prefix='imessage_sync_')
+                os.close(fd)
+                snapshot = sqlite3.connect(self._snapshot_file)
+            # Copy all pages in one step, so the copy is of a single point in
+            # time and Messages is only held up for as long as it takes
+            conn.backup(snapshot)
+            conn.close()
+            conn = snapshot
+            self.snapshot_time = time.time() - start
+        return self.tune_conn(conn)
+
+    def close(self):
+        """Release the snapshot, or end the read transaction"""
+        if(self._conn is not None):
+            self._conn.close()
+            self._conn = None
+        if(self._snapshot_file):
+            os.remove(self._snapshot_file)
+            self._snapshot_file = None
+
+    def timing_summary(self):
+        if(self._snapshot in ('memory', 'file')):
+            return 'snapshot %.2f s, read %.2f s'%(self.snapshot_time, self.read_time)
+        return 'read %.2f s'%self.read_time
 
     def get_handles(self):
         handles = dict()
         query = self._conn.cursor()
         for handle in query.execute('SELECT ROWID, id, country, service, '
                 'uncanonicalized_id FROM handle'):
-            handles[handle[0]] = dict(
+            handles[handle[0]] = Handle(
                 handle_rowid            = handle[0],
                 contact                 = handle[1],
-                country                 = handle[2],
-                service                 = handle[3],
+                country                 = intern_or_none(handle[2]),
+                service                 = intern_or_none(handle[3]),
                 uncanonicalized_contact = handle[4]
                 )
         return handles;
 
-    def get_chats(self):
+    def where_chat(self, column, keyword = 'WHERE'):
+        """SQL clause restricting the chat ROWIDs in the column to those
+        passing the filter, and its arguments"""
+        if(self._chat_ids is None):
+            return '', []
+        return ' %s %s IN (%s)'%(keyword, column, self._chat_ids), self._chat_ids_args
+
+    def where_message(self, column, keyword = 'WHERE'):
+        """As where_chat, for message ROWIDs"""
+        if(self._chat_ids is None):
+            return '', []
+        return ' %s %s IN (SELECT message_id FROM chat_message_join '\
+            'WHERE chat_id IN (%s))'%(keyword, column, self._chat_ids), self._chat_ids_args
+
+    def get_chats(self, handles = None):
         chats = dict()
         query = self._conn.cursor()
+        where, args = self.where_chat('ROWID')
         for chat in query.execute('SELECT ROWID, guid, chat_identifier, '
-                'service_name, room_name, group_id, last_addressed_handle FROM chat'):
-            chats[chat[0]] = dict(
+                'service_name, room_name, group_id, last_addressed_handle FROM chat'
+                + where, args):
+            chats[chat[0]] = Chat(
                 handle_rowid          = chat[0],
                 guid                  = chat[1],
                 chat_identifier       = chat[2],
-                service               = chat[3],
+                service               = intern_or_none(chat[3]),
                 room                  = chat[4],
                 group_id              = chat[5],
                 last_addressed_handle = chat[6],
                 handles               = []
                 )
 
-        handles = self.get_handles()
-        for chat_handle in query.execute('SELECT chat_id, handle_id FROM chat_handle_join'):
+        if(handles is None):
+            handles = self.get_handles()
+        where, args = self.where_chat('chat_id')
+        for chat_handle in query.execute('SELECT chat_id, handle_id FROM chat_handle_join'
+                + where, args):
             chats[chat_handle[0]]['handles'].append(handles[chat_handle[1]]);
         return chats;
 
     def get_attachments(self):
         afiles = dict()
         query = self._conn.cursor()
+        where, args = self.where_message('message_id')
+        if(where):
+            where = ' WHERE ROWID IN (SELECT attachment_id FROM message_attachment_join' \
+                + where + ')'
         for afile in query.execute('SELECT ROWID, guid, created_date, start_date, '
-                'filename, mime_type, transfer_name, total_bytes FROM attachment'):
-            fn = afile[4] and self._finder.filename(afile[4])
-            afiles[afile[0]] = dict(
+                'filename, mime_type, transfer_name, total_bytes FROM attachment'
+                + where, args):
+            afiles[afile[0]] = Attachment(
                 attachment_rowid    = afile[0],
                 guid                = afile[1],
-                created_date        = make_date(afile[2]),
-                start_date          = make_date(afile[3]),
-                filename            = fn,
+                raw_created_date    = afile[2],
+                raw_start_date      = afile[3],
                 raw_filename        = afile[4],
-                mime_type           = afile[5],
+                mime_type           = intern_or_none(afile[5]),
                 transfer_name       = afile[6],
-                total_bytes         = afile[7]
+                total_bytes         = afile[7],
+                finder              = self._finder
                 )
         return afiles
 
     def get_messages(self):
-        msgs = dict()
+        start = time.time()
+        msgs = MessageIndex()
         handles = self.get_handles()
         query = self._conn.cursor()
+        where, args = self.where_message('ROWID')
         for msg in query.execute('SELECT ROWID, guid, text, handle_id, subject, '
                 'type, service, account, account_guid, date, date_read, '
                 'date_delivered, is_delivered, is_finished, is_from_me, is_read, '
-                'is_sent, is_audio_message, other_handle FROM message'):
-            msgdict = dict(
+                'is_sent, is_audio_message, other_handle FROM message' + where, args):
+            msgdict = Message(
                 message_rowid              = msg[0],
                 guid                       = msg[1],
                 text                       = msg[2],
                 handle_id                  = msg[3],
                 subject                    = msg[4],
                 type                       = msg[5],
-                service                    = msg[6],
-                account                    = msg[7],
-                account_guid               = msg[8],
+                service                    = intern_or_none(msg[6]),
+                account                    = intern_or_none(msg[7]),
+                account_guid               = intern_or_none(msg[8]),
                 date                       = make_date(msg[9]) if msg[9]>0 else None,
                 date_read                  = make_date(msg[10]) if msg[10]>0 else None,
                 date_delivered             = make_date(msg[11]) if msg[11]>0 else None,
@@ -135,7 +483,8 @@ class IMessageDBReader:
                 handle                     = None,
                 other_handle               = None,
                 chat                       = None,
-                attachments                = []
+                attachments                = [],
+                reply_to_guid              = None
                 )
             if(msgdict['handle_id'] > 0):
                 msgdict['handle'] = handles[msgdict['handle_id']];
@@ -143,12 +492,37 @@ class IMessageDBReader:
                 msgdict['other_handle'] = handles[msgdict['other_handle_id']];
             msgs[msg[0]] = msgdict
 
-        chats = self.get_chats()
-        for chat_msg in query.execute('SELECT chat_id, message_id FROM chat_message_join'):
+        chats = self.get_chats(handles)
+        where, args = self.where_chat('chat_id')
+        for chat_msg in query.execute('SELECT chat_id, message_id FROM chat_message_join'
+                + where, args):
             msgs[chat_msg[1]]['chat'] = chats[chat_msg[0]];
 
         attachments = self.get_attachments()
-        for msg_attachment in query.execute('SELECT message_id, attachment_id FROM message_attachment_join'):
+        where, args = self.where_message('message_id')
+        for msg_attachment in query.execute('SELECT message_id, attachment_id FROM message_attachment_join'
+                + where, args):
             msgs[msg_attachment[0]]['attachments'].append(attachments[msg_attachment[1]]);
 
+        for message_id, reply_to_guid in self.get_reply_to_guids():
+            msgs[message_id]['reply_to_guid'] = reply_to_guid;
+
+        self.read_time = time.time() - start
         return msgs
+
+    def get_reply_to_guids(self):
+        """Pairs of message row id and the GUID of the message before it in
+        the same chat, from a window function over each chat ordered by
+        date. Only messages with text or attachments from a known sender,
+        which are the ones that can be uploaded, are counted, so that the
+        threading headers of every message can be made independently."""
+        query = self._conn.cursor()
+        where, args = self.where_chat('chat_id', 'AND')
+        return query.execute('SELECT message_id, reply_to_guid FROM ('
+            '  SELECT cm.chat_id, cm.message_id, LAG(m.guid) OVER ('
+            '    PARTITION BY cm.chat_id ORDER BY m.date, m.ROWID) AS reply_to_guid '
+            '  FROM chat_message_join cm JOIN message m ON m.ROWID = cm.message_id '
+            '  WHERE (m.is_from_me OR m.handle_id > 0 OR m.other_handle > 0) '
+            '    AND (m.text IS NOT NULL OR m.ROWID IN '
+            '      (SELECT message_id FROM message_attachment_join))) '
+            'WHERE reply_to_guid IS NOT NULL' + where, args)
@@ -0,0 +1,142 @@
+# imessage_stats.py - Message statistics computed in SQL against chat.db
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import file_finder
+import imessage_db_reader
+import imessage_to_mime
+
+# Unix time of a message date, which chat.db stores in seconds or, in newer
+# versions, nanoseconds since 2001-01-01 (see imessage_db_reader.make_date)
+sql_unix_date = '(CASE WHEN m.date < 10000000000 THEN m.date ' \
+    'ELSE m.date/1000000000 END + 978307200)'
+
+class IMessageStats:
+    """Counts of messages and attachment bytes per chat, handle, service and
+    month. The message, chat and handle tables of each database are copied
+    into an in-memory database with one row per message GUID, the first
+    database to hold a message winning, and the counts are GROUP BY queries
+    on it, so no Message records are built. Chat names are looked up in the
+    address book once per chat."""
+
+    def __init__(self, finder_or_base_path = None, index_cache = None,
+            addressbook = None):
+        self._addressbook = addressbook
+        self._chat_names = None
+        self._db = sqlite3.connect('file::memory:', uri=True)
+        self._db.execute('CREATE TABLE message (guid TEXT PRIMARY KEY, '
+            'source INTEGER, chat_guid TEXT, contact TEXT, service TEXT, '
+            'is_from_me INTEGER, date REAL, nattachment INTEGER, nbytes INTEGER)')
+        self._db.execute('CREATE TABLE chat_handle (chat_guid TEXT, contact TEXT, '
+            'PRIMARY KEY (chat_guid, contact)) WITHOUT ROWID')
+        sources = finder_or_base_path if type(finder_or_base_path) is list \
+            else [ finder_or_base_path ]
+        for isource, source in enumerate(sources):
+            self.add_source(isource, source, index_cache)
+
+    def add_source(self, isource, finder_or_base_path, index_cache = None):
+        if finder_or_base_path is None or type(finder_or_base_path) is str:
+            finder = file_finder.MagicFilenameFinder(finder_or_base_path,
+                index_cache = index_cache)
+        else:
+            finder = finder_or_base_path
+        self._db.execute('ATTACH DATABASE ? AS src',
+            ('file:' + finder.chat_db() + '?mode=ro',))
+        try:
+            self._db.execute('INSERT OR IGNORE INTO message '
+                'SELECT m.guid, ?, c.guid, h.id, m.service, m.is_from_me, '
+                '  CASE WHEN m.date > 0 THEN ' + sql_unix_date + ' END, '
+                '  IFNULL(a.nattachment, 0), IFNULL(a.nbytes, 0) '
+                'FROM src.message m '
+                'LEFT JOIN src.handle h ON h.ROWID = m.handle_id '
+                'LEFT JOIN src.chat_message_join cm ON cm.message_id = m.ROWID '
+                'LEFT JOIN src.chat c ON c.ROWID = cm.chat_id '
+                'LEFT JOIN (SELECT ma.message_id, COUNT(*) AS nattachment, '
+                '    SUM(at.total_bytes) AS nbytes '
+                '  FROM src.message_attachment_join ma '
+                '  JOIN src.attachment at ON at.ROWID = ma.attachment_id '
+                '  GROUP BY ma.message_id) a ON a.message_id = m.ROWID',
+                (isource,))
+            self._db.execute('INSERT OR IGNORE INTO chat_handle '
+                'SELECT c.guid, h.id FROM src.chat_handle_join ch '
+                'JOIN src.chat c ON c.ROWID = ch.chat_id '
+                'JOIN src.handle h ON h.ROWID = ch.handle_id')
+            self._db.commit()
+        finally:
+            self._db.execute('DETACH DATABASE src')
+        self._chat_names = None
+
+    def chat_names(self):
+        """Dictionary of chat GUID to the names of its participants"""
+        if(self._chat_names is None):
+            handles = dict()
+            for chat_guid, contact in self._db.execute('SELECT chat_guid, contact '
+                    'FROM chat_handle ORDER BY chat_guid'):
+                handles.setdefault(chat_guid, []).append(
+                    imessage_db_reader.Handle(contact = contact))
+            self._chat_names = dict()
+            for chat_guid, chat_handles in handles.items():
+                if(self._addressbook):
+                    chat = imessage_db_reader.Chat(guid = chat_guid, handles = chat_handles)
+                    name = imessage_to_mime.get_chat_names(chat, self._addressbook)
+                else:
+                    name = imessage_to_mime.get_chat_contacts(dict(handles = chat_handles))
+                self._chat_names[chat_guid] = name
+        return self._chat_names
+
+    def group_by(self, column, where = None):
+        """List of (value, messages, attachments, attachment bytes) for each
+        value of the column, most messages first"""
+        return self._db.execute('SELECT %s AS k, COUNT(*), SUM(nattachment), '
+            'SUM(nbytes) FROM message m %s GROUP BY k ORDER BY COUNT(*) DESC, k'%(
+                column, 'WHERE ' + where if where else '')).fetchall()
+
+    def by_chat(self):
+        """As group_by, for each distinct chat name. Chats with the same
+        participants on different services are counted together."""
+        names = self.chat_names()
+        totals = dict()
+        for chat_guid, nmessage, nattachment, nbytes in self.group_by('chat_guid',
+                'chat_guid IS NOT NULL'):
+            name = names.get(chat_guid, chat_guid)
+            t = totals.get(name, (0, 0, 0))
+            totals[name] = (t[0]+nmessage, t[1]+nattachment, t[2]+nbytes)
+        return sorted(((name,) + t for name, t in totals.items()),
+            key = lambda r: (-r[1], r[0]))
+
+    def by_handle(self):
+        return self.group_by('contact', 'contact IS NOT NULL')
+
+    def by_service(self):
+        return self.group_by('service')
+
+    def by_month(self):
+        return sorted(self.group_by("strftime('%Y-%m', date, 'unixepoch')",
+            'date IS NOT NULL'))
+
+    def totals(self):
+        return self._db.execute('SELECT COUNT(*), SUM(nattachment), SUM(nbytes) '
+            'FROM message').fetchone()
+
+def print_table(title, rows):
+    print('%-50s %10s %10s %14s'%(title, 'Messages', 'Attached', 'Bytes'))
+    for value, nmessage, nattachment, nbytes in rows:
+        print('%-50s %10d %10d %14d'%(str(value)[0:50], nmessage,
+            nattachment or 0, nbytes or 0))
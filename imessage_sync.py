@@ -20,160 +20,158 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import imaplib
 import imaplib_connect
 import imessage_sync_config
 import imessage_db_reader
 import imessage_to_mime
+import imessage_stats
 import file_finder
 import addressbook
-import re
+import guid_set
+import storage_backend
+import upload_throttle
 import time
 import calendar
 import os
 import os.path
-import email.utils
+import json
+import hashlib
+
+partition_formats = dict(none = None, year = '%Y', month = '%Y-%m')
 
 class IMessageSync:
-    def __init__(self, connection, addressbook, config=None, verbose=False, sync_time=time.time()):
+    def __init__(self, backend, addressbook, config=None, verbose=False,
+            sync_time=time.time(), partition=None, chat_names=None,
+            search_index=None):
         if(not config):
             config = imessage_sync_config.get_config()
-        self.connection   = connection
         self.addressbook  = addressbook
         self.mailbox      = config.get('server', 'mailbox', fallback='iMessage')
         self.max_attach   = int(config.get('server', 'max_attachment_size', fallback=25000000))
+        self.partition    = partition or \
+            config.get('server', 'mailbox_partition', fallback='none')
+        self.separator    = config.get('server', 'mailbox_separator', fallback='/')
         self.verbose      = verbose
-        self.mailbox_size = None
         self.sync_time    = sync_time
-        if(self.connection and not self.connect_to_mailbox()):
+        self.chat_names   = chat_names if chat_names is not None else dict()
+        self.search_index = search_index
+        self.fragment_counts = dict()
+        self.nuploaded    = 0
+        self.nfailed      = 0
+        self.nbytes       = 0
+        if(backend is not None and not isinstance(backend, storage_backend.StorageBackend)):
+            # An IMAP connection, as returned by imaplib_connect
+            backend = storage_backend.IMAPBackend(backend, verbose=verbose,
+                separator=self.separator)
+        self.backend      = backend
+        self.connection   = getattr(backend, 'connection', None)
+        if(self.partition not in partition_formats):
+            raise Exception('Unknown mailbox partition: ' + self.partition)
+        if(self.backend and not self.connect_to_mailbox()):
             return None
 
-    def get_mailbox_size(self):
-        resp, data = self.connection.status(self.mailbox,'(MESSAGES)')
-        if(resp != 'OK'):
-            return None
-        mb, el, n = re.match(r'"(.*)" \((.*) (.*)\)',data[0].decode()).groups()
-        self.mailbox_size = int(n)
-        return self.mailbox_size
+    def is_partitioned(self):
+        return partition_formats[self.partition] is not None
+
+    def mailbox_for_date(self, date):
+        """Return the mailbox that a message sent at the given date goes in"""
+        if(not self.is_partitioned()):
+            return self.mailbox
+        return self.mailbox + self.separator + \
+            time.strftime(partition_formats[self.partition], time.gmtime(date or 0))
+
+    def mailboxes_between(self, start_date, stop_date):
+        """Return the mailboxes holding messages sent between the two dates"""
+        if(not self.is_partitioned()):
+            return [ self.mailbox ]
+        mailboxes = []
+        t = time.gmtime(start_date or 0)
+        year, month = t.tm_year, t.tm_mon
+        t = time.gmtime(stop_date if stop_date is not None else self.sync_time)
+        while((year, month) <= (t.tm_year, t.tm_mon)):
+            mailbox = self.mailbox_for_date(calendar.timegm((year, month, 1, 0, 0, 0)))
+            if(not mailboxes or mailboxes[-1] != mailbox):
+                mailboxes.append(mailbox)
+            year, month = (year, month+1) if month<12 else (year+1, 1)
+        return mailboxes
+
+    def list_partitions(self):
+        """Return the sorted names of the partition mailboxes that exist"""
+        return self.backend.list_mailboxes(self.mailbox)
 
     def connect_to_mailbox(self):
-        resp, data = self.connection.create(self.mailbox)
-        resp, data = self.connection.select(self.mailbox)
-        if(resp != 'OK'):
-            print(data[0].decode())
-            return False
-        self.mailbox_size = int(data[0].decode())
-        return True
-
-    def fetch_all_guids(self, block_size=1000):
-        i = 0
-        guids = set()
-        print("Querying previously uploaded messages",end='',flush=True)
-        while(True):
-            qrange = '%d:%d'%(i+1,i+block_size)
-            qfilter = 'BODY.PEEK[HEADER.FIELDS (%s)]'%imessage_to_mime.Xheader_guid
-            #print(qrange, qfilter)
-            resp, data = self.connection.fetch(qrange, qfilter)
-            #print (resp, len(data))
-            if(resp != 'OK'):
-                print(resp, data[0].decode())
+        if(self.is_partitioned()):
+            # Partition mailboxes are created and opened as they are used
+            return True
+        return self.backend.open_mailbox(self.mailbox)
+
+    def fetch_all_guids(self):
+        if(not self.is_partitioned()):
+            return self.backend.fetch_guids(self.mailbox)
+        guids = guid_set.GUIDSet()
+        for mailbox in self.list_partitions():
+            mailbox_guids = self.backend.fetch_guids(mailbox)
+            if(mailbox_guids is None):
                 return None
-            if(data == [None]):
-                break
-            for line in data:
-                if(type(line) == tuple):
-                    guid = re.match(r'^.*:\s+([^\s]*)\s*$',line[1].decode())
-                    if(guid):
-                        guids.add(guid.groups()[0])
-            print('.',end='',flush=True)
-            i += block_size
-        print('',flush=True)
+            guids |= mailbox_guids
         return guids
 
-    def fetch_all_guids_since(self, start_date, block_size=1000):
-        start_date = time.strftime('%d-%b-%Y',time.gmtime(start_date-86400))
-        print('Querying messages uploaded since %s'%start_date,end='',flush=True)
-        resp, data = self.connection.search(None, 'SENTSINCE %s'%start_date)
-        if(resp != 'OK'):
-            print('',flush=True)
-            print(resp, data[0].decode())
-            return None
-        if(not data[0]):
-            print('',flush=True)
-            return set()
-        first_id = None
-        last_id = None
-        all_id = []
-        num_id = 0
-        for cur_id in map(int, data[0].decode().split(' ')):
-            if(not first_id):
-                first_id = cur_id
-            else:
-                if(cur_id != last_id+1):
-                    all_id.append('%d'%first_id if first_id==last_id else \
-                        '%d:%d'%(first_id,last_id))
-                    first_id = cur_id
-            last_id = cur_id
-            num_id += 1
-            if(num_id == block_size):
-                all_id.append('%d'%first_id if first_id==last_id else \
-                    '%d:%d'%(first_id,last_id))
-                first_id = None
-                last_id = None
-                num_id = 0
-        if(first_id):
-            all_id.append('%d'%first_id if first_id==last_id else \
-                '%d:%d'%(first_id,last_id))
-        guids = set()
-        for qrange in all_id:
-            qfilter = 'BODY.PEEK[HEADER.FIELDS (%s)]'%imessage_to_mime.Xheader_guid
-            #print(qrange, qfilter)
-            resp, data = self.connection.fetch(qrange, qfilter)
-            #print (resp, len(data))
-            if(resp != 'OK'):
-                print(resp, data[0].decode())
+    def fetch_all_guids_since(self, start_date, stop_date=None):
+        """Return the GUIDs of messages sent since start_date, looking only in
+        the partitions covering start_date to stop_date if partitioned. A
+        backend keeping an index of the GUIDs on the server may return all
+        of those in the mailboxes instead, which is a superset."""
+        if(not self.is_partitioned()):
+            return self.backend.fetch_guids_since(self.mailbox, start_date)
+        guids = guid_set.GUIDSet()
+        existing = set(self.list_partitions())
+        for mailbox in self.mailboxes_between(start_date, stop_date):
+            if(mailbox not in existing):
+                continue
+            if(self.verbose):
+                print('Searching', mailbox)
+            mailbox_guids = self.backend.fetch_guids_since(mailbox, start_date)
+            if(mailbox_guids is None):
                 return None
-            for line in data:
-                if(type(line) == tuple):
-                    guid = re.match(r'^.*:\s+([^\s]*)\s*$',line[1].decode())
-                    if(guid):
-                        guids.add(guid.groups()[0])
-            print('.',end='',flush=True)
-        print('',flush=True)
+            guids |= mailbox_guids
         return guids
 
-    def fetch_internal_dates(self, start_index=-100, end_index=0):
-        if(start_index < 0):
-            start_index += self.mailbox_size
-            end_index += self.mailbox_size
-        elif(start_index < 0):
-            end_index += self.mailbox_size
-        start_index = min(max(start_index, 0), self.mailbox_size)
-        end_index = min(max(end_index, 0), self.mailbox_size)
-        if(start_index > end_index):
-            raise Exception("start_index must be smaller than end_index")
-        qrange = '%d:%d'%(start_index,end_index)
-        qfilter = 'INTERNALDATE'
-        resp, data = self.connection.fetch(qrange, qfilter)
-        if(resp != 'OK'):
-            print(resp, data[0].decode())
-            return None
-        internal_dates = []
-        for line in data:
-            date = re.match(r'^.*\s+\(INTERNALDATE "(.*)"\)$',line.decode())
-            if(date):
-                internal_dates.append(
-                    calendar.timegm(email.utils.parsedate(date.groups()[0])))
-        return internal_dates
-
     def guess_last_sync_time(self):
-        message_dates = self.fetch_internal_dates()
-        return max(message_dates) if message_dates else 0
+        if(not self.is_partitioned()):
+            return self.backend.last_message_time(self.mailbox)
+        # Only look back through the partitions until one has messages, which
+        # is normally just the current one
+        for mailbox in reversed(self.list_partitions()):
+            last_time = self.backend.last_message_time(mailbox)
+            if(last_time):
+                return last_time
+        return 0
+
+    def chat_name(self, chat):
+        """Names of the participants in the chat, looked up in the address
+        book only the first time each chat is seen"""
+        name = self.chat_names.get(chat['guid'])
+        if(name is None):
+            name = imessage_to_mime.get_chat_names(chat, self.addressbook)
+            self.chat_names[chat['guid']] = name
+        return name
+
+    def index_message(self, message, synced = True):
+        """Add the message to the search index, if there is one"""
+        if(self.search_index is None):
+            return
+        sender = None
+        if(message['is_from_me']):
+            sender = self.addressbook.me()[0]
+        elif(message.get('handle')):
+            sender = imessage_to_mime.get_handle_name(message['handle'], self.addressbook)
+        self.search_index.add(message, self.chat_name(message['chat']), sender,
+            self.mailbox_for_date(message['date']), synced = synced)
 
     def message_summary(self, message, before_gid = None):
         address = 'unknown'
         if(message['is_from_me']):
-            address = imessage_to_mime.get_chat_names(message['chat'], self.addressbook)
+            address = self.chat_name(message['chat'])
         elif(message.get('handle')):
             address = imessage_to_mime.get_handle_name(message['handle'], self.addressbook)
         s = 'to' if message['is_from_me'] else 'from'
@@ -185,51 +183,132 @@ class IMessageSync:
         s += ', guid: ' + message['guid']
         return s
 
-    def upload_message(self, message, in_reply_to = dict()):
-        emails = imessage_to_mime.get_email(message, self.addressbook, in_reply_to,
-            max_attachment_size = self.max_attach, sync_time = self.sync_time)
-        if(type(emails) is not list):
-            emails = [ emails ]
-        for iemail, email_msg in enumerate(emails):
+    def missing_fragments(self, message, guids_to_skip = None):
+        """Numbers of the fragments of the message that are not on the
+        server, so that a message that was partly uploaded is completed.
+        Earlier versions split messages differently, so once the first
+        email of a message is on the server the rest are only uploaded if
+        that email records the same number of fragments as the current
+        plan. Otherwise the message is taken to be complete."""
+        guids = imessage_to_mime.fragment_guids(message, self.max_attach)
+        missing = [ ifragment for ifragment, guid in enumerate(guids)
+            if not guids_to_skip or guid not in guids_to_skip ]
+        if(missing and missing[0] > 0 and
+                self.uploaded_fragment_count(message) != len(guids)):
+            return []
+        return missing
+
+    def uploaded_fragment_count(self, message):
+        """Number of fragments recorded in the first email of the message on
+        the server, or None if it is not known"""
+        guid = message['guid']
+        if(guid not in self.fragment_counts):
+            count = self.backend.fetch_header(self.mailbox_for_date(message['date']),
+                guid, imessage_to_mime.Xheader('fragment-count'))
+            self.fragment_counts[guid] = int(count) if count and count.isdigit() else None
+        return self.fragment_counts[guid]
+
+    def upload_message(self, message, fragments = None):
+        nfragment = len(imessage_to_mime.plan_fragments(message, self.max_attach))
+        if(fragments is None):
+            fragments = range(nfragment)
+        mailbox = self.mailbox_for_date(message['date'])
+        self.backend.create_mailbox(mailbox)
+        for ifragment in fragments:
+            # Render one fragment at a time so that only one set of
+            # attachments is held in memory
+            email_msg = imessage_to_mime.get_email(message, self.addressbook,
+                max_attachment_size = self.max_attach, sync_time = self.sync_time,
+                fragments = [ ifragment ])
+            if(type(email_msg) is list):
+                email_msg = email_msg[0]
             email_str = email_msg.as_bytes()
             if True or self.verbose:
                 info = 'size: %d'%len(email_str)
-                if(len(emails)>1):
-                    info = 'frag: %d/%d, '%(iemail+1,len(emails)) + info
+                if(nfragment>1):
+                    info = 'frag: %d/%d, '%(ifragment+1,nfragment) + info
+                if(self.is_partitioned()):
+                    info = mailbox + ', ' + info
                 print('Uploading message',
                     self.message_summary(message, info))
-            resp, data = self.connection.append(self.mailbox,
-                '(\\Seen)' if message['is_read'] or message['is_from_me'] else None,
-                imaplib.Time2Internaldate(message['date']), email_str)
-            if self.verbose:
-                print('  ',resp,data)
-            if(resp == 'OK'):
-                self.mailbox_size += 1
+            good, status = self.backend.append(mailbox, email_str, message['date'],
+                bool(message['is_read'] or message['is_from_me']),
+                email_msg[imessage_to_mime.Xheader_guid])
+            if(not good):
+                return False, status
+            self.nbytes += len(email_str)
         return True, 'OK'
 
-    def upload_all_messages(self, messages, guids_to_skip = set(), do_upload = True):
-        in_reply_to = dict()
-        for id in sorted(messages, key=lambda im: messages[im]['date']):
+    def upload_all_messages(self, messages, guids_to_skip = set(), do_upload = True,
+            missing = None):
+        """Upload the fragments of the messages that are not on the server.
+        If missing is given it is a dictionary of message id to the numbers
+        of the fragments to upload, as found by missing_fragments, and
+        messages not in it are taken to be on the server already."""
+        nfailed = 0
+        nuploaded = 0
+        for id in imessage_db_reader.date_sorted_ids(messages):
             message = messages[id]
             if(not imessage_to_mime.is_valid(message)):
                 continue
-            if(not guids_to_skip or message['guid'] not in guids_to_skip):
+            if(missing is not None):
+                fragments = missing.get(id)
+            else:
+                fragments = self.missing_fragments(message, guids_to_skip)
+            if(fragments):
                 if(do_upload):
-                    good, status = self.upload_message(message, in_reply_to)
+                    good, status = self.upload_message(message, fragments)
+                    if(not good):
+                        nfailed += 1
+                    else:
+                        nuploaded += 1
+                        self.index_message(message)
                 elif True or self.verbose:
                     print('Not uploading message', self.message_summary(message))
-            elif self.verbose:
-                print('Skipping message', self.message_summary(message))
-            imessage_to_mime.update_chat_thread_ids(message, self.addressbook, in_reply_to)
+            else:
+                if self.verbose:
+                    print('Skipping message', self.message_summary(message))
+                self.index_message(message)
+        if(nfailed):
+            print('Failed to upload %d messages'%nfailed)
+        self.nuploaded += nuploaded
+        self.nfailed += nfailed
+        if(self.search_index is not None):
+            self.search_index.commit()
+        throttle = getattr(self.backend, 'throttle', None)
+        if(throttle and do_upload):
+            print('Upload throttle:', throttle.summary())
+
+    def update_seen_flags(self, messages):
+        """Flag as \\Seen the uploaded emails of messages that have been read
+        since they were uploaded, using the UIDs recorded when they were
+        appended, so that nothing has to be uploaded again"""
+        uids = getattr(self.backend, 'uid_index', None)
+        if(uids is None):
+            return 0
+        unseen = uids.unseen(self.backend.account)
+        if(not unseen):
+            return 0
+        targets = dict()
+        for message in messages.values():
+            locations = unseen.get(message['guid'])
+            if(locations and (message['is_read'] or message['is_from_me'])):
+                for mailbox, uidvalidity, uid in locations:
+                    targets.setdefault((mailbox, uidvalidity), []).append(uid)
+        nflagged = 0
+        for (mailbox, uidvalidity), mailbox_uids in sorted(targets.items()):
+            nflagged += self.backend.update_seen(mailbox, uidvalidity, mailbox_uids)
+        if(targets):
+            print('Marked %d uploaded messages as read'%nflagged)
+        return nflagged
 
     def print_all_messages(self, messages):
-        in_reply_to = dict()
-        for id in sorted(messages, key=lambda im: messages[im]['date']):
+        for id in imessage_db_reader.date_sorted_ids(messages):
             message = messages[id]
             print(self.message_summary(message))
 
-    def full_message_email(self, message, in_reply_to = dict()):
-        emails = imessage_to_mime.get_email(message, self.addressbook, in_reply_to,
+    def full_message_email(self, message):
+        emails = imessage_to_mime.get_email(message, self.addressbook,
             max_attachment_size = self.max_attach, sync_time = self.sync_time)
         if(type(emails) is not list):
             emails = [ emails ]
@@ -242,76 +321,233 @@ class IMessageSync:
 def num_attachments(m):
     nfound = 0
     for a in m['attachments']:
-        fn = a['filename']
-        if(fn and os.path.isfile(fn)):
+        if(a.file_exists()):
             nfound += 1
     return nfound
 
 def best_message_copy(m1, m2):
     return m1 if num_attachments(m1)>=num_attachments(m2) else m2
 
-def get_all_messages(finder_or_base_path = None):
+def read_messages(finder_or_base_path = None, index_cache = None, snapshot = None,
+        message_filter = None):
+    db = imessage_db_reader.IMessageDBReader(finder_or_base_path = finder_or_base_path,
+        index_cache = index_cache, snapshot = snapshot, message_filter = message_filter)
+    try:
+        messages = db.get_messages()
+    finally:
+        db.close()
+    print('Read %d messages from %s: %s'%(len(messages),
+        finder_or_base_path or 'iMessage database', db.timing_summary()))
+    return messages
+
+def get_all_messages(finder_or_base_path = None, index_cache = None, snapshot = None,
+        message_filter = None):
     if(type(finder_or_base_path) is list):
         all_guid = dict()
         for ifobp, fobp in enumerate(finder_or_base_path):
-            db = imessage_db_reader.IMessageDBReader(finder_or_base_path = fobp)
-            messages = db.get_messages()
+            messages = read_messages(fobp, index_cache, snapshot, message_filter)
             for im, m in messages.items():
                 m['message_rowid'] = str(ifobp)+'_'+str(im)
                 if(m['guid'] not in all_guid):
                     all_guid[m['guid']] = m
                 else:
                     all_guid[m['guid']] = best_message_copy(all_guid[m['guid']], m)
-        all_messages = dict()
+        all_messages = imessage_db_reader.MessageIndex()
         for m in all_guid.values():
             all_messages[m['message_rowid']] = m
         return all_messages
     else:
-        db = imessage_db_reader.IMessageDBReader(finder_or_base_path = finder_or_base_path)
-        return db.get_messages()
+        return read_messages(finder_or_base_path, index_cache, snapshot, message_filter)
+
+def check_attachment(attachment, checksum = False, block_size = 1048576):
+    """Stat the file of one attachment, and optionally read it through a
+    SHA-256 hash, returning a dict describing it. The status is one of
+    'found', 'missing', 'truncated' (smaller than the total_bytes recorded
+    in the database) or 'unreadable'"""
+    fn = attachment['filename']
+    result = dict(guid = attachment['guid'], raw_filename = attachment['raw_filename'],
+        filename = fn, total_bytes = attachment['total_bytes'])
+    if(not fn):
+        result['status'] = 'missing'
+        result['error'] = 'no path found'
+        return result
+    try:
+        st = os.stat(fn)
+        result['size'] = st.st_size
+        if(checksum):
+            h = hashlib.sha256()
+            with open(fn, 'rb') as fp:
+                for block in iter(lambda: fp.read(block_size), b''):
+                    h.update(block)
+            result['sha256'] = h.hexdigest()
+    except FileNotFoundError:
+        result['status'] = 'missing'
+        result['error'] = 'file not found'
+        return result
+    except OSError as e:
+        result['status'] = 'unreadable'
+        result['error'] = str(e)
+        return result
+    if(attachment['total_bytes'] and st.st_size < attachment['total_bytes']):
+        result['status'] = 'truncated'
+    else:
+        result['status'] = 'found'
+    return result
+
+verify_statuses = ('found', 'missing', 'truncated', 'unreadable')
 
-def verify_all_messages(finder_or_base_path = None, verbose = False):
+def verify_all_messages(finder_or_base_path = None, verbose = False,
+        index_cache = None, checksum = False, nthread = 8, problems_file = None,
+        snapshot = None):
+    """Check the attachment files of all messages in each source database,
+    printing the number found, missing, truncated and unreadable for each.
+    The checks run in a pool of nthread threads, so that the time taken
+    is limited by I/O rather than by the latency of each file. Problem
+    attachments are written to problems_file, if given, as JSON lines"""
+    import concurrent.futures
     config = imessage_sync_config.get_config()
-    x = get_all_messages(finder_or_base_path = finder_or_base_path)
     a = addressbook.AddressBook(config = config)
     sync = IMessageSync(None,a)
-    nfound = 0
-    nmissing = 0
-    for ix in sorted(x, key=lambda ix: x[ix]['date']):
-        if(verbose):
-            print('Verifying message', sync.message_summary(x[ix]))
-        all_found = True
-        for ia in x[ix]['attachments']:
-            fn = ia['filename']
-            if(fn):
-                if os.path.isfile(fn):
-                    nfound += 1
-                    if(verbose):
-                        print('- OK :', fn)
-                else:
-                    if(all_found and not verbose):
-                        print('Verifying message', sync.message_summary(x[ix]))
-                    nmissing + 1
-                    all_found = False
-                    print('- NOT FOUND :', fn)
-            else:
-                if(all_found and not verbose):
-                    print('Verifying message', sync.message_summary(x[ix]))
-                nmissing += 1
-                all_found = False
-                print('- NO PATH FOUND :', ia)
-    print('Found:', nfound, '; not found:', nmissing)
+    sources = finder_or_base_path if type(finder_or_base_path) is list \
+        else [ finder_or_base_path ]
+    problems = open(problems_file, 'w') if problems_file else None
+    total = dict.fromkeys(verify_statuses, 0)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = nthread) as pool:
+            for source in sources:
+                x = read_messages(source, index_cache, snapshot)
+                work = [ (x[ix], ia) for ix in imessage_db_reader.date_sorted_ids(x)
+                    for ia in x[ix]['attachments'] ]
+                counts = dict.fromkeys(verify_statuses, 0)
+                last_message = None
+                for (m, ia), result in zip(work, pool.map(
+                        lambda w: check_attachment(w[1], checksum), work)):
+                    status = result['status']
+                    counts[status] += 1
+                    if(status == 'found' and not verbose):
+                        continue
+                    if(m is not last_message):
+                        print('Verifying message', sync.message_summary(m))
+                        last_message = m
+                    print('- %s :'%status.upper(), result['filename'] or ia['raw_filename'])
+                    if(status != 'found' and problems):
+                        result['source'] = str(source) if source else 'default'
+                        result['message_guid'] = m['guid']
+                        problems.write(json.dumps(result) + '\n')
+                print('%s: found: %d; missing: %d; truncated: %d; unreadable: %d'%(
+                    source or 'default', counts['found'], counts['missing'],
+                    counts['truncated'], counts['unreadable']))
+                for status in verify_statuses:
+                    total[status] += counts[status]
+    finally:
+        if(problems):
+            problems.close()
+    if(len(sources) > 1):
+        print('Total: found: %d; missing: %d; truncated: %d; unreadable: %d'%(
+            total['found'], total['missing'], total['truncated'], total['unreadable']))
+    return total
+
+def print_attachment_resolution(messages):
+    nresolved, ntotal = imessage_db_reader.count_resolved_attachments(messages)
+    print('Attachments resolved: %d, skipped: %d'%(nresolved, ntotal-nresolved))
+
+def imap_account(config):
+    """Name of the IMAP account, under which its UIDs are indexed"""
+    return '%s@%s'%(config.get('account', 'username', fallback=''),
+        config.get('server', 'hostname', fallback=''))
+
+def open_imap_backend(config, verbose = False, max_upload_rate = None,
+        uid_index = None):
+    """Connect to the IMAP server, with APPENDs paced by an adaptive throttle
+    unless it is disabled in the config"""
+    open_connection = lambda: imaplib_connect.open_connection(config = config,
+        verbose = verbose)
+    throttle = upload_throttle.AdaptiveThrottle.from_config(config,
+        verbose = verbose, max_bytes_per_sec = max_upload_rate)
+    return storage_backend.IMAPBackend(open_connection(), verbose = verbose,
+        separator = config.get('server', 'mailbox_separator', fallback='/'),
+        throttle = throttle, reconnect = open_connection,
+        uid_index = uid_index, account = imap_account(config))
+
+def sync_target(config, backend = None, partition = None, message_filter = None):
+    """Name of the store and mailbox that a sync uploads to, and of the
+    filter selecting the messages uploaded there"""
+    location = backend.location() if backend else 'imap:' + imap_account(config)
+    target = '%s %s %s'%(location, config.get('server', 'mailbox', fallback='iMessage'),
+        partition or config.get('server', 'mailbox_partition', fallback='none'))
+    if(message_filter and message_filter.is_set()):
+        target += ' ' + message_filter.describe()
+    return target
+
+def unchanged_sources(finder_or_base_path, sync_state, target):
+    """Split the sources into those changed since they were last fully
+    synced to the target and those that were not, returning the changed
+    sources, in the form given, and the fingerprints of all of them"""
+    sources = finder_or_base_path if type(finder_or_base_path) is list \
+        else [ finder_or_base_path ]
+    changed = []
+    fingerprints = []
+    for source in sources:
+        fingerprint = sync_state.fingerprint(source)
+        fingerprints.append(fingerprint)
+        if(sync_state.is_synced(fingerprint, target)):
+            print('Skipping %s, unchanged since it was synced'%(
+                source or 'iMessage database'))
+        else:
+            changed.append(source)
+    if(type(finder_or_base_path) is not list):
+        changed = changed[0] if changed else []
+    return changed, fingerprints
 
 def sync_all_messages(finder_or_base_path = None, verbose = True,
-        start_date = None, stop_date = None, do_upload = True):
-    config = imessage_sync_config.get_config()
+        start_date = None, stop_date = None, do_upload = True, index_cache = None,
+        partition = None, backend = None, max_upload_rate = None, snapshot = None,
+        config = None, address_book = None, chat_names = None, search_index = None,
+        uid_index = None, update_seen = True, sync_state = None,
+        message_filter = None):
+    """Upload the messages not yet on the server, returning a dictionary
+    summarising what was done. A config, AddressBook and cache of chat
+    names can be given to share them between several syncs. Messages that
+    are uploaded or already on the server are added to the search index.
+    If update_seen is set, messages read since they were uploaded are
+    flagged as such on the server. With a SyncState, sources unchanged since
+    they were fully synced to the same mailbox are skipped without being
+    read, and those fully synced by this call are recorded. Only the chats
+    selected by the MessageFilter, by default the one in the config, are
+    read."""
+    config = config or imessage_sync_config.get_config()
+    message_filter = message_filter or \
+        imessage_db_reader.MessageFilter.from_config(config)
     sync_time = time.time()
-    x = get_all_messages(finder_or_base_path = finder_or_base_path)
+    summary = dict(found = 0, new = 0, uploaded = 0, failed = 0, bytes = 0, seen = 0,
+        skipped = 0)
+    fingerprints = []
+    if(sync_state and do_upload):
+        target = sync_target(config, backend, partition, message_filter)
+        nsource = len(finder_or_base_path) if type(finder_or_base_path) is list else 1
+        finder_or_base_path, fingerprints = unchanged_sources(finder_or_base_path,
+            sync_state, target)
+        summary['skipped'] = nsource - (len(finder_or_base_path)
+            if type(finder_or_base_path) is list else 1)
+        if(finder_or_base_path == []):
+            print('All sources unchanged since they were synced, exiting')
+            return summary
+    def record_synced():
+        # Only a sync of all dates without failures leaves nothing to do
+        if(fingerprints and start_date is None and stop_date is None
+                and summary['failed'] == 0):
+            sync_state.mark_synced(fingerprints, target)
+    x = get_all_messages(finder_or_base_path = finder_or_base_path,
+        index_cache = index_cache, snapshot = snapshot, message_filter = message_filter)
+    all_x = x
     sync = None
+    make_sync = lambda: IMessageSync(
+        backend or open_imap_backend(config, verbose, max_upload_rate, uid_index),
+        address_book or addressbook.AddressBook(config = config), config = config,
+        verbose=verbose, sync_time=sync_time, partition=partition,
+        chat_names=chat_names, search_index=search_index)
     if(start_date == "latest"):
-        c = imaplib_connect.open_connection(config = config, verbose = verbose)
-        a = addressbook.AddressBook(config = config)
-        sync = IMessageSync(c,a,verbose=verbose,sync_time=sync_time)
+        sync = make_sync()
         if(verbose):
             print("Querying time of latest messages")
         start_date = sync.guess_last_sync_time()
@@ -319,55 +555,64 @@ def sync_all_messages(finder_or_base_path = None, verbose = True,
             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_date)))
         start_date -= 3600
     if(start_date):
-        xx = dict()
-        for ix in filter(lambda ix: x[ix]['date']>=start_date, x):
-            xx[ix] = x[ix]
-        x = xx
+        x = x.filter(lambda m: m['date'] is not None and m['date']>=start_date)
     if(stop_date):
-        xx = dict()
-        for ix in filter(lambda ix: x[ix]['date']<=stop_date, x):
-            xx[ix] = x[ix]
-        x = xx
+        x = x.filter(lambda m: m['date'] is not None and m['date']<=stop_date)
+    summary['found'] = len(x)
     if(len(x) == 0):
+        if(sync and update_seen and do_upload):
+            summary['seen'] = sync.update_seen_flags(all_x)
         print('Found no messages in iMessages database(s), exiting')
-        return
+        if(verbose):
+            print_attachment_resolution(all_x)
+        record_synced()
+        return summary
     print('Found %d messages in iMessages database(s)'%len(x))
     if(sync == None):
-        c = imaplib_connect.open_connection(config = config, verbose = verbose)
-        a = addressbook.AddressBook(config = config)
-        sync = IMessageSync(c,a,verbose=verbose,sync_time=sync_time)
+        sync = make_sync()
     guids_to_skip = sync.fetch_all_guids_since( \
-        min(map(lambda ix: ix['date'], x.values())))
+        min(map(lambda ix: ix['date'], x.values())),
+        max(map(lambda ix: ix['date'], x.values())))
+    if(update_seen and do_upload):
+        summary['seen'] = sync.update_seen_flags(all_x)
 
-    nupload = 0
-    for id in sorted(x, key=lambda im: x[im]['date']):
+    missing = dict()
+    for id in x:
         message = x[id]
         if(not imessage_to_mime.is_valid(message)):
             continue
-        if(not guids_to_skip or message['guid'] not in guids_to_skip):
-            nupload += 1
+        fragments = sync.missing_fragments(message, guids_to_skip)
+        if(fragments):
+            missing[id] = fragments
+    nupload = len(missing)
+    summary['new'] = nupload
     if(nupload == 0):
         print('No new messages to upload, exiting')
-        return
+        if(verbose):
+            print_attachment_resolution(all_x)
+        record_synced()
+        return summary
     print('Number of new messages to upload : %d'%nupload)
 
-    sync.upload_all_messages(x, guids_to_skip, do_upload=do_upload)
+    sync.upload_all_messages(x, guids_to_skip, do_upload=do_upload, missing=missing)
+    if(verbose):
+        print_attachment_resolution(all_x)
+    summary.update(uploaded = sync.nuploaded, failed = sync.nfailed,
+        bytes = sync.nbytes)
+    record_synced()
+    return summary
 
-def print_all_messages(finder_or_base_path = None):
+def print_all_messages(finder_or_base_path = None, index_cache = None):
     config = imessage_sync_config.get_config()
-    x = get_all_messages(finder_or_base_path = finder_or_base_path)
+    x = get_all_messages(finder_or_base_path = finder_or_base_path,
+        index_cache = index_cache)
     a = addressbook.AddressBook(config = config)
     sync = IMessageSync(None,a)
     sync.print_all_messages(x)
 
-def recipient_histogram(finder_or_base_path = None):
+def recipient_histogram(finder_or_base_path = None, index_cache = None):
     config = imessage_sync_config.get_config()
-    x = get_all_messages(finder_or_base_path = finder_or_base_path)
     a = addressbook.AddressBook(config = config)
-    sync = IMessageSync(None,a)
-    count = dict()
-    for ix in x:
-        if(x[ix]['chat']):
-            n = imessage_to_mime.get_chat_names(x[ix]['chat'], a)
-            count[n] = count.get(n,0) + 1
-    return count
+    stats = imessage_stats.IMessageStats(finder_or_base_path = finder_or_base_path,
+        index_cache = index_cache, addressbook = a)
+    return dict((name, nmessage) for name, nmessage, nattachment, nbytes in stats.by_chat())
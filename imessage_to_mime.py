@@ -20,18 +20,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import email.mime.base
-import email.mime.text
-import email.mime.image
-import email.mime.audio
-import email.mime.multipart
+# The email.mime classes are imported by the functions that build messages,
+# so that runs which upload nothing do not pay for loading them
 import email.utils
-import email.encoders
 import email.charset
 import email.header
 import email
 import hashlib
 import copy
+import os
 #import BytesIO
 
 email.charset.Charset('utf-8').body_encoding = email.charset.QP
@@ -115,6 +112,7 @@ def get_chat_id(chat, addressbook):
     return get_rfc3501_id(id)
 
 def get_text_msg(message):
+    import email.mime.text
     text = message['text']
     try:
         text.encode('us-ascii')
@@ -126,6 +124,11 @@ def get_text_msg(message):
     return email.mime.text.MIMEText(text, _charset='us-ascii')
 
 def get_attachment_msg(attachment):
+    import email.mime.base
+    import email.mime.text
+    import email.mime.image
+    import email.mime.audio
+    import email.encoders
     if(not attachment['mime_type']):
         return None
     path = attachment['filename']
@@ -173,16 +176,17 @@ def is_valid(message):
         (message['is_from_me']==True or message.get('handle') is not None or message.get('other_handle') is not None) and \
         (message['text'] is not None or len(message['attachments'])>0))
 
-def set_headers(outer, message, addressbook, in_reply_to, sync_time=None):
+def set_headers(outer, message, addressbook, sync_time=None):
     outer['Subject']    = email.header.Header(get_subject(message, addressbook))
     outer['To']         = get_to(message, addressbook)
     outer['From']       = get_from(message, addressbook)
     outer['Date']       = email.utils.formatdate(message['date'])
     outer['Message-ID'] = get_message_id(message)
     chat_id = get_chat_id(message['chat'], addressbook)
-    if(chat_id in in_reply_to):
-        outer['In-Reply-To']             = in_reply_to[chat_id]
-        outer['References']              = chat_id + ' ' + in_reply_to[chat_id]
+    if(message.get('reply_to_guid')):
+        reply_to_id = get_rfc3501_id(message['reply_to_guid'])
+        outer['In-Reply-To']             = reply_to_id
+        outer['References']              = chat_id + ' ' + reply_to_id
     else:
         outer['References']              = chat_id
     outer[Xheader_guid]                  = message['guid']
@@ -208,53 +212,104 @@ def set_headers(outer, message, addressbook, in_reply_to, sync_time=None):
         outer[Xheader('upload-date')]    = \
             email.utils.formatdate(sync_time)
 
-def get_email(message, addressbook, in_reply_to = dict(), max_attachment_size = None, sync_time = None):
+def base64_size(nbytes):
+    """Estimate of the size of a MIME part holding nbytes base64 encoded"""
+    return (nbytes + 56)//57*78 + 512
+
+def encoded_size(attachment):
+    """Estimate of the size of the attachment once base64 encoded into a
+    message, from the size recorded in the database only, so that it does
+    not depend on which files happen to be available. An attachment with
+    no recorded size is counted as its MIME headers alone."""
+    return base64_size(attachment['total_bytes'] or 0)
+
+def file_encoded_size(attachment):
+    """As encoded_size, from the size of the attachment's file, or of the
+    placeholder for a missing file"""
+    path = attachment['filename']
+    return base64_size(os.path.getsize(path) if path and os.path.isfile(path) else 0)
+
+def plan_fragments(message, max_attachment_size = None):
+    """Split the attachments of the message into the fragments that will be
+    uploaded as separate emails, returning a list of (attachment index,
+    suppressed) pairs for each fragment. The plan depends only on the
+    message and the size limit, so fragment n has the same GUID and
+    contents in every run."""
+    fragments = [ [] ]
+    total_asize = 0
+    for ia, a in enumerate(message['attachments']):
+        if(not a['mime_type']):
+            continue
+        if(max_attachment_size is None or max_attachment_size <= 0):
+            fragments[-1].append((ia, False))
+            continue
+        asize = encoded_size(a)
+        if(asize > max_attachment_size):
+            fragments[-1].append((ia, True))
+            continue
+        if(total_asize + asize > max_attachment_size):
+            fragments.append([])
+            total_asize = 0
+        fragments[-1].append((ia, False))
+        total_asize += asize
+    return fragments
+
+def fragment_guid(message, ifragment):
+    if(ifragment == 0):
+        return message['guid']
+    return message['guid'] + '-FRAGMENT-' + str(ifragment)
+
+def fragment_guids(message, max_attachment_size = None):
+    return [ fragment_guid(message, ifragment) for ifragment in
+        range(len(plan_fragments(message, max_attachment_size))) ]
+
+def get_email(message, addressbook, max_attachment_size = None, sync_time = None,
+        fragments = None):
+    """Return the email for the message, or a list of emails if its
+    attachments are split into fragments. If fragments is given only the
+    fragments with those numbers are rendered."""
+    import email.mime.text
+    import email.mime.multipart
     if(message['attachments']):
+        plan = plan_fragments(message, max_attachment_size)
         emails = []
-        outer = email.mime.multipart.MIMEMultipart()
-        set_headers(outer, message, addressbook, in_reply_to, sync_time)
-        outer.preamble = 'You will not see this in a MIME-aware email reader.\n'
-        outer.attach(get_text_msg(message))
-        attachments = []
-        for a in message['attachments']:
-            attachments.append(get_attachment_msg(a))
-        if(max_attachment_size is not None and max_attachment_size > 0):
-            total_asize = 0
-            for ia, a in enumerate(attachments):
-                if(not a):
-                    continue
-                asize = len(a.as_bytes())
-                if(asize > max_attachment_size):
+        for ifragment, fragment in enumerate(plan):
+            if(fragments is not None and ifragment not in fragments):
+                continue
+            fragment_message = message
+            if(ifragment > 0):
+                fragment_message = copy.copy(message)
+                fragment_message['guid'] = fragment_guid(message, ifragment)
+            outer = email.mime.multipart.MIMEMultipart()
+            set_headers(outer, fragment_message, addressbook, sync_time)
+            outer.preamble = 'You will not see this in a MIME-aware email reader.\n'
+            if(ifragment == 0):
+                outer.attach(get_text_msg(message))
+            fragment_size = 0
+            for ia, suppressed in fragment:
+                if(not suppressed and max_attachment_size is not None and
+                        max_attachment_size > 0):
+                    # The plan uses the sizes recorded in the database, which
+                    # may be missing or wrong, so the files themselves are
+                    # checked against the limit before they are read
+                    asize = file_encoded_size(message['attachments'][ia])
+                    suppressed = fragment_size + asize > max_attachment_size
+                    if(not suppressed):
+                        fragment_size += asize
+                if(suppressed):
                     a = email.mime.text.MIMEText('Attachment "%s" suppressed due to '
                         'file-size constraints'%message['attachments'][ia]['raw_filename'])
-                    asize = len(a.as_bytes())
-                elif(total_asize + asize > max_attachment_size):
-                    outer[Xheader('fragment')] = str(len(emails))
-                    emails.append(outer)
-                    new_message = copy.copy(message)
-                    new_message['guid'] = \
-                        message['guid'] + '-FRAGMENT-' + str(len(emails))
-                    outer = email.mime.multipart.MIMEMultipart()
-                    set_headers(outer, new_message, addressbook, in_reply_to, sync_time)
-                    outer.preamble = 'You will not see this in a MIME-aware email reader.\n'
-                    total_asize = 0
+                else:
+                    a = get_attachment_msg(message['attachments'][ia])
                 outer.attach(a)
-                total_asize += asize
-        else:
-            for a in attachments:
-                if(a):
-                    outer.attach(a)
-        if(emails):
-            outer[Xheader('fragment')] = str(len(emails))
+            if(len(plan) > 1):
+                outer[Xheader('fragment')] = str(ifragment)
+                outer[Xheader('fragment-count')] = str(len(plan))
             emails.append(outer)
+        if(len(plan) > 1):
             return emails
-        else:
-            return outer
+        return emails[0] if emails else []
     else:
         outer = get_text_msg(message)
-        set_headers(outer, message, addressbook, in_reply_to, sync_time)
+        set_headers(outer, message, addressbook, sync_time)
     return outer
-
-def update_chat_thread_ids(message, addressbook, in_reply_to):
-    chat_id = get_chat_id(message['chat'], addressbook)
-    in_reply_to[chat_id] = get_message_id(message)
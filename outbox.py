@@ -0,0 +1,261 @@
+# outbox.py - Durable spool of rendered messages awaiting upload
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import guid_set
+import storage_backend
+
+default_outbox = '~/.imessage_sync_outbox'
+
+class Outbox:
+    """Directory of rendered emails waiting to be uploaded, with a SQLite
+    manifest of the GUID, mailbox, size, flags and date of each. An email
+    is written to its own file and synced to disk before it is added to
+    the manifest, and is only removed once the server has accepted it, so
+    nothing is lost or rendered again if either side is interrupted. The
+    manifest keeps the GUIDs of delivered emails, so that messages are not
+    queued twice. UIDs of emails already on the server that are to be
+    flagged \\Seen are queued too. The directory can be copied to another
+    host to be drained there."""
+    manifest = 'manifest.db'
+
+    def __init__(self, path = None, config = None):
+        if(not path):
+            path = config.get('outbox', 'path', fallback=default_outbox) \
+                if config else default_outbox
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.path, self.manifest),
+            timeout=60, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS email ('
+            'id INTEGER PRIMARY KEY, guid TEXT UNIQUE, mailbox TEXT, filename TEXT, '
+            'size INTEGER, seen INTEGER, date REAL, queued REAL, delivered REAL, '
+            'attempts INTEGER DEFAULT 0, error TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS email_mailbox ON email (mailbox)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen_update ('
+            'account TEXT, mailbox TEXT, uidvalidity INTEGER, uid INTEGER, '
+            'PRIMARY KEY (account, mailbox, uidvalidity, uid)) WITHOUT ROWID')
+        self._db.commit()
+
+    def email_filename(self, guid):
+        digest = hashlib.sha1(guid.encode()).hexdigest()
+        return os.path.join(digest[0:2], digest + '.eml')
+
+    def write_file(self, filename, data):
+        """Write the file so that it is complete on disk, or not there"""
+        fn = os.path.join(self.path, filename)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn + '.tmp', 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(fn + '.tmp', fn)
+        fd = os.open(os.path.dirname(fn), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def put(self, mailbox, email_str, date, seen, guid):
+        filename = self.email_filename(guid)
+        self.write_file(filename, email_str)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO email (guid, mailbox, filename, '
+                'size, seen, date, queued) VALUES (?,?,?,?,?,?,?)', (guid, mailbox,
+                    filename, len(email_str), int(bool(seen)), date, time.time()))
+            self._db.commit()
+
+    def read(self, filename):
+        with open(os.path.join(self.path, filename), 'rb') as fp:
+            return fp.read()
+
+    def pending(self):
+        """List of (id, guid, mailbox, filename, seen, date) of the queued
+        emails, in the order they were queued"""
+        with self._lock:
+            return self._db.execute('SELECT id, guid, mailbox, filename, seen, date '
+                'FROM email WHERE delivered IS NULL ORDER BY id').fetchall()
+
+    def mark_delivered(self, id, filename):
+        with self._lock:
+            self._db.execute('UPDATE email SET delivered=? WHERE id=?', (time.time(), id))
+            self._db.commit()
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except FileNotFoundError:
+            pass
+
+    def mark_failed(self, id, error):
+        with self._lock:
+            self._db.execute('UPDATE email SET attempts=attempts+1, error=? WHERE id=?',
+                (str(error), id))
+            self._db.commit()
+
+    def guids(self, mailbox):
+        """GUIDSet of the emails queued for or delivered to the mailbox"""
+        with self._lock:
+            return guid_set.GUIDSet(guid for guid, in self._db.execute(
+                'SELECT guid FROM email WHERE mailbox=?', (mailbox,)))
+
+    def mailboxes(self):
+        with self._lock:
+            return [ m for m, in self._db.execute('SELECT DISTINCT mailbox FROM email '
+                'ORDER BY mailbox') ]
+
+    def last_date(self, mailbox):
+        with self._lock:
+            return self._db.execute('SELECT MAX(date) FROM email WHERE mailbox=?',
+                (mailbox,)).fetchone()[0] or 0
+
+    def put_seen(self, account, mailbox, uidvalidity, uids):
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO seen_update VALUES (?,?,?,?)',
+                ((account, mailbox, uidvalidity, uid) for uid in uids))
+            self._db.commit()
+
+    def pending_seen(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM seen_update').fetchone()[0]
+
+    def drain_seen(self, backend):
+        """Flag as \\Seen the queued UIDs of the backend's account, returning
+        the number flagged. Updates for UIDs whose mailbox has since changed
+        UIDVALIDITY are dropped, as the backend ignores them."""
+        account = getattr(backend, 'account', None)
+        with self._lock:
+            rows = self._db.execute('SELECT mailbox, uidvalidity, uid FROM seen_update '
+                'WHERE account=? ORDER BY mailbox, uidvalidity, uid', (account,)).fetchall()
+        targets = dict()
+        for mailbox, uidvalidity, uid in rows:
+            targets.setdefault((mailbox, uidvalidity), []).append(uid)
+        nflagged = 0
+        for (mailbox, uidvalidity), uids in targets.items():
+            nflagged += backend.update_seen(mailbox, uidvalidity, uids)
+            with self._lock:
+                self._db.execute('DELETE FROM seen_update WHERE account=? AND mailbox=? '
+                    'AND uidvalidity=?', (account, mailbox, uidvalidity))
+                self._db.commit()
+        return nflagged
+
+    def status(self):
+        """Number and total size of the queued emails, and number delivered"""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) - COUNT(delivered), '
+                'IFNULL(SUM(CASE WHEN delivered IS NULL THEN size END), 0), '
+                'COUNT(delivered) FROM email').fetchone()
+
+    def drain(self, backend, verbose = False):
+        """Append the queued emails to the backend in the order they were
+        queued, returning the numbers delivered, found to be on the server
+        already, and refused. Emails already in their mailbox, uploaded from
+        elsewhere, are not sent again. A refused email stays queued with the
+        error recorded, and an exception, such as a lost connection, stops
+        the drain with the email being sent and those after it queued. The
+        emails for a mailbox whose GUIDs cannot be fetched stay queued, as
+        they might otherwise be uploaded twice."""
+        ndelivered = 0
+        nskipped = 0
+        nfailed = 0
+        on_server = dict()
+        for id, guid, mailbox, filename, seen, date in self.pending():
+            if(mailbox not in on_server):
+                backend.create_mailbox(mailbox)
+                on_server[mailbox] = backend.fetch_guids(mailbox)
+                if(on_server[mailbox] is None):
+                    print('Cannot list the messages in %s, leaving them queued'%mailbox)
+            if(on_server[mailbox] is None):
+                continue
+            if(guid in on_server[mailbox]):
+                self.mark_delivered(id, filename)
+                nskipped += 1
+                continue
+            email_str = self.read(filename)
+            if(verbose):
+                print('Uploading %s to %s, size: %d'%(guid, mailbox, len(email_str)))
+            good, status = backend.append(mailbox, email_str, date, seen, guid)
+            if(good):
+                self.mark_delivered(id, filename)
+                ndelivered += 1
+            else:
+                self.mark_failed(id, status)
+                nfailed += 1
+        return ndelivered, nskipped, nfailed
+
+    def close(self):
+        self._db.close()
+
+class OutboxBackend(storage_backend.StorageBackend):
+    """Backend that queues the rendered emails in an Outbox rather than
+    uploading them, so that a sync needs no connection to the server.
+    Messages are deduplicated against those ever queued in the outbox and,
+    given a uid_index, those it records as on the server for the account."""
+
+    def __init__(self, outbox, verbose=False, separator='/', uid_index=None,
+            account=None):
+        self.outbox = outbox
+        self.verbose = verbose
+        self.separator = separator
+        self.uid_index = uid_index
+        self.account = account
+
+    def open_mailbox(self, mailbox):
+        return True
+
+    def create_mailbox(self, mailbox):
+        pass
+
+    def list_mailboxes(self, parent):
+        prefix = parent + self.separator
+        mailboxes = set(self.outbox.mailboxes())
+        if(self.uid_index is not None):
+            mailboxes.update(self.uid_index.mailboxes(self.account))
+        return sorted(m for m in mailboxes if m.startswith(prefix))
+
+    def append(self, mailbox, email_str, date, seen, guid):
+        self.outbox.put(mailbox, email_str, date, seen, guid)
+        return True, 'OK'
+
+    def fetch_guids(self, mailbox):
+        guids = self.outbox.guids(mailbox)
+        if(self.uid_index is not None):
+            guids.update(self.uid_index.guids(self.account, mailbox))
+        return guids
+
+    def fetch_guids_since(self, mailbox, start_date):
+        return self.fetch_guids(mailbox)
+
+    def update_seen(self, mailbox, uidvalidity, uids):
+        """Queue the UIDs to be flagged \\Seen when the outbox is drained"""
+        self.outbox.put_seen(self.account, mailbox, uidvalidity, uids)
+        return len(uids)
+
+    def last_message_time(self, mailbox):
+        return self.outbox.last_date(mailbox)
+
+    def location(self):
+        return 'outbox:' + os.path.abspath(self.outbox.path)
+
+    def close(self):
+        self.outbox.close()
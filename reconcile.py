@@ -0,0 +1,161 @@
+# reconcile.py - Compare the emails on the server with the local messages
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import itertools
+import sqlite3
+import tempfile
+import imessage_to_mime
+import uid_index
+
+class Reconciler:
+    """Compares the emails in the mailboxes of a sync with the messages in
+    the local databases. The GUIDs of both are written to a temporary
+    SQLite database as the server is scanned a block of UIDs at a time,
+    and read back sorted by GUID, so that they are compared by merging two
+    sorted streams and memory use does not grow with the mailbox. Finds
+    emails that are on the server more than once, emails with no local
+    message, fragments of local messages that are no longer part of how
+    the message is split, and local messages missing from the server."""
+    kinds = ('duplicate', 'server_only', 'stale_fragment', 'local_only')
+
+    def __init__(self, sync):
+        self.sync = sync
+        self.backend = sync.backend
+        fd, self._filename = tempfile.mkstemp(suffix='.db', prefix='imessage_reconcile_')
+        os.close(fd)
+        self._db = sqlite3.connect(self._filename)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE server (guid TEXT, message_guid TEXT, '
+            'mailbox TEXT, uidvalidity INTEGER, uid INTEGER)')
+        self._db.execute('CREATE TABLE local (guid TEXT, message_guid TEXT)')
+        self._db.execute('CREATE TABLE extra (mailbox TEXT, uidvalidity INTEGER, uid INTEGER)')
+        self.counts = dict((kind, 0) for kind in self.kinds)
+        self.nserver = 0
+        self.nlocal = 0
+
+    def close(self):
+        self._db.close()
+        os.remove(self._filename)
+
+    def add_local(self, messages):
+        """Add the GUIDs of the emails that the valid messages upload as"""
+        rows = ((guid, message['guid']) for message in messages.values()
+            if imessage_to_mime.is_valid(message)
+            for guid in imessage_to_mime.fragment_guids(message, self.sync.max_attach))
+        self._db.executemany('INSERT INTO local VALUES (?,?)', rows)
+        self._db.commit()
+        self.nlocal = self._db.execute('SELECT COUNT(*) FROM local').fetchone()[0]
+
+    def mailboxes(self):
+        if(self.sync.is_partitioned()):
+            return self.sync.list_partitions()
+        return [ self.sync.mailbox ]
+
+    def scan_server(self):
+        for mailbox in self.mailboxes():
+            status = self.backend.mailbox_status(mailbox)
+            if(status is None):
+                raise Exception('Cannot query mailbox: ' + mailbox)
+            print('Scanning %s'%mailbox,end='',flush=True)
+            for entries, last_uid in self.backend.scan_guids(mailbox, 1, status['UIDNEXT']):
+                self._db.executemany('INSERT INTO server VALUES (?,?,?,?,?)',
+                    ((guid, uid_index.message_guid(guid), mailbox, status['UIDVALIDITY'], uid)
+                        for uid, guid, seen in entries))
+                self.nserver += len(entries)
+                print('.',end='',flush=True)
+            print('',flush=True)
+        self._db.commit()
+
+    def merge(self):
+        """Generate (kind, guid, locations) for each discrepancy, where the
+        locations are the (mailbox, uidvalidity, uid) of the emails on the
+        server, in the order in which duplicates are kept"""
+        self._db.execute('CREATE INDEX local_guid ON local (guid)')
+        self._db.execute('CREATE INDEX local_message_guid ON local (message_guid)')
+        server = self._db.cursor().execute('SELECT guid, mailbox, uidvalidity, uid, '
+            'EXISTS (SELECT 1 FROM local WHERE local.message_guid = server.message_guid) '
+            'FROM server ORDER BY guid, mailbox, uid')
+        local = self._db.cursor().execute('SELECT DISTINCT guid FROM local ORDER BY guid')
+        local_guid = next(local, (None,))[0]
+        for guid, rows in itertools.groupby(server, key=lambda r: r[0]):
+            rows = list(rows)
+            while(local_guid is not None and local_guid < guid):
+                yield 'local_only', local_guid, []
+                local_guid = next(local, (None,))[0]
+            locations = [ r[1:4] for r in rows ]
+            if(local_guid == guid):
+                local_guid = next(local, (None,))[0]
+            elif(rows[0][4]):
+                yield 'stale_fragment', guid, locations
+            else:
+                yield 'server_only', guid, locations
+            if(len(rows) > 1):
+                yield 'duplicate', guid, locations
+        while(local_guid is not None):
+            yield 'local_only', local_guid, []
+            local_guid = next(local, (None,))[0]
+
+    def reconcile(self, report = None, verbose = False):
+        """Count the discrepancies, writing each to the report file as a
+        line of JSON if given, and note the extra copies of duplicates"""
+        fp = open(report, 'w') if report else None
+        try:
+            extra = []
+            for kind, guid, locations in self.merge():
+                self.counts[kind] += 1
+                if(kind == 'duplicate'):
+                    extra += locations[1:]
+                    if(len(extra) >= 10000):
+                        self._db.executemany('INSERT INTO extra VALUES (?,?,?)', extra)
+                        extra = []
+                if(fp):
+                    fp.write(json.dumps(dict(kind = kind, guid = guid,
+                        locations = locations)) + '\n')
+                if(verbose):
+                    print('%-15s %s %s'%(kind, guid, ' '.join('%s:%d'%(l[0], l[2])
+                        for l in locations)))
+            self._db.executemany('INSERT INTO extra VALUES (?,?,?)', extra)
+            self._db.commit()
+        finally:
+            if(fp):
+                fp.close()
+
+    def delete_duplicates(self):
+        """Delete the extra copies of duplicated emails, keeping the one
+        with the lowest UID in the first mailbox, returning the number
+        deleted"""
+        ndeleted = 0
+        query = self._db.cursor().execute('SELECT mailbox, uidvalidity, uid '
+            'FROM extra ORDER BY mailbox, uidvalidity, uid')
+        for (mailbox, uidvalidity), rows in itertools.groupby(query, key=lambda r: r[0:2]):
+            for block in iter(lambda: [ r[2] for r in itertools.islice(rows,
+                    self.backend.block_size) ], []):
+                ndeleted += self.backend.delete_uids(mailbox, uidvalidity, block)
+        return ndeleted
+
+    def print_summary(self):
+        print('Server emails: %d, local emails: %d'%(self.nserver, self.nlocal))
+        print('  duplicated on server  : %d'%self.counts['duplicate'])
+        print('  only on server        : %d'%self.counts['server_only'])
+        print('  stale fragments       : %d'%self.counts['stale_fragment'])
+        print('  only in local db(s)   : %d'%self.counts['local_only'])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import argparse
+import imessage_sync
+import imessage_sync_config
+import imessage_db_reader
+import backup_index_cache
+import reconcile
+import uid_index
+
+parser = argparse.ArgumentParser(description='Compare the iMessages on the IMAP server with '
+    'those in the iMessage database(s), finding duplicated, orphaned and missing uploads.')
+
+parser.add_argument('-v', '--verbose', dest='verbose', action='store_const',
+                    default=False, const=True,
+                    help='print each discrepancy found')
+parser.add_argument('--db', dest='db', action='append', default=None,
+                    help='specify iMessage database(s) to use')
+parser.add_argument('--partition', dest='partition', action='store',
+                    choices=['none','year','month'], default=None,
+                    help='mailbox partitioning used when the messages were uploaded')
+parser.add_argument('--index_cache', dest='index_cache', action='store',
+                    choices=['use','rebuild','off'], default='use',
+                    help='use, rebuild or do not use the on-disk cache of iPhone backup indexes')
+parser.add_argument('--report', dest='report', action='store', default=None,
+                    help='write each discrepancy to the given file as JSON lines')
+parser.add_argument('--delete_duplicates', dest='delete_duplicates', action='store_const',
+                    default=False, const=True,
+                    help='delete all but one copy of each message uploaded more than once')
+
+args = parser.parse_args()
+
+config = imessage_sync_config.get_config()
+index_cache = None
+if(args.index_cache != 'off'):
+    index_cache = backup_index_cache.BackupIndexCache(config=config,
+        rebuild=(args.index_cache == 'rebuild'))
+
+backend = imessage_sync.open_imap_backend(config, args.verbose,
+    uid_index=uid_index.UIDIndex(config=config))
+if(args.delete_duplicates and not backend.has_capability('UIDPLUS')):
+    print('The server does not support UIDPLUS, so duplicates cannot be deleted safely')
+    backend.close()
+    raise SystemExit(1)
+
+x = imessage_sync.get_all_messages(finder_or_base_path=args.db, index_cache=index_cache,
+    message_filter=imessage_db_reader.MessageFilter.from_config(config))
+sync = imessage_sync.IMessageSync(backend, None, config=config, verbose=args.verbose,
+    partition=args.partition)
+
+r = reconcile.Reconciler(sync)
+try:
+    r.add_local(x)
+    r.scan_server()
+    r.reconcile(report=args.report, verbose=args.verbose)
+    r.print_summary()
+    if(args.delete_duplicates and r.counts['duplicate']):
+        print('Deleted %d duplicate emails'%r.delete_duplicates())
+finally:
+    r.close()
+    backend.close()
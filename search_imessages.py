@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import time
+import imessage_sync
+import imessage_sync_config
+import imessage_to_mime
+import backup_index_cache
+import search_index
+import addressbook
+
+parser = argparse.ArgumentParser(description='Search the local index of synced iMessages.')
+
+parser.add_argument('query', nargs='*',
+                    help='words to search for, in SQLite FTS5 query syntax, '
+                    'e.g. dinner, "see you", chat:alice or sender:bob')
+parser.add_argument('--limit', dest='limit', action='store', type=int, default=50,
+                    help='maximum number of messages to print')
+parser.add_argument('--since', dest='since', action='store', default=None,
+                    help='only messages sent since given date. Specify as YYYY-MM-DD')
+parser.add_argument('--until', dest='until', action='store', default=None,
+                    help='only messages sent before given date. Specify as YYYY-MM-DD')
+parser.add_argument('--guid', dest='guid', action='append', default=None,
+                    help='print whether the message with the given GUID has been synced')
+parser.add_argument('--update', dest='update', action='store_const',
+                    default=False, const=True,
+                    help='add all messages in the iMessage database(s) to the index, '
+                    'without marking them as synced')
+parser.add_argument('--db', dest='db', action='append', default=None,
+                    help='specify iMessage database(s) to use with --update')
+
+args = parser.parse_args()
+
+config = imessage_sync_config.get_config()
+index = search_index.SearchIndex(config=config)
+
+if(args.update):
+    x = imessage_sync.get_all_messages(finder_or_base_path=args.db,
+        index_cache=backup_index_cache.BackupIndexCache(config=config))
+    sync = imessage_sync.IMessageSync(None, addressbook.AddressBook(config=config),
+        config=config, search_index=index)
+    for m in x.values():
+        if(imessage_to_mime.is_valid(m)):
+            sync.index_message(m, synced=False)
+    index.commit()
+    nindexed, nsynced = index.count()
+    print('Index holds %d messages, %d of them synced'%(nindexed, nsynced))
+
+for guid in args.guid or []:
+    print(guid, 'synced' if index.has_guid(guid) else 'not synced')
+
+if(args.query):
+    parse_date = lambda d: d and datetime.datetime.strptime(d, '%Y-%m-%d').timestamp()
+    start = time.time()
+    matches = index.search(' '.join(args.query), limit=args.limit,
+        since=parse_date(args.since), until=parse_date(args.until))
+    for guid, date, chat, sender, snippet in matches:
+        print('%s  %-30s %-20s %s'%(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(date or 0)),
+            (chat or '')[0:30], (sender or '')[0:20], snippet))
+    print('%d matches in %.1f ms'%(len(matches), (time.time()-start)*1000))
@@ -0,0 +1,113 @@
+# search_index.py - Local full-text index of synced messages
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import sqlite3
+import threading
+
+default_search_db = '~/.imessage_sync_search.db'
+
+class SearchIndex:
+    """SQLite FTS5 index of the text, chat name, participants and sender of
+    each message, keyed by GUID. Messages are added as the sync processes
+    them, whether uploaded or found to be on the server already, so the
+    index also answers whether a GUID has been synced without asking the
+    server. Messages added only for searching are not marked as synced."""
+    commit_every = 1000
+
+    def __init__(self, filename = None, config = None):
+        if(not filename):
+            filename = config.get('cache', 'search_db', fallback=default_search_db) \
+                if config else default_search_db
+        self._filename = os.path.expanduser(filename)
+        self._lock = threading.Lock()
+        self._nuncommitted = 0
+        self._db = sqlite3.connect(self._filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS message ('
+            'id INTEGER PRIMARY KEY, guid TEXT UNIQUE, date REAL, text TEXT, '
+            'chat TEXT, participants TEXT, sender TEXT, service TEXT, '
+            'mailbox TEXT, synced REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS message_date ON message (date)')
+        self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5('
+            'text, chat, participants, sender, '
+            'content=message, content_rowid=id, tokenize=\'unicode61 remove_diacritics 2\')')
+        self._db.commit()
+
+    def add(self, message, chat = None, sender = None, mailbox = None, synced = True):
+        """Add a message, given the names of its chat and sender, or mark it
+        as synced if it is already in the index"""
+        participants = ' '.join(h['contact'] for h in message['chat']['handles']) \
+            if message.get('chat') else None
+        synced = time.time() if synced else None
+        with self._lock:
+            cursor = self._db.execute('INSERT OR IGNORE INTO message (guid, date, '
+                'text, chat, participants, sender, service, mailbox, synced) '
+                'VALUES (?,?,?,?,?,?,?,?,?)', (message['guid'], message['date'],
+                    message['text'], chat, participants, sender, message['service'],
+                    mailbox, synced))
+            if(cursor.rowcount == 1):
+                self._db.execute('INSERT INTO message_fts (rowid, text, chat, '
+                    'participants, sender) VALUES (?,?,?,?,?)', (cursor.lastrowid,
+                        message['text'], chat, participants, sender))
+            elif(synced):
+                self._db.execute('UPDATE message SET synced=?, mailbox=IFNULL(?, mailbox) '
+                    'WHERE guid=? AND synced IS NULL', (synced, mailbox, message['guid']))
+            self._nuncommitted += 1
+            if(self._nuncommitted >= self.commit_every):
+                self._db.commit()
+                self._nuncommitted = 0
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._nuncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def has_guid(self, guid):
+        """True if the message with the GUID has been synced"""
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM message WHERE guid=? AND '
+                'synced IS NOT NULL', (guid,)).fetchone() is not None
+
+    def search(self, query, limit = 50, since = None, until = None):
+        """Return (guid, date, chat, sender, snippet) of the messages best
+        matching the FTS5 query, most relevant first"""
+        where = [ 'message_fts MATCH ?' ]
+        args = [ query ]
+        if(since is not None):
+            where.append('m.date >= ?')
+            args.append(since)
+        if(until is not None):
+            where.append('m.date <= ?')
+            args.append(until)
+        with self._lock:
+            return self._db.execute('SELECT m.guid, m.date, m.chat, m.sender, '
+                'snippet(message_fts, -1, \'[\', \']\', \'...\', 12) '
+                'FROM message_fts JOIN message m ON m.id = message_fts.rowid '
+                'WHERE ' + ' AND '.join(where) + ' ORDER BY bm25(message_fts) '
+                'LIMIT ?', args + [ limit ]).fetchall()
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*), COUNT(synced) FROM message').fetchone()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import argparse
+import imessage_stats
+import imessage_sync_config
+import backup_index_cache
+import addressbook
+
+parser = argparse.ArgumentParser(description='Print counts of iMessages per chat, contact, service and month.')
+
+parser.add_argument('--db', dest='db', action='append', default=None,
+                    help='specify iMessage database(s) to use')
+parser.add_argument('--by', dest='by', action='append', default=None,
+                    choices=['chat','handle','service','month'],
+                    help='tables to print, by default all of them')
+parser.add_argument('--no_names', dest='names', action='store_const',
+                    default=True, const=False,
+                    help='identify chats by contacts rather than address book names')
+parser.add_argument('--index_cache', dest='index_cache', action='store',
+                    choices=['use','rebuild','off'], default='use',
+                    help='use, rebuild or do not use the on-disk cache of iPhone backup indexes')
+
+args = parser.parse_args()
+
+config = imessage_sync_config.get_config()
+index_cache = None
+if(args.index_cache != 'off'):
+    index_cache = backup_index_cache.BackupIndexCache(config=config,
+        rebuild=(args.index_cache == 'rebuild'))
+a = addressbook.AddressBook(config=config) if args.names else None
+
+stats = imessage_stats.IMessageStats(finder_or_base_path=args.db,
+    index_cache=index_cache, addressbook=a)
+
+tables = dict(chat=('Chat', stats.by_chat), handle=('Contact', stats.by_handle),
+    service=('Service', stats.by_service), month=('Month', stats.by_month))
+for by in args.by or ['chat','handle','service','month']:
+    title, rows = tables[by]
+    imessage_stats.print_table(title, rows())
+    print()
+nmessage, nattachment, nbytes = stats.totals()
+print('Total: %d messages, %d attachments, %d bytes'%(nmessage, nattachment or 0, nbytes or 0))
@@ -0,0 +1,792 @@
+# storage_backend.py - Where synchronised messages are stored : IMAP or local
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import time
+import calendar
+import email.utils
+import imessage_to_mime
+import guid_set
+import upload_throttle
+
+mboxrd_from_re = re.compile(rb'^(>*From )', re.MULTILINE)
+appenduid_re = re.compile(r'\[APPENDUID (\d+) (\d+)\]')
+
+def uid_sets(uids, block_size):
+    """Split the UIDs into blocks of at most block_size, yielding each as an
+    IMAP sequence set of ranges, such as '3:7,9', and the list of UIDs"""
+    uids = sorted(set(uids))
+    for start in range(0, len(uids), block_size):
+        block = uids[start:start+block_size]
+        ranges = []
+        first = last = block[0]
+        for uid in block[1:]:
+            if(uid != last+1):
+                ranges.append('%d'%first if first==last else '%d:%d'%(first,last))
+                first = uid
+            last = uid
+        ranges.append('%d'%first if first==last else '%d:%d'%(first,last))
+        yield ','.join(ranges), block
+
+class StorageBackend:
+    """Interface between IMessageSync and the store holding the messages.
+    Mailboxes are named by strings using '/' or the configured separator
+    to denote hierarchy."""
+    separator = '/'
+
+    def open_mailbox(self, mailbox):
+        """Create the mailbox if needed and prepare it for use"""
+        raise NotImplementedError
+
+    def create_mailbox(self, mailbox):
+        raise NotImplementedError
+
+    def list_mailboxes(self, parent):
+        """Return the sorted names of the mailboxes directly below parent"""
+        raise NotImplementedError
+
+    def append(self, mailbox, email_str, date, seen, guid):
+        """Store one message, returning True and a status if it succeeded"""
+        raise NotImplementedError
+
+    def fetch_guids(self, mailbox):
+        """Return the GUIDs of all messages in the mailbox"""
+        raise NotImplementedError
+
+    def fetch_guids_since(self, mailbox, start_date):
+        """Return the GUIDs of messages sent since start_date, possibly
+        including some sent before it"""
+        raise NotImplementedError
+
+    def last_message_time(self, mailbox):
+        """Return the latest date of the messages in the mailbox, or 0"""
+        raise NotImplementedError
+
+    def fetch_header(self, mailbox, guid, header):
+        """Return the value of a header of the message with the GUID, or
+        None if it, or the message, cannot be found"""
+        return None
+
+    def update_seen(self, mailbox, uidvalidity, uids):
+        """Flag the messages with the given UIDs as \\Seen, returning the
+        number flagged"""
+        return 0
+
+    def location(self):
+        """Name of the store, identifying it across runs"""
+        return type(self).__name__
+
+    def close(self):
+        pass
+
+class IMAPBackend(StorageBackend):
+    """Messages stored on an IMAP server. APPENDs are paced by the throttle,
+    if one is given, and retried when the server asks us to slow down or
+    drops the connection, in which case reconnect is called for a new one.
+    With a uid_index, the UIDs that the server reports for appended messages
+    are recorded in it under the name of the account, and the GUIDs in a
+    mailbox are looked up in it after fetching those of the emails that
+    arrived since the mailbox was last scanned."""
+
+    def __init__(self, connection, verbose=False, separator='/', block_size=1000,
+            throttle=None, reconnect=None, uid_index=None, account=None):
+        self.connection   = connection
+        self.throttle     = throttle
+        self.reconnect    = reconnect
+        self.uid_index    = uid_index
+        self.account      = account
+        self.verbose      = verbose
+        self.separator    = separator
+        self.block_size   = block_size
+        self.mailbox_size = None
+        self.mailbox_sizes = dict()
+        self.selected_mailbox = None
+        self.created_mailboxes = set()
+        self.capabilities = None
+
+    def open_mailbox(self, mailbox):
+        return self.select_mailbox(mailbox, create=True)
+
+    def list_mailboxes(self, parent):
+        resp, data = self.connection.list('""', '"' + parent + self.separator + '%"')
+        if(resp != 'OK'):
+            return []
+        mailboxes = []
+        for line in data:
+            if(not line):
+                continue
+            if(type(line) == tuple):
+                line = line[-1]
+            mailbox = re.match(r'^\(.*\) (?:"[^"]*"|NIL) "?([^"]*)"?$', line.decode())
+            if(mailbox):
+                mailboxes.append(mailbox.groups()[0])
+        return sorted(mailboxes)
+
+    def get_mailbox_size(self, mailbox=None):
+        mailbox = mailbox or self.selected_mailbox
+        resp, data = self.connection.status(mailbox,'(MESSAGES)')
+        if(resp != 'OK'):
+            return None
+        mb, el, n = re.match(r'"(.*)" \((.*) (.*)\)',data[0].decode()).groups()
+        self.mailbox_sizes[mailbox] = int(n)
+        if(mailbox == self.selected_mailbox):
+            self.mailbox_size = int(n)
+        return int(n)
+
+    def create_mailbox(self, mailbox):
+        if(mailbox not in self.created_mailboxes):
+            resp, data = self.connection.create(mailbox)
+            self.created_mailboxes.add(mailbox)
+
+    def select_mailbox(self, mailbox, create=False):
+        if(mailbox == self.selected_mailbox):
+            return True
+        if(create):
+            self.create_mailbox(mailbox)
+        resp, data = self.connection.select(mailbox)
+        if(resp != 'OK'):
+            print(data[0].decode())
+            return False
+        self.selected_mailbox = mailbox
+        self.mailbox_size = int(data[0].decode())
+        self.mailbox_sizes[mailbox] = self.mailbox_size
+        return True
+
+    def append(self, mailbox, email_str, date, seen, guid):
+        import imaplib
+        attempt = 0
+        while(True):
+            if(self.throttle):
+                self.throttle.wait(len(email_str))
+                start = self.throttle.clock()
+            try:
+                resp, data = self.connection.append(mailbox,
+                    '(\\Seen)' if seen else None,
+                    imaplib.Time2Internaldate(date), email_str)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if(not self.throttle or not self.reconnect or
+                        not self.throttle.failed('connection lost (%s)'%e, attempt)):
+                    raise
+                self.reopen()
+                attempt += 1
+                # The server may have stored the message before the
+                # connection dropped, in which case sending it again would
+                # duplicate it
+                found = self.find_guid(mailbox, guid)
+                if(found):
+                    print('Message %s was stored before the connection was lost'%guid)
+                    uidvalidity = self.uidvalidity(mailbox)
+                    if(self.uid_index is not None and uidvalidity is not None):
+                        self.uid_index.add(self.account, mailbox, uidvalidity,
+                            found[0][0], guid, seen)
+                    return True, 'OK'
+                continue
+            if self.verbose:
+                print('  ',resp,data)
+            if(resp == 'OK'):
+                if(self.throttle):
+                    self.throttle.succeeded(self.throttle.clock() - start,
+                        len(email_str))
+                break
+            code = upload_throttle.throttle_code(data)
+            if(code is None or not self.throttle or
+                    not self.throttle.failed('server replied [%s]'%code, attempt)):
+                print('Upload failed:', resp, data[0].decode(errors='replace') \
+                    if data and isinstance(data[0], bytes) else data)
+                break
+            attempt += 1
+        if(resp == 'OK'):
+            if(mailbox in self.mailbox_sizes):
+                self.mailbox_sizes[mailbox] += 1
+            if(mailbox == self.selected_mailbox):
+                self.mailbox_size += 1
+            appenduid = self.uid_index is not None and data and data[0] and \
+                appenduid_re.search(data[0].decode(errors='replace'))
+            if(appenduid):
+                self.uid_index.add(self.account, mailbox, int(appenduid.group(1)),
+                    int(appenduid.group(2)), guid, seen)
+        return resp == 'OK', resp
+
+    def has_capability(self, capability):
+        """True if the server advertises the capability. Servers often list
+        more capabilities once logged in than in their greeting, so they
+        are asked again."""
+        if(self.capabilities is None):
+            resp, data = self.connection.capability()
+            if(resp == 'OK' and data and data[0]):
+                self.capabilities = set(data[0].decode().upper().split())
+            else:
+                self.capabilities = set(getattr(self.connection, 'capabilities', ()))
+        return capability in self.capabilities
+
+    def uidvalidity(self, mailbox):
+        resp, data = self.connection.status(mailbox, '(UIDVALIDITY)')
+        if(resp != 'OK'):
+            return None
+        m = re.search(r'UIDVALIDITY (\d+)', data[0].decode())
+        return m and int(m.group(1))
+
+    def update_seen(self, mailbox, uidvalidity, uids):
+        """Flag the messages with the given UIDs as \\Seen, without fetching
+        or uploading them, returning the number flagged. Nothing is done,
+        and the index is left alone, if the UIDVALIDITY cannot be read."""
+        current = self.uidvalidity(mailbox)
+        if(current is None):
+            return 0
+        if(current != uidvalidity):
+            # The mailbox was recreated, so the UIDs no longer name our messages
+            if(self.uid_index is not None):
+                self.uid_index.forget_mailbox(self.account, mailbox, current)
+            return 0
+        if(not self.select_mailbox(mailbox)):
+            return 0
+        nflagged = 0
+        for qrange, quids in uid_sets(uids, self.block_size):
+            resp, data = self.connection.uid('STORE', qrange, '+FLAGS.SILENT', '(\\Seen)')
+            if(resp != 'OK'):
+                print('Flag update failed:', resp, data)
+                continue
+            if(self.uid_index is not None):
+                self.uid_index.mark_seen(self.account, mailbox, uidvalidity, quids)
+            nflagged += len(quids)
+        return nflagged
+
+    def find_guid(self, mailbox, guid, headers = ()):
+        """List of (uid, headers) of the emails in the mailbox with the GUID,
+        found with UID SEARCH HEADER, where headers is a dictionary of the
+        values of the named headers. Returns None if the search fails."""
+        import email.parser
+        if(not self.select_mailbox(mailbox)):
+            return None
+        resp, data = self.connection.uid('SEARCH', 'HEADER',
+            imessage_to_mime.Xheader_guid, '"%s"'%guid)
+        if(resp != 'OK'):
+            return None
+        uids = (data[0] or b'').decode().split()
+        if(not uids):
+            return []
+        # SEARCH HEADER matches substrings, so the GUID of the first email of
+        # a message also finds its fragments
+        resp, data = self.connection.uid('FETCH', ','.join(uids),
+            '(UID BODY.PEEK[HEADER.FIELDS (%s)])'%' '.join(
+                (imessage_to_mime.Xheader_guid,) + tuple(headers)))
+        if(resp != 'OK'):
+            return None
+        found = []
+        parser = email.parser.BytesHeaderParser()
+        for line in data:
+            if(type(line) == tuple):
+                uid = re.search(r'UID (\d+)', line[0].decode())
+                fields = parser.parsebytes(line[1])
+                if(uid and (fields.get(imessage_to_mime.Xheader_guid) or '').strip() == guid):
+                    found.append((int(uid.group(1)), dict((h, fields[h] and fields[h].strip())
+                        for h in headers)))
+        return found
+
+    def fetch_header(self, mailbox, guid, header):
+        found = self.find_guid(mailbox, guid, (header,))
+        return found[0][1][header] if found else None
+
+    def mailbox_status(self, mailbox):
+        """Dictionary of the MESSAGES, UIDNEXT and UIDVALIDITY of the
+        mailbox, or None if it cannot be queried"""
+        resp, data = self.connection.status(mailbox, '(MESSAGES UIDNEXT UIDVALIDITY)')
+        if(resp != 'OK'):
+            return None
+        return dict((k, int(v)) for k, v in re.findall(
+            r'(MESSAGES|UIDNEXT|UIDVALIDITY) (\d+)', data[0].decode()))
+
+    def search_uids(self, mailbox):
+        """Sorted list of the UIDs of all emails in the mailbox, from UID
+        SEARCH ALL. Raises an exception if the search fails."""
+        if(not self.select_mailbox(mailbox)):
+            raise Exception('Cannot select mailbox: ' + mailbox)
+        resp, data = self.connection.uid('SEARCH', 'ALL')
+        if(resp != 'OK'):
+            raise Exception('UID SEARCH failed: %s %s'%(resp, data[0].decode()))
+        return sorted(int(uid) for uid in (data[0] or b'').split())
+
+    def fetch_guid_entries(self, qrange, by_uid = True):
+        """List of (uid, guid, seen) of the emails in the selected mailbox
+        with UIDs, or sequence numbers if not by_uid, in qrange. Raises an
+        exception if the fetch fails."""
+        qfilter = '(UID FLAGS BODY.PEEK[HEADER.FIELDS (%s)])'%imessage_to_mime.Xheader_guid
+        if(by_uid):
+            resp, data = self.connection.uid('FETCH', qrange, qfilter)
+        else:
+            resp, data = self.connection.fetch(qrange, qfilter)
+        if(resp != 'OK'):
+            raise Exception('%s failed: %s %s'%('UID FETCH' if by_uid else 'FETCH',
+                resp, data[0].decode()))
+        entries = []
+        for line in data:
+            if(type(line) == tuple):
+                uid = re.search(r'UID (\d+)', line[0].decode())
+                guid = re.match(r'^.*:\s+([^\s]*)\s*$',line[1].decode())
+                if(uid and guid):
+                    entries.append((int(uid.group(1)), guid.groups()[0],
+                        re.search(r'FLAGS \([^)]*\\Seen', line[0].decode()) is not None))
+        return entries
+
+    def scan_guids(self, mailbox, first_uid, uidnext):
+        """Generate, a block at a time, lists of (uid, guid, seen) of the
+        emails with UIDs from first_uid up to uidnext, so that only one
+        block is held in memory. Each list is followed by the last UID it
+        covers. Blocks are fetched by message sequence number, which unlike
+        UIDs has no gaps, so no fetch comes back empty, and a final UID
+        FETCH picks up any emails that arrived since the mailbox was
+        selected. Raises an exception if a fetch fails."""
+        if(not self.select_mailbox(mailbox)):
+            raise Exception('Cannot select mailbox: ' + mailbox)
+        last_uid = first_uid - 1
+        for first in range(1, self.mailbox_size + 1, self.block_size):
+            last = min(first + self.block_size - 1, self.mailbox_size)
+            entries = [ e for e in self.fetch_guid_entries('%d:%d'%(first, last),
+                by_uid=False) if first_uid <= e[0] < uidnext ]
+            last_uid = max([ last_uid ] + [ e[0] for e in entries ])
+            yield entries, last_uid
+        if(last_uid + 1 < uidnext):
+            # n:* always includes the highest UID, even if below n
+            entries = [ e for e in self.fetch_guid_entries('%d:*'%(last_uid + 1))
+                if last_uid < e[0] < uidnext ]
+            if(entries):
+                yield entries, max(e[0] for e in entries)
+
+    def fetch_indexed_guids(self, mailbox):
+        """Return the GUIDs in the mailbox from the uid_index, first fetching
+        with UID FETCH last+1:* the GUID headers of the emails with UIDs
+        above the last one scanned. The whole mailbox is scanned if its
+        UIDVALIDITY has changed. If the number of emails indexed then
+        differs from the number in the mailbox, some may have been removed,
+        and the UIDs no longer listed by UID SEARCH ALL are dropped from
+        the index. Emails without a GUID header are not indexed, so in a
+        mailbox holding any that search is made every time."""
+        status = self.mailbox_status(mailbox)
+        if(status is None):
+            return None
+        uidvalidity = status['UIDVALIDITY']
+        last_uid = self.uid_index.last_uid(self.account, mailbox, uidvalidity)
+        try:
+            if(last_uid is None):
+                self.uid_index.forget_mailbox(self.account, mailbox)
+                print('Querying previously uploaded messages',end='',flush=True)
+                for entries, scan_uid in self.scan_guids(mailbox, 1, status['UIDNEXT']):
+                    self.uid_index.add_scanned(self.account, mailbox, uidvalidity,
+                        entries, scan_uid)
+                    print('.',end='',flush=True)
+                self.uid_index.add_scanned(self.account, mailbox, uidvalidity, [],
+                    status['UIDNEXT'] - 1)
+                print('',flush=True)
+            elif(status['UIDNEXT'] > last_uid + 1):
+                print('Querying messages uploaded since UID %d'%last_uid,flush=True)
+                if(not self.select_mailbox(mailbox)):
+                    raise Exception('Cannot select mailbox: ' + mailbox)
+                # n:* always includes the highest UID, even if below n
+                entries = [ e for e in self.fetch_guid_entries('%d:*'%(last_uid + 1))
+                    if e[0] > last_uid ]
+                self.uid_index.add_scanned(self.account, mailbox, uidvalidity, entries,
+                    max([ status['UIDNEXT'] - 1 ] + [ e[0] for e in entries ]))
+            if(self.uid_index.count(self.account, mailbox, uidvalidity) !=
+                    status['MESSAGES']):
+                present = set(self.search_uids(mailbox))
+                removed = [ uid for uid in self.uid_index.uids(self.account, mailbox,
+                    uidvalidity) if uid not in present ]
+                if(removed):
+                    self.uid_index.remove(self.account, mailbox, uidvalidity, removed)
+        except Exception as e:
+            print('',flush=True)
+            print(e)
+            return None
+        return self.uid_index.guids(self.account, mailbox, uidvalidity)
+
+    def delete_uids(self, mailbox, uidvalidity, uids):
+        """Flag the emails with the given UIDs as \\Deleted and remove them
+        with UID EXPUNGE (RFC 4315), which leaves any other emails flagged
+        \\Deleted alone, returning the number removed. Without UIDPLUS the
+        emails could only be removed by a plain EXPUNGE, so nothing is done
+        and an exception is raised."""
+        if(not self.has_capability('UIDPLUS')):
+            raise Exception('The server does not support UIDPLUS, needed to delete emails')
+        if(self.uidvalidity(mailbox) != uidvalidity or not self.select_mailbox(mailbox)):
+            return 0
+        ndeleted = 0
+        for qrange, quids in uid_sets(uids, self.block_size):
+            resp, data = self.connection.uid('STORE', qrange, '+FLAGS.SILENT', '(\\Deleted)')
+            if(resp == 'OK'):
+                resp, data = self.connection.uid('EXPUNGE', qrange)
+            if(resp != 'OK'):
+                print('Delete failed:', resp, data)
+                continue
+            if(self.uid_index is not None):
+                self.uid_index.remove(self.account, mailbox, uidvalidity, quids)
+            ndeleted += len(quids)
+        self.mailbox_size -= ndeleted
+        self.mailbox_sizes[mailbox] = self.mailbox_size
+        return ndeleted
+
+    def fetch_guids(self, mailbox):
+        if(self.uid_index is not None):
+            return self.fetch_indexed_guids(mailbox)
+        if(not self.select_mailbox(mailbox)):
+            return None
+        block_size = self.block_size
+        i = 0
+        guids = guid_set.GUIDSet()
+        print("Querying previously uploaded messages",end='',flush=True)
+        while(True):
+            qrange = '%d:%d'%(i+1,i+block_size)
+            qfilter = 'BODY.PEEK[HEADER.FIELDS (%s)]'%imessage_to_mime.Xheader_guid
+            #print(qrange, qfilter)
+            resp, data = self.connection.fetch(qrange, qfilter)
+            #print (resp, len(data))
+            if(resp != 'OK'):
+                print(resp, data[0].decode())
+                return None
+            if(data == [None]):
+                break
+            for line in data:
+                if(type(line) == tuple):
+                    guid = re.match(r'^.*:\s+([^\s]*)\s*$',line[1].decode())
+                    if(guid):
+                        guids.add(guid.groups()[0])
+            print('.',end='',flush=True)
+            i += block_size
+        print('',flush=True)
+        return guids
+
+    def fetch_guids_since(self, mailbox, start_date):
+        if(self.uid_index is not None):
+            # The index holds the whole mailbox, which is no slower to use
+            return self.fetch_indexed_guids(mailbox)
+        if(not self.select_mailbox(mailbox)):
+            return None
+        block_size = self.block_size
+        start_date = time.strftime('%d-%b-%Y',time.gmtime(start_date-86400))
+        print('Querying messages uploaded since %s'%start_date,end='',flush=True)
+        resp, data = self.connection.search(None, 'SENTSINCE %s'%start_date)
+        if(resp != 'OK'):
+            print('',flush=True)
+            print(resp, data[0].decode())
+            return None
+        if(not data[0]):
+            print('',flush=True)
+            return guid_set.GUIDSet()
+        first_id = None
+        last_id = None
+        all_id = []
+        num_id = 0
+        for cur_id in map(int, data[0].decode().split(' ')):
+            if(not first_id):
+                first_id = cur_id
+            else:
+                if(cur_id != last_id+1):
+                    all_id.append('%d'%first_id if first_id==last_id else \
+                        '%d:%d'%(first_id,last_id))
+                    first_id = cur_id
+            last_id = cur_id
+            num_id += 1
+            if(num_id == block_size):
+                all_id.append('%d'%first_id if first_id==last_id else \
+                    '%d:%d'%(first_id,last_id))
+                first_id = None
+                last_id = None
+                num_id = 0
+        if(first_id):
+            all_id.append('%d'%first_id if first_id==last_id else \
+                '%d:%d'%(first_id,last_id))
+        guids = guid_set.GUIDSet()
+        for qrange in all_id:
+            qfilter = 'BODY.PEEK[HEADER.FIELDS (%s)]'%imessage_to_mime.Xheader_guid
+            #print(qrange, qfilter)
+            resp, data = self.connection.fetch(qrange, qfilter)
+            #print (resp, len(data))
+            if(resp != 'OK'):
+                print(resp, data[0].decode())
+                return None
+            for line in data:
+                if(type(line) == tuple):
+                    guid = re.match(r'^.*:\s+([^\s]*)\s*$',line[1].decode())
+                    if(guid):
+                        guids.add(guid.groups()[0])
+            print('.',end='',flush=True)
+        print('',flush=True)
+        return guids
+
+    def fetch_internal_dates(self, start_index=-100, end_index=0):
+        if(start_index < 0):
+            start_index += self.mailbox_size
+            end_index += self.mailbox_size
+        elif(start_index < 0):
+            end_index += self.mailbox_size
+        start_index = min(max(start_index, 0), self.mailbox_size)
+        end_index = min(max(end_index, 0), self.mailbox_size)
+        if(start_index > end_index):
+            raise Exception("start_index must be smaller than end_index")
+        if(start_index == end_index):
+            return []
+        # Indexes count from 0 and end_index is excluded, while message
+        # sequence numbers count from 1
+        qrange = '%d:%d'%(start_index+1,end_index)
+        qfilter = 'INTERNALDATE'
+        resp, data = self.connection.fetch(qrange, qfilter)
+        if(resp != 'OK'):
+            print(resp, data[0].decode())
+            return None
+        internal_dates = []
+        for line in data:
+            date = re.match(r'^.*\s+\(INTERNALDATE "(.*)"\)$',line.decode())
+            if(date):
+                internal_dates.append(
+                    calendar.timegm(email.utils.parsedate(date.groups()[0])))
+        return internal_dates
+
+    def last_message_time(self, mailbox):
+        if(not self.select_mailbox(mailbox)):
+            return 0
+        if(self.mailbox_size == 0):
+            return 0
+        message_dates = self.fetch_internal_dates()
+        return max(message_dates) if message_dates else 0
+
+    def reopen(self):
+        try:
+            self.connection.logout()
+        except Exception:
+            pass
+        self.connection = self.reconnect()
+        self.selected_mailbox = None
+        self.capabilities = None
+
+    def location(self):
+        return 'imap:' + (self.account or '')
+
+    def close(self):
+        self.connection.logout()
+
+class LocalGUIDIndex:
+    """GUIDs and dates of the messages in a local mailbox, kept in a text
+    file alongside it so that deduplication never has to read the mailbox.
+    Each line holds a GUID and the message date separated by a tab."""
+
+    def __init__(self, filename, flush_each = True):
+        self.filename = filename
+        self.flush_each = flush_each
+        self.guids = set()
+        self.last_date = 0
+        if(os.path.isfile(filename)):
+            with open(filename, 'r') as fp:
+                for line in fp:
+                    guid, date = line.rstrip('\n').split('\t')
+                    self.guids.add(guid)
+                    self.last_date = max(self.last_date, float(date))
+        self._fp = None
+
+    def add(self, guid, date):
+        if(self._fp is None):
+            self._fp = open(self.filename, 'a')
+        self._fp.write('%s\t%d\n'%(guid, date or 0))
+        if(self.flush_each):
+            self._fp.flush()
+        self.guids.add(guid)
+        self.last_date = max(self.last_date, date or 0)
+
+    def close(self):
+        if(self._fp is not None):
+            self._fp.close()
+            self._fp = None
+
+class LocalBackend(StorageBackend):
+    """Base for backends storing messages in local files, with mailbox
+    names mapped to paths below a root directory"""
+    index_suffix = '.imessage_sync_guids'
+    flush_index = True
+
+    def __init__(self, root, verbose=False):
+        self.root = os.path.expanduser(root)
+        self.verbose = verbose
+        self._indexes = dict()
+        self._mailboxes = dict()
+        os.makedirs(self.root, exist_ok=True)
+
+    def mailbox_path(self, mailbox):
+        return os.path.join(self.root, *mailbox.split(self.separator))
+
+    def index_path(self, mailbox):
+        raise NotImplementedError
+
+    def open_local_mailbox(self, name, create):
+        raise NotImplementedError
+
+    def is_mailbox(self, path):
+        raise NotImplementedError
+
+    def local_mailbox(self, mailbox, create=True):
+        if(mailbox not in self._mailboxes):
+            if(not create and not self.is_mailbox(self.mailbox_path(mailbox))):
+                return None
+            self._mailboxes[mailbox] = self.open_local_mailbox(mailbox, create)
+        return self._mailboxes[mailbox]
+
+    def index(self, mailbox):
+        if(mailbox not in self._indexes):
+            fn = self.index_path(mailbox)
+            md = self.local_mailbox(mailbox, create=False)
+            if(md is not None and not os.path.isfile(fn) and len(md) > 0):
+                self.rebuild_index(mailbox)
+            self._indexes[mailbox] = LocalGUIDIndex(fn, flush_each=self.flush_index)
+        return self._indexes[mailbox]
+
+    def rebuild_index(self, mailbox):
+        """Recreate the GUID index of a mailbox by reading its messages"""
+        import email.parser
+        md = self.local_mailbox(mailbox)
+        parser = email.parser.BytesHeaderParser()
+        if(mailbox in self._indexes):
+            self._indexes.pop(mailbox).close()
+        print('Indexing messages in', self.mailbox_path(mailbox))
+        with open(self.index_path(mailbox), 'w') as fp:
+            for key in md.iterkeys():
+                with md.get_file(key) as mfp:
+                    headers = parser.parse(mfp)
+                guid = headers.get(imessage_to_mime.Xheader_guid)
+                if(guid):
+                    date = headers.get('Date')
+                    date = date and email.utils.mktime_tz(email.utils.parsedate_tz(date))
+                    fp.write('%s\t%d\n'%(guid.strip(), date or 0))
+
+    def open_mailbox(self, mailbox):
+        self.create_mailbox(mailbox)
+        return True
+
+    def create_mailbox(self, mailbox):
+        self.local_mailbox(mailbox, create=True)
+
+    def list_mailboxes(self, parent):
+        path = self.mailbox_path(parent)
+        if(not os.path.isdir(path)):
+            return []
+        mailboxes = []
+        for entry in sorted(os.listdir(path)):
+            if(self.is_mailbox(os.path.join(path, entry))):
+                mailboxes.append(parent + self.separator + entry)
+        return mailboxes
+
+    def fetch_guids(self, mailbox):
+        return self.index(mailbox).guids
+
+    def fetch_guids_since(self, mailbox, start_date):
+        return self.index(mailbox).guids
+
+    def last_message_time(self, mailbox):
+        return self.index(mailbox).last_date
+
+    def append(self, mailbox, email_str, date, seen, guid):
+        self.store(mailbox, self.local_mailbox(mailbox), email_str, date, seen)
+        self.index(mailbox).add(guid, date)
+        return True, 'OK'
+
+    def location(self):
+        return '%s:%s'%(type(self).__name__, os.path.abspath(self.root))
+
+    def close(self):
+        for md in self._mailboxes.values():
+            md.close()
+        for index in self._indexes.values():
+            index.close()
+
+class MaildirBackend(LocalBackend):
+    def index_path(self, mailbox):
+        return os.path.join(self.mailbox_path(mailbox), self.index_suffix)
+
+    def is_mailbox(self, path):
+        return os.path.isdir(os.path.join(path, 'cur'))
+
+    def open_local_mailbox(self, name, create):
+        path = self.mailbox_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        import mailbox
+        return mailbox.Maildir(path, factory=None, create=create)
+
+    def store(self, name, md, email_str, date, seen):
+        # Add the message as raw bytes rather than as a MaildirMessage, which
+        # would parse it again, then set its flags and date directly
+        key = md.add(email_str)
+        path = os.path.join(self.mailbox_path(name), 'new', key)
+        if(seen):
+            seen_path = os.path.join(self.mailbox_path(name), 'cur', key + ':2,S')
+            os.rename(path, seen_path)
+            path = seen_path
+        if(date):
+            os.utime(path, (date, date))
+
+class MboxBackend(LocalBackend):
+    """Messages appended to one mbox file per mailbox, in mboxrd format.
+    Writes go straight to the end of the file and are flushed, along with
+    the GUID index, when the backend is closed."""
+    mbox_suffix = '.mbox'
+    flush_index = False
+
+    def __init__(self, root, verbose=False):
+        LocalBackend.__init__(self, root, verbose)
+        self._files = dict()
+
+    def mailbox_path(self, mailbox):
+        return LocalBackend.mailbox_path(self, mailbox) + self.mbox_suffix
+
+    def list_mailboxes(self, parent):
+        path = LocalBackend.mailbox_path(self, parent)
+        if(not os.path.isdir(path)):
+            return []
+        return [ parent + self.separator + entry[0:-len(self.mbox_suffix)]
+            for entry in sorted(os.listdir(path)) if entry.endswith(self.mbox_suffix) ]
+
+    def index_path(self, mailbox):
+        return self.mailbox_path(mailbox) + self.index_suffix
+
+    def is_mailbox(self, path):
+        return os.path.isfile(path)
+
+    def open_local_mailbox(self, name, create):
+        path = self.mailbox_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        import mailbox
+        return mailbox.mbox(path, factory=None, create=create)
+
+    def store(self, name, mb, email_str, date, seen):
+        # Append to the file directly rather than with mailbox.mbox.add,
+        # which reads the whole file to build its table of contents first,
+        # and whose flush syncs the file after every message
+        fp = self._files.get(name)
+        if(fp is None):
+            fp = self._files[name] = open(self.mailbox_path(name), 'ab')
+        from_line = b'From imessage_sync ' + \
+            time.asctime(time.gmtime(date or 0)).encode() + b'\n'
+        status = b'Status: RO\n' if seen else b''
+        email_str = mboxrd_from_re.sub(rb'>\1', email_str.replace(b'\r\n', b'\n'))
+        if(not email_str.endswith(b'\n')):
+            email_str += b'\n'
+        fp.write(from_line + status + email_str + b'\n')
+
+    def close(self):
+        for fp in self._files.values():
+            fp.close()
+        self._files = dict()
+        LocalBackend.close(self)
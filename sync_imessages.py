@@ -2,6 +2,14 @@
 import argparse
 import datetime
 import imessage_sync
+import imessage_sync_config
+import imessage_db_reader
+import backup_index_cache
+import storage_backend
+import search_index
+import uid_index
+import sync_state
+import outbox
 
 parser = argparse.ArgumentParser(description='Syncronise iMessages to GMail or other IMAP mail system.')
 
@@ -11,13 +19,118 @@ parser.add_argument('-v', '--verbose', dest='verbose', action='store_const',
 parser.add_argument('--no_upload', dest='do_upload', action='store_const',
                     default=True, const=False,
                     help='do not upload messages, instead do all prior steps')
+parser.add_argument('--no_seen_update', dest='update_seen', action='store_const',
+                    default=True, const=False,
+                    help='do not flag messages read since they were uploaded as read on the server')
 parser.add_argument('--since', dest='start_date', action='store', default=None,
                     help='process messages since given date. Specify as YYYY-MM-DD')
 parser.add_argument('--db', dest='db', action='append', default=None,
                     help='specify iMessage database(s) to use')
+parser.add_argument('--snapshot', dest='snapshot', action='store',
+                    choices=['none','transaction','memory','file'], default=None,
+                    help='read a consistent snapshot of each database, taken in one read '
+                    'transaction or by copying it into memory or a temporary file')
+
+parser.add_argument('--include', dest='include', action='append', default=[],
+                    metavar='KEY=PATTERN',
+                    help='only read chats matching the GLOB pattern, where KEY is one of '
+                    'guid, identifier, contact or service')
+parser.add_argument('--exclude', dest='exclude', action='append', default=[],
+                    metavar='KEY=PATTERN',
+                    help='do not read chats matching the GLOB pattern, KEY as for --include')
+parser.add_argument('--chat_kind', dest='chat_kind', action='store',
+                    choices=['all','group','direct'], default=None,
+                    help='only read group chats or one-to-one chats')
+
+parser.add_argument('--partition', dest='partition', action='store',
+                    choices=['none','year','month'], default=None,
+                    help='upload into one mailbox per year or month of the message date')
+parser.add_argument('--maildir', dest='maildir', action='store', default=None,
+                    help='write messages to Maildir folders under the given directory instead of IMAP')
+parser.add_argument('--mbox', dest='mbox', action='store', default=None,
+                    help='write messages to mbox files under the given directory instead of IMAP')
+parser.add_argument('--outbox', dest='outbox', action='store', nargs='?', default=None,
+                    const='', help='queue messages in the outbox, or the given directory, '
+                    'for drain_imessages.py to upload')
+parser.add_argument('--max_upload_rate', dest='max_upload_rate', action='store',
+                    type=float, default=None,
+                    help='limit IMAP uploads to the given number of bytes per second')
+parser.add_argument('--index_cache', dest='index_cache', action='store',
+                    choices=['use','rebuild','off'], default='use',
+                    help='use, rebuild or do not use the on-disk cache of iPhone backup indexes')
+parser.add_argument('--search_index', dest='search_index', action='store',
+                    choices=['use','off'], default='use',
+                    help='add synced messages to the local search index used by search_imessages.py')
+parser.add_argument('--prune_index_cache', dest='prune_index_cache', action='store_const',
+                    default=False, const=True,
+                    help='remove cached indexes of backups that have changed or no longer exist')
+parser.add_argument('--rescan', dest='rescan', action='store_const',
+                    default=False, const=True,
+                    help='read every database, even those unchanged since they were last synced')
+parser.add_argument('--jobs', dest='jobs', action='store_const',
+                    default=False, const=True,
+                    help='run the sync jobs described by the [job:<name>] sections of the config concurrently')
+parser.add_argument('--job', dest='job', action='append', default=None,
+                    help='run only the given sync job(s), implies --jobs')
+parser.add_argument('--verify', dest='verify', action='store_const',
+                    default=False, const=True,
+                    help='check the attachment files of each database instead of syncing')
+parser.add_argument('--checksum', dest='checksum', action='store_const',
+                    default=False, const=True,
+                    help='with --verify, read every attachment through a SHA-256 hash')
+parser.add_argument('--verify_threads', dest='verify_threads', action='store',
+                    type=int, default=8,
+                    help='with --verify, number of attachments to check in parallel')
+parser.add_argument('--verify_report', dest='verify_report', action='store', default=None,
+                    help='with --verify, write problem attachments to the given file as JSON lines')
 
 args = parser.parse_args()
 
+def filter_patterns(terms):
+    patterns = dict()
+    for term in terms:
+        key, sep, pattern = term.partition('=')
+        if(not sep or key not in imessage_db_reader.MessageFilter.keys):
+            parser.error('filter must be KEY=PATTERN with KEY one of: ' +
+                ', '.join(imessage_db_reader.MessageFilter.keys))
+        patterns.setdefault(key, []).append(pattern)
+    return patterns
+
+config = imessage_sync_config.get_config()
+snapshot = args.snapshot or config.get('database', 'snapshot', fallback='none')
+index_cache = None
+if(args.index_cache != 'off'):
+    index_cache = backup_index_cache.BackupIndexCache(config=config,
+        rebuild=(args.index_cache == 'rebuild'))
+if(args.prune_index_cache):
+    cache = index_cache or backup_index_cache.BackupIndexCache(config=config)
+    print('Pruned %d stale backup indexes from cache'%cache.prune())
+
+if(args.verify):
+    imessage_sync.verify_all_messages(finder_or_base_path=args.db,
+        verbose=args.verbose, index_cache=index_cache, checksum=args.checksum,
+        nthread=args.verify_threads, problems_file=args.verify_report,
+        snapshot=snapshot)
+    raise SystemExit(0)
+
+message_filter = imessage_db_reader.MessageFilter.from_config(config,
+    include=filter_patterns(args.include), exclude=filter_patterns(args.exclude),
+    kind=args.chat_kind)
+uids = uid_index.UIDIndex(config=config)
+state = sync_state.SyncState(config=config, rescan=args.rescan)
+search = None
+if(args.search_index != 'off' and args.do_upload):
+    search = search_index.SearchIndex(config=config)
+
+if(args.jobs or args.job):
+    import sync_jobs
+    jobs = sync_jobs.SyncJobs(config, names=args.job, verbose=args.verbose,
+        do_upload=args.do_upload, index_cache=index_cache, snapshot=snapshot,
+        max_upload_rate=args.max_upload_rate, search_index=search,
+        uid_index=uids, update_seen=args.update_seen, sync_state=state)
+    jobs.run()
+    raise SystemExit(0)
+
 start_date = None
 if(args.start_date == "latest"):
     start_date = args.start_date
@@ -25,6 +138,24 @@ elif(args.start_date is not None):
     start_date = datetime.datetime.strptime(args.start_date,'%Y-%m-%d')
     start_date = start_date and start_date.timestamp()
 
+backend = None
+if(args.maildir):
+    backend = storage_backend.MaildirBackend(args.maildir, verbose=args.verbose)
+elif(args.mbox):
+    backend = storage_backend.MboxBackend(args.mbox, verbose=args.verbose)
+elif(args.outbox is not None):
+    backend = outbox.OutboxBackend(outbox.Outbox(args.outbox, config=config),
+        verbose=args.verbose,
+        separator=config.get('server', 'mailbox_separator', fallback='/'),
+        uid_index=uids, account=imessage_sync.imap_account(config))
+
 imessage_sync.sync_all_messages(finder_or_base_path=args.db,
     start_date=start_date, verbose=args.verbose,
-    do_upload=args.do_upload)
+    do_upload=args.do_upload, index_cache=index_cache,
+    partition=args.partition, backend=backend,
+    max_upload_rate=args.max_upload_rate, snapshot=snapshot,
+    search_index=search, uid_index=uids, update_seen=args.update_seen,
+    sync_state=state, message_filter=message_filter)
+
+if(backend):
+    backend.close()
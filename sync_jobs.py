@@ -0,0 +1,267 @@
+# sync_jobs.py - Run several syncs described in the config file concurrently
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Each job is a config section named [job:<name>], for example
+#
+#   [job:phone]
+#   db = ~/Backups/phone-backup
+#        ~/Backups/old-phone-backup
+#   mailbox = iMessage/Phone
+#   exclude_contact = [0-9][0-9][0-9][0-9][0-9] [0-9][0-9][0-9][0-9][0-9][0-9]
+#   username = someone@gmail.com
+#   password = ...
+#
+# Options not given in a job section are taken from the rest of the config.
+
+import configparser
+import datetime
+import threading
+import time
+import concurrent.futures
+import imaplib_connect
+import imessage_sync
+import imessage_db_reader
+import storage_backend
+import upload_throttle
+import addressbook
+
+job_prefix = 'job:'
+
+# Job options and the config section and option each one overrides
+job_options = dict(
+    hostname            = ('server', 'hostname'),
+    mailbox             = ('server', 'mailbox'),
+    mailbox_partition   = ('server', 'mailbox_partition'),
+    mailbox_separator   = ('server', 'mailbox_separator'),
+    max_attachment_size = ('server', 'max_attachment_size'),
+    username            = ('account', 'username'),
+    password            = ('account', 'password'),
+    max_bytes_per_sec   = ('throttle', 'max_bytes_per_sec'),
+    chat_kind           = ('filter', 'chat_kind'),
+    )
+for key in imessage_db_reader.MessageFilter.keys:
+    job_options['include_' + key] = ('filter', 'include_' + key)
+    job_options['exclude_' + key] = ('filter', 'exclude_' + key)
+
+def job_names(config):
+    return [ s[len(job_prefix):] for s in config.sections() if s.startswith(job_prefix) ]
+
+def job_config(config, name):
+    """Copy of the config with the options of the named job applied"""
+    jc = configparser.ConfigParser()
+    jc.read_dict(dict((s, dict(config.items(s, raw=True))) for s in config.sections()
+        if not s.startswith(job_prefix)))
+    for key, value in config.items(job_prefix + name, raw=True):
+        if(key in job_options):
+            s, option = job_options[key]
+            if(not jc.has_section(s)):
+                jc.add_section(s)
+            jc.set(s, option, value)
+    return jc
+
+class ConnectionPool:
+    """Logged-in IMAP connections to one account, shared by the jobs that
+    upload to it. A job holds a connection for as long as it runs, at most
+    size of them are open at once, and idle ones are reused by the next
+    job rather than logging in again."""
+
+    def __init__(self, config, size = 2, verbose = False):
+        self.config  = config
+        self.size    = size
+        self.verbose = verbose
+        self._idle   = []
+        self._nopen  = 0
+        self._cond   = threading.Condition()
+
+    def open(self):
+        return imaplib_connect.open_connection(config = self.config,
+            verbose = self.verbose)
+
+    def acquire(self):
+        with self._cond:
+            while(not self._idle and self._nopen >= self.size):
+                self._cond.wait()
+            if(self._idle):
+                return self._idle.pop()
+            self._nopen += 1
+        try:
+            return self.open()
+        except:
+            with self._cond:
+                self._nopen -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, connection):
+        with self._cond:
+            self._idle.append(connection)
+            self._cond.notify()
+
+    def discard(self, connection):
+        """Drop a connection that may be broken, rather than reusing it"""
+        try:
+            connection.logout()
+        except Exception:
+            pass
+        with self._cond:
+            self._nopen -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for connection in self._idle:
+                try:
+                    connection.logout()
+                except Exception:
+                    pass
+            self._idle = []
+            self._nopen = 0
+
+class SyncJobs:
+    """Runs the sync jobs in the config in a pool of threads. The jobs share
+    one AddressBook, one cache of chat names, the search index, the
+    record of synced sources and the backup index cache,
+    and those uploading to the same account share a ConnectionPool."""
+
+    def __init__(self, config, names = None, verbose = False, do_upload = True,
+            index_cache = None, snapshot = None, max_upload_rate = None,
+            search_index = None, uid_index = None, update_seen = True,
+            sync_state = None):
+        self.config       = config
+        self.names        = names or job_names(config)
+        self.verbose      = verbose
+        self.do_upload    = do_upload
+        self.index_cache  = index_cache
+        self.snapshot     = snapshot
+        self.max_upload_rate = max_upload_rate
+        self.search_index = search_index
+        self.uid_index    = uid_index
+        self.update_seen  = update_seen
+        self.sync_state   = sync_state
+        self.address_book = addressbook.AddressBook(config = config)
+        self.chat_names   = dict()
+        self.pools        = dict()
+        self._pools_lock  = threading.Lock()
+        for name in self.names:
+            if(not config.has_section(job_prefix + name)):
+                raise Exception('Unknown sync job: ' + name)
+
+    def pool(self, jc):
+        key = (jc.get('server', 'hostname', fallback=None),
+            jc.get('account', 'username', fallback=None))
+        with self._pools_lock:
+            if(key not in self.pools):
+                self.pools[key] = ConnectionPool(jc, verbose = self.verbose,
+                    size = self.config.getint('jobs', 'connections_per_server', fallback=2))
+            return self.pools[key]
+
+    def backend(self, name, jc):
+        section = self.config[job_prefix + name]
+        kind = section.get('backend', 'imap')
+        if(kind == 'maildir'):
+            return storage_backend.MaildirBackend(section['path'], verbose=self.verbose), None
+        elif(kind == 'mbox'):
+            return storage_backend.MboxBackend(section['path'], verbose=self.verbose), None
+        elif(kind != 'imap'):
+            raise Exception('Unknown backend for job %s: %s'%(name, kind))
+        pool = self.pool(jc)
+        throttle = upload_throttle.AdaptiveThrottle.from_config(jc,
+            verbose = self.verbose, max_bytes_per_sec = self.max_upload_rate)
+        return storage_backend.IMAPBackend(pool.acquire(), verbose = self.verbose,
+            separator = jc.get('server', 'mailbox_separator', fallback='/'),
+            throttle = throttle, reconnect = pool.open, uid_index = self.uid_index,
+            account = imessage_sync.imap_account(jc)), pool
+
+    def run_job(self, name):
+        section = self.config[job_prefix + name]
+        jc = job_config(self.config, name)
+        dbs = [ db.strip() for db in section.get('db', '').splitlines() if db.strip() ]
+        start_date = section.get('since', None)
+        if(start_date and start_date != 'latest'):
+            start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').timestamp()
+        start = time.time()
+        print('Job %s: starting'%name)
+        backend, pool = self.backend(name, jc)
+        try:
+            summary = imessage_sync.sync_all_messages(
+                finder_or_base_path = dbs or None, verbose = self.verbose,
+                start_date = start_date, do_upload = self.do_upload,
+                index_cache = self.index_cache, backend = backend,
+                snapshot = section.get('snapshot', self.snapshot),
+                config = jc, address_book = self.address_book,
+                chat_names = self.chat_names, search_index = self.search_index,
+                update_seen = self.update_seen, sync_state = self.sync_state)
+        except:
+            if(pool):
+                pool.discard(backend.connection)
+            else:
+                backend.close()
+            raise
+        if(pool):
+            pool.release(backend.connection)
+        else:
+            backend.close()
+        summary['seconds'] = time.time() - start
+        print('Job %s: finished in %.1f s'%(name, summary['seconds']))
+        return summary
+
+    def run(self, nthread = None):
+        """Run all the jobs, returning a dictionary of the summary of each,
+        or of the exception it raised"""
+        nthread = nthread or self.config.getint('jobs', 'max_parallel',
+            fallback=len(self.names))
+        results = dict()
+        start = time.time()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, nthread)) as tp:
+                futures = dict((tp.submit(self.run_job, name), name) for name in self.names)
+                for future in concurrent.futures.as_completed(futures):
+                    name = futures[future]
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print('Job %s: failed: %s'%(name, e))
+                        results[name] = e
+        finally:
+            for pool in self.pools.values():
+                pool.close()
+        self.print_summary(results, time.time() - start)
+        return results
+
+    def print_summary(self, results, seconds):
+        print('%-20s %9s %9s %9s %7s %10s %8s %8s'%('Job', 'Found', 'New',
+            'Uploaded', 'Failed', 'MB', 'msg/s', 'MB/s'))
+        total = dict(found = 0, new = 0, uploaded = 0, failed = 0, bytes = 0)
+        for name in self.names:
+            r = results.get(name)
+            if(not isinstance(r, dict)):
+                print('%-20s %s'%(name, 'error: %s'%r))
+                continue
+            for k in total:
+                total[k] += r[k]
+            t = max(r['seconds'], 1e-6)
+            print('%-20s %9d %9d %9d %7d %10.1f %8.1f %8.2f'%(name, r['found'], r['new'],
+                r['uploaded'], r['failed'], r['bytes']/1e6, r['uploaded']/t,
+                r['bytes']/1e6/t))
+        t = max(seconds, 1e-6)
+        print('%-20s %9d %9d %9d %7d %10.1f %8.1f %8.2f'%('Total', total['found'],
+            total['new'], total['uploaded'], total['failed'], total['bytes']/1e6,
+            total['uploaded']/t, total['bytes']/1e6/t))
+        print('All jobs finished in %.1f s'%seconds)
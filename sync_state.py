@@ -0,0 +1,104 @@
+# sync_state.py - Fingerprints of the sources already synced to each mailbox
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import sqlite3
+import threading
+import file_finder
+
+default_state_db = '~/.imessage_sync_state.db'
+
+def stat_key(filename):
+    st = os.stat(filename)
+    return '%s:%d:%d'%(filename, st.st_size, st.st_mtime_ns)
+
+def source_fingerprint(finder_or_base_path):
+    """Return (path, fingerprint) of a message source, or None if it cannot
+    be fingerprinted. An iPhone backup is identified by the path, size and
+    modification time of its manifest, which is rewritten whenever the
+    backup is, so its chat database need not be found. A chat.db on disk
+    may be changed in place, so the fingerprint also covers its write-ahead
+    log and the largest message ROWID in it."""
+    if(finder_or_base_path is not None and type(finder_or_base_path) is not str):
+        return None
+    path = finder_or_base_path or file_finder.NativeDBFilenameFinder.native_db_path
+    path = os.path.abspath(os.path.expanduser(path.rstrip('/') or path))
+    chat_db = os.path.join(path, file_finder.NativeDBFilenameFinder.native_chat_db)
+    try:
+        if(not os.path.isfile(chat_db)):
+            for manifest in (file_finder.OldIPhoneBackupFilenameFinder.native_manifest,
+                    file_finder.NewIPhoneBackupFilenameFinder.native_manifest):
+                if(os.path.isfile(os.path.join(path, manifest))):
+                    return path, stat_key(os.path.join(path, manifest))
+            return None
+        keys = [ stat_key(chat_db) ]
+        if(os.path.isfile(chat_db + '-wal')):
+            keys.append(stat_key(chat_db + '-wal'))
+        conn = sqlite3.connect('file:' + chat_db + '?mode=ro', uri=True)
+        try:
+            keys.append('rowid:%s'%conn.execute('SELECT MAX(ROWID) FROM message').fetchone()[0])
+        finally:
+            conn.close()
+        return path, ' '.join(keys)
+    except (OSError, sqlite3.Error):
+        return None
+
+class SyncState:
+    """SQLite side file recording the fingerprint of each source as it was
+    when all of its messages were last synced to a target, a mailbox on a
+    given server or local store. A source whose fingerprint is unchanged
+    has nothing new to sync there and can be skipped without being read.
+    With rescan set every source is treated as changed."""
+
+    def __init__(self, filename = None, config = None, rescan = False):
+        if(not filename):
+            filename = config.get('cache', 'state_db', fallback=default_state_db) \
+                if config else default_state_db
+        self._filename = os.path.expanduser(filename)
+        self._rescan = rescan
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS synced_source ('
+            'path TEXT, target TEXT, fingerprint TEXT, synced REAL, '
+            'PRIMARY KEY (path, target)) WITHOUT ROWID')
+        self._db.commit()
+
+    def fingerprint(self, finder_or_base_path):
+        return source_fingerprint(finder_or_base_path)
+
+    def is_synced(self, fingerprint, target):
+        """True if the source with the fingerprint was fully synced to the
+        target and has not changed since"""
+        if(self._rescan or fingerprint is None):
+            return False
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM synced_source WHERE path=? '
+                'AND target=? AND fingerprint=?', (fingerprint[0], target,
+                    fingerprint[1])).fetchone() is not None
+
+    def mark_synced(self, fingerprints, target):
+        """Record that the sources with the fingerprints, taken before they
+        were read, have been fully synced to the target"""
+        synced = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO synced_source VALUES (?,?,?,?)',
+                ((f[0], target, f[1], synced) for f in fingerprints if f is not None))
+            self._db.commit()
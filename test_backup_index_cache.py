@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import backup_index_cache
+import file_finder
+
+def make_backup(path):
+    """Manifest.db of a backup holding a message database in two places"""
+    os.makedirs(path)
+    db = sqlite3.connect(os.path.join(path, 'Manifest.db'))
+    db.execute('CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, '
+        'relativePath TEXT, flags INTEGER, file BLOB)')
+    db.executemany('INSERT INTO Files VALUES (?,?,?,1,NULL)', [
+        ('aa01', 'HomeDomain', 'Library/SMS/sms.db'),
+        ('bb02', 'HomeDomain', 'Library/Other/sms.db'),
+        ('cc03', 'MediaDomain', 'Library/Other/Attachments/x.jpeg') ])
+    db.commit()
+    db.close()
+
+def test_indexes_of_different_db_paths_are_cached_separately(tmp_path):
+    backup = str(tmp_path / 'backup')
+    make_backup(backup)
+    cache = backup_index_cache.BackupIndexCache(str(tmp_path / 'index.db'))
+    for db_path, file_id in (('Library/SMS', 'aa01'), ('Library/Other', 'bb02'),
+            ('Library/SMS', 'aa01')):
+        finder = file_finder.NewIPhoneBackupFilenameFinder(backup, db_path=db_path,
+            index_cache=cache)
+        assert finder._ff.get(db_path + '/sms.db') == file_id[0:2] + '/' + file_id
+        assert finder.chat_db() == os.path.join(backup, file_id[0:2], file_id)
+
+def test_cache_without_variants_is_replaced(tmp_path):
+    filename = str(tmp_path / 'index.db')
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE manifest (id INTEGER PRIMARY KEY, path TEXT UNIQUE, '
+        'size INTEGER, mtime_ns INTEGER, created REAL)')
+    db.execute('INSERT INTO manifest VALUES (1, \'x\', 1, 1, 0)')
+    db.commit()
+    db.close()
+    manifest = str(tmp_path / 'Manifest.db')
+    open(manifest, 'w').close()
+    cache = backup_index_cache.BackupIndexCache(filename)
+    assert cache.load(manifest, 'a') is None
+    cache.store(manifest, {'p': 'f'}, 'a')
+    assert cache.load(manifest, 'a') == {'p': 'f'}
+    assert cache.load(manifest, 'b') is None
+    assert cache.prune() == 0
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+import benchmark_imessages
+import imessage_sync
+import imessage_to_mime
+import imessage_db_reader
+from test_outbox import AddressBook
+
+def attachment_messages(tmp_path, total_bytes, attachment_size):
+    db_dir = str(tmp_path)
+    benchmark_imessages.make_chat_db_dir(db_dir, nmessage=200)
+    db = sqlite3.connect(os.path.join(db_dir, imessage_db_reader.chat_db))
+    db.execute('UPDATE attachment SET total_bytes=?', (total_bytes,))
+    db.commit()
+    db.close()
+    benchmark_imessages.make_attachment_files(db_dir, attachment_size=attachment_size)
+    messages = imessage_sync.get_all_messages(db_dir)
+    return [ m for m in messages.values() if m['attachments'] and imessage_to_mime.is_valid(m) ]
+
+def test_attachment_without_recorded_size_is_checked_against_limit(tmp_path):
+    messages = attachment_messages(tmp_path, 0, 200000)
+    assert messages
+    for message in messages:
+        # The plan does not know the size, so puts the attachment in one email
+        assert imessage_to_mime.plan_fragments(message, 100000) == [ [ (0, False) ] ]
+        email_str = imessage_to_mime.get_email(message, AddressBook(), 100000).as_bytes()
+        assert len(email_str) < 100000
+        assert b'suppressed due to file-size constraints' in email_str
+
+def test_attachment_within_limit_is_attached(tmp_path):
+    messages = attachment_messages(tmp_path, 20000, 20000)
+    for message in messages:
+        email_str = imessage_to_mime.get_email(message, AddressBook(), 100000).as_bytes()
+        assert b'suppressed' not in email_str
+        assert len(email_str) > 20000
@@ -0,0 +1,62 @@
+import os
+import configparser
+import benchmark_imessages
+import imessage_sync
+import imessage_db_reader
+import outbox
+import uid_index
+
+class AddressBook:
+    def me(self):
+        return ['Me', 'me@example.com']
+
+    def lookup_email(self, handle):
+        return [handle['contact'], handle['contact'] + '@example.com']
+
+    def lookup_name(self, handle):
+        return handle['contact']
+
+def make_config():
+    config = configparser.ConfigParser()
+    config.read_dict({'server': {'mailbox': 'iMessage', 'hostname': 'imap.example.com'},
+        'account': {'username': 'someone'}})
+    return config
+
+def test_sync_to_outbox_queues_seen_updates(tmp_path):
+    db_dir = str(tmp_path / 'db')
+    os.makedirs(db_dir)
+    benchmark_imessages.make_chat_db_dir(db_dir, nmessage=100)
+    config = make_config()
+    account = imessage_sync.imap_account(config)
+    messages = imessage_sync.get_all_messages(db_dir)
+    read = [ m for m in messages.values() if m['is_read'] or m['is_from_me'] ]
+
+    # Emails uploaded by an earlier IMAP run, not yet flagged \Seen
+    uids = uid_index.UIDIndex(str(tmp_path / 'uids.db'))
+    for uid, message in enumerate(read[:10], 1):
+        uids.add(account, 'iMessage', 7, uid, message['guid'], False)
+
+    box = outbox.Outbox(str(tmp_path / 'outbox'))
+    backend = outbox.OutboxBackend(box, uid_index=uids, account=account)
+    summary = imessage_sync.sync_all_messages(finder_or_base_path=db_dir,
+        backend=backend, config=config, address_book=AddressBook(),
+        message_filter=imessage_db_reader.MessageFilter())
+    assert summary['seen'] == 10
+    assert box.pending_seen() == 10
+    # Messages recorded in the UID index are not queued again
+    assert summary['uploaded'] == summary['new']
+    assert all(m['guid'] not in box.guids('iMessage') for m in read[:10])
+
+    class Server:
+        def __init__(self):
+            self.account = account
+            self.flagged = []
+
+        def update_seen(self, mailbox, uidvalidity, uids):
+            self.flagged.extend((mailbox, uidvalidity, uid) for uid in uids)
+            return len(uids)
+
+    server = Server()
+    assert box.drain_seen(server) == 10
+    assert sorted(server.flagged) == [ ('iMessage', 7, uid) for uid in range(1, 11) ]
+    assert box.pending_seen() == 0
@@ -0,0 +1,110 @@
+import time
+import imaplib
+import configparser
+import imessage_sync
+import storage_backend
+
+class Connection:
+    """Just enough of an imaplib connection to list mailboxes and fetch the
+    INTERNALDATE of messages by sequence number, rejecting sequence numbers
+    out of range as a server does"""
+
+    def __init__(self, mailboxes):
+        # Dictionary of mailbox name to list of message dates
+        self.mailboxes = mailboxes
+        self.selected = None
+        self.fetched = []
+
+    def list(self, directory, pattern):
+        parent = pattern.strip('"').rstrip('%')
+        return 'OK', [ ('(\\HasNoChildren) "/" "%s"'%name).encode()
+            for name in sorted(self.mailboxes) if name.startswith(parent) ]
+
+    def select(self, mailbox):
+        if(mailbox not in self.mailboxes):
+            return 'NO', [b'No such mailbox']
+        self.selected = mailbox
+        return 'OK', [str(len(self.mailboxes[mailbox])).encode()]
+
+    def fetch(self, qrange, qfilter):
+        dates = self.mailboxes[self.selected]
+        first, last = map(int, qrange.split(':'))
+        if(first < 1 or last > len(dates) or first > last):
+            raise imaplib.IMAP4.error('FETCH command error: BAD [b\'Invalid messageset\']')
+        self.fetched.append(qrange)
+        return 'OK', [ ('%d (INTERNALDATE "%s")'%(i, imaplib.Time2Internaldate(dates[i-1])
+            .strip('"'))).encode() for i in range(first, last+1) ]
+
+def test_last_message_time_of_small_mailbox():
+    dates = [ 1500000000 + 3600*i for i in range(30) ]
+    connection = Connection({'iMessage': dates})
+    backend = storage_backend.IMAPBackend(connection)
+    assert backend.last_message_time('iMessage') == dates[-1]
+    assert connection.fetched == [ '1:30' ]
+
+def test_last_message_time_of_large_mailbox():
+    dates = [ 1500000000 + 3600*i for i in range(250) ]
+    connection = Connection({'iMessage': dates})
+    backend = storage_backend.IMAPBackend(connection)
+    assert backend.last_message_time('iMessage') == dates[-1]
+    assert connection.fetched == [ '151:250' ]
+
+def test_guess_last_sync_time_of_small_partition():
+    config = configparser.ConfigParser()
+    config.read_dict({'server': {'mailbox': 'iMessage', 'mailbox_partition': 'year'}})
+    dates_2016 = [ time.mktime((2016, 6, 1, 0, 0, 0, 0, 0, 0)) + 60*i for i in range(150) ]
+    dates_2017 = [ time.mktime((2017, 1, 1, 12, 0, 0, 0, 0, 0)) + 60*i for i in range(12) ]
+    connection = Connection({'iMessage/2016': dates_2016, 'iMessage/2017': dates_2017})
+    sync = imessage_sync.IMessageSync(storage_backend.IMAPBackend(connection), None,
+        config=config)
+    assert sync.guess_last_sync_time() == dates_2017[-1]
+    assert connection.fetched == [ '1:12' ]
+
+class GUIDConnection:
+    """Just enough of an imaplib connection to fetch the GUID header of the
+    emails in one mailbox, by sequence number or by UID, without searching"""
+
+    def __init__(self, uids):
+        # Sorted UIDs of the emails in the mailbox, each with GUID 'g<uid>'
+        self.uids = uids
+        self.fetched = []
+
+    def select(self, mailbox):
+        return 'OK', [str(len(self.uids)).encode()]
+
+    def _entries(self, uids):
+        return [ (('%d (UID %d FLAGS () BODY[HEADER.FIELDS (X-imessagesync-guid)] {30}'
+            %(self.uids.index(uid)+1, uid)).encode(),
+            ('X-imessagesync-guid: g%d\r\n\r\n'%uid).encode()) for uid in uids ]
+
+    def fetch(self, qrange, qfilter):
+        first, last = map(int, qrange.split(':'))
+        self.fetched.append(('FETCH', qrange))
+        return 'OK', self._entries(self.uids[first-1:last])
+
+    def uid(self, command, *args):
+        assert command == 'FETCH'
+        first = int(args[0].split(':')[0])
+        self.fetched.append(('UID FETCH', args[0]))
+        return 'OK', self._entries([ uid for uid in self.uids if uid >= first ] or self.uids[-1:])
+
+def test_scan_guids_fetches_sparse_uids_in_full_blocks():
+    uids = [ 3 + 1000*i for i in range(250) ]
+    connection = GUIDConnection(uids)
+    backend = storage_backend.IMAPBackend(connection, block_size=100)
+    blocks = list(backend.scan_guids('iMessage', 1, uids[-1]+1))
+    assert [ len(entries) for entries, last_uid in blocks ] == [ 100, 100, 50 ]
+    assert [ last_uid for entries, last_uid in blocks ] == [ uids[99], uids[199], uids[-1] ]
+    assert [ e for entries, last_uid in blocks for e in entries ] == [
+        (uid, 'g%d'%uid, False) for uid in uids ]
+    assert connection.fetched == [ ('FETCH', '1:100'), ('FETCH', '101:200'), ('FETCH', '201:250') ]
+
+def test_scan_guids_picks_up_emails_arriving_after_select():
+    connection = GUIDConnection([ 1, 2, 3 ])
+    backend = storage_backend.IMAPBackend(connection)
+    backend.select_mailbox('iMessage')
+    connection.uids += [ 4, 5 ]
+    blocks = list(backend.scan_guids('iMessage', 2, 5))
+    assert [ e[0] for entries, last_uid in blocks for e in entries ] == [ 2, 3, 4 ]
+    assert blocks[-1][1] == 4
+    assert connection.fetched == [ ('FETCH', '1:3'), ('UID FETCH', '4:*') ]
@@ -0,0 +1,157 @@
+# uid_index.py - Local index of the IMAP UIDs of uploaded messages
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import guid_set
+
+default_uid_db = '~/.imessage_sync_uids.db'
+
+fragment_marker = '-FRAGMENT-'
+
+def message_guid(guid):
+    """GUID of the iMessage that an uploaded email, possibly a fragment, is of"""
+    return guid.split(fragment_marker, 1)[0]
+
+class UIDIndex:
+    """SQLite side file mapping each email on the server to its UID and
+    recording whether it was flagged \\Seen. Emails are added as they are
+    uploaded and as mailboxes are scanned, with the highest UID scanned in
+    each mailbox kept so that later scans need only fetch newer emails. UIDs
+    are only meaningful together with the UIDVALIDITY of their mailbox, so
+    both are stored, and entries are kept per account."""
+
+    def __init__(self, filename = None, config = None):
+        if(not filename):
+            filename = config.get('cache', 'uid_db', fallback=default_uid_db) \
+                if config else default_uid_db
+        self._filename = os.path.expanduser(filename)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS message_uid ('
+            'account TEXT, mailbox TEXT, uidvalidity INTEGER, uid INTEGER, '
+            'guid TEXT, message_guid TEXT, seen INTEGER, '
+            'PRIMARY KEY (account, mailbox, uidvalidity, uid)) WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS message_uid_unseen '
+            'ON message_uid (account, seen)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS mailbox_scan ('
+            'account TEXT, mailbox TEXT, uidvalidity INTEGER, last_uid INTEGER, '
+            'PRIMARY KEY (account, mailbox)) WITHOUT ROWID')
+        self._db.commit()
+
+    def add(self, account, mailbox, uidvalidity, uid, guid, seen):
+        """Add an uploaded email. If its UID directly follows the last one
+        scanned, nobody else added an email in between, so the scanned range
+        is extended over it."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO message_uid VALUES (?,?,?,?,?,?,?)',
+                (account, mailbox, uidvalidity, uid, guid, message_guid(guid), int(bool(seen))))
+            self._db.execute('UPDATE mailbox_scan SET last_uid=? WHERE account=? '
+                'AND mailbox=? AND uidvalidity=? AND last_uid=?',
+                (uid, account, mailbox, uidvalidity, uid-1))
+            self._db.commit()
+
+    def add_scanned(self, account, mailbox, uidvalidity, entries, last_uid):
+        """Add the (uid, guid, seen) of emails found by scanning a mailbox
+        up to last_uid"""
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO message_uid VALUES (?,?,?,?,?,?,?)',
+                ((account, mailbox, uidvalidity, uid, guid, message_guid(guid),
+                    int(bool(seen))) for uid, guid, seen in entries))
+            self._db.execute('INSERT OR REPLACE INTO mailbox_scan VALUES (?,?,?,?)',
+                (account, mailbox, uidvalidity, last_uid))
+            self._db.commit()
+
+    def last_uid(self, account, mailbox, uidvalidity):
+        """Highest UID scanned in the mailbox, or None if it has not been
+        scanned with this UIDVALIDITY"""
+        with self._lock:
+            row = self._db.execute('SELECT last_uid FROM mailbox_scan WHERE account=? '
+                'AND mailbox=? AND uidvalidity=?', (account, mailbox, uidvalidity)).fetchone()
+        return row and row[0]
+
+    def count(self, account, mailbox, uidvalidity):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM message_uid WHERE account=? '
+                'AND mailbox=? AND uidvalidity=?', (account, mailbox, uidvalidity)).fetchone()[0]
+
+    def uids(self, account, mailbox, uidvalidity):
+        with self._lock:
+            return [ uid for uid, in self._db.execute('SELECT uid FROM message_uid '
+                'WHERE account=? AND mailbox=? AND uidvalidity=?',
+                (account, mailbox, uidvalidity)) ]
+
+    def guids(self, account, mailbox, uidvalidity = None):
+        """GUIDSet of the emails in the mailbox, of any UIDVALIDITY if none
+        is given"""
+        with self._lock:
+            if(uidvalidity is None):
+                return guid_set.GUIDSet(guid for guid, in self._db.execute('SELECT guid '
+                    'FROM message_uid WHERE account=? AND mailbox=?', (account, mailbox)))
+            return guid_set.GUIDSet(guid for guid, in self._db.execute('SELECT guid '
+                'FROM message_uid WHERE account=? AND mailbox=? AND uidvalidity=?',
+                (account, mailbox, uidvalidity)))
+
+    def mailboxes(self, account):
+        with self._lock:
+            return [ m for m, in self._db.execute('SELECT DISTINCT mailbox FROM '
+                'message_uid WHERE account=? ORDER BY mailbox', (account,)) ]
+
+    def unseen(self, account):
+        """Return a dictionary of message GUID to a list of (mailbox,
+        uidvalidity, uid) of the emails of that message not flagged \\Seen"""
+        unseen = dict()
+        with self._lock:
+            for mailbox, uidvalidity, uid, guid in self._db.execute(
+                    'SELECT mailbox, uidvalidity, uid, message_guid FROM message_uid '
+                    'WHERE account=? AND seen=0', (account,)):
+                unseen.setdefault(guid, []).append((mailbox, uidvalidity, uid))
+        return unseen
+
+    def mark_seen(self, account, mailbox, uidvalidity, uids):
+        with self._lock:
+            self._db.executemany('UPDATE message_uid SET seen=1 WHERE account=? '
+                'AND mailbox=? AND uidvalidity=? AND uid=?',
+                ((account, mailbox, uidvalidity, uid) for uid in uids))
+            self._db.commit()
+
+    def remove(self, account, mailbox, uidvalidity, uids):
+        with self._lock:
+            self._db.executemany('DELETE FROM message_uid WHERE account=? '
+                'AND mailbox=? AND uidvalidity=? AND uid=?',
+                ((account, mailbox, uidvalidity, uid) for uid in uids))
+            self._db.commit()
+
+    def forget_mailbox(self, account, mailbox, uidvalidity = None):
+        """Remove the entries of a mailbox, or those of it that have a
+        different UIDVALIDITY and so no longer name the same messages"""
+        with self._lock:
+            if(uidvalidity is None):
+                self._db.execute('DELETE FROM message_uid WHERE account=? AND mailbox=?',
+                    (account, mailbox))
+                self._db.execute('DELETE FROM mailbox_scan WHERE account=? AND mailbox=?',
+                    (account, mailbox))
+            else:
+                self._db.execute('DELETE FROM message_uid WHERE account=? AND mailbox=? '
+                    'AND uidvalidity!=?', (account, mailbox, uidvalidity))
+                self._db.execute('DELETE FROM mailbox_scan WHERE account=? AND mailbox=? '
+                    'AND uidvalidity!=?', (account, mailbox, uidvalidity))
+            self._db.commit()
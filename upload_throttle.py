@@ -0,0 +1,171 @@
+# upload_throttle.py - Adaptive rate control and bandwidth shaping of uploads
+#
+# This program is motivated by the author's experience of SMSBackup+ under
+# Android, an excellent application to backup SMS/MMS messages to GMail where
+# they can be searched etc. This little program tries to do the same thing for
+# messages / conversations stored in the iMessage database.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+
+# Response codes with which servers ask clients to slow down. GMail uses
+# [THROTTLED] and [OVERQUOTA], others [LIMIT] and [UNAVAILABLE] (RFC 5530)
+throttle_codes = ('THROTTLED', 'OVERQUOTA', 'LIMIT', 'UNAVAILABLE', 'INUSE')
+throttle_re = re.compile(r'\[(%s)\b'%'|'.join(throttle_codes))
+
+def throttle_code(data):
+    """Return the throttling response code in the server's reply, or None"""
+    for line in data or []:
+        if(isinstance(line, bytes)):
+            line = line.decode(errors='replace')
+        m = throttle_re.search(str(line))
+        if(m):
+            return m.group(1)
+    return None
+
+class TokenBucket:
+    """Limit the average number of bytes sent per second, allowing bursts
+    of up to burst bytes"""
+
+    def __init__(self, rate, burst = None, clock = time.monotonic, sleep = time.sleep):
+        self.rate   = float(rate)
+        self.burst  = float(burst or rate)
+        self.tokens = self.burst
+        self.clock  = clock
+        self._sleep = sleep
+        self._last  = clock()
+
+    def consume(self, nbytes):
+        """Wait until nbytes can be sent, returning the time waited. A
+        message larger than the burst size drives the bucket negative, so
+        that the average rate is still respected."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last)*self.rate)
+        self._last = now
+        self.tokens -= nbytes
+        if(self.tokens >= 0):
+            return 0
+        wait = -self.tokens/self.rate
+        self._sleep(wait)
+        self._last = self.clock()
+        self.tokens = 0
+        return wait
+
+class AdaptiveThrottle:
+    """AIMD control of the rate of APPEND commands. Each successful APPEND
+    that completes within latency_target raises the allowed rate by
+    increase messages per second. A throttling response or a dropped
+    connection multiplies it by decrease, and failed APPENDs are retried
+    after an exponentially growing pause. An APPEND also counts as slow,
+    and decreases the rate, if it takes longer than latency_target beyond
+    the time needed to send it at the uplink speed measured on earlier
+    large APPENDs, so that big attachments alone do not slow the rate. An
+    optional TokenBucket caps the bytes sent per second. Changes of rate
+    are printed as they happen, increases only when verbose."""
+    min_uplink_sample = 65536
+
+    def __init__(self, rate = 10.0, min_rate = 0.1, max_rate = 100.0,
+            increase = 0.5, decrease = 0.5, latency_target = 5.0,
+            max_retries = 6, max_backoff = 300.0, max_bytes_per_sec = None,
+            verbose = False, clock = time.monotonic, sleep = time.sleep):
+        self.rate           = float(rate)
+        self.min_rate       = float(min_rate)
+        self.max_rate       = float(max_rate)
+        self.increase       = float(increase)
+        self.decrease       = float(decrease)
+        self.latency_target = float(latency_target)
+        self.max_retries    = int(max_retries)
+        self.max_backoff    = float(max_backoff)
+        self.verbose        = verbose
+        self.bucket         = TokenBucket(max_bytes_per_sec, clock=clock, sleep=sleep) \
+            if max_bytes_per_sec else None
+        self.clock          = clock
+        self._sleep         = sleep
+        self._next_send     = clock()
+        self.uplink         = None
+        self.nthrottled     = 0
+        self.nretries       = 0
+        self.time_waiting   = 0.0
+
+    @classmethod
+    def from_config(cls, config, verbose = False, max_bytes_per_sec = None):
+        """Make a throttle from the [throttle] section of the config, or
+        return None if it is disabled there"""
+        get = lambda key, default: config.get('throttle', key, fallback=default)
+        if(get('enabled', 'yes').lower() in ('no', 'false', 'off', '0')):
+            return None
+        return cls(rate = float(get('rate', 10.0)),
+            min_rate = float(get('min_rate', 0.1)),
+            max_rate = float(get('max_rate', 100.0)),
+            latency_target = float(get('latency_target', 5.0)),
+            max_retries = int(get('max_retries', 6)),
+            max_bytes_per_sec = max_bytes_per_sec or
+                float(get('max_bytes_per_sec', 0)) or None,
+            verbose = verbose)
+
+    def wait(self, nbytes = 0):
+        """Sleep until the next message of nbytes may be sent"""
+        waited = 0
+        delay = self._next_send - self.clock()
+        if(delay > 0):
+            self._sleep(delay)
+            waited += delay
+        if(self.bucket):
+            waited += self.bucket.consume(nbytes)
+        self.time_waiting += waited
+        self._next_send = self.clock() + 1.0/self.rate
+
+    def set_rate(self, rate, reason, always_print = True):
+        rate = max(self.min_rate, min(self.max_rate, rate))
+        if(rate != self.rate and (always_print or self.verbose)):
+            print('Throttle: %s, rate %.2f -> %.2f msg/s'%(reason, self.rate, rate))
+        self.rate = rate
+
+    def succeeded(self, latency, nbytes = 0):
+        """Record an APPEND of nbytes that the server accepted"""
+        transfer = 0
+        if(nbytes >= self.min_uplink_sample and latency > 0):
+            if(self.uplink is None):
+                self.uplink = nbytes/latency
+            transfer = nbytes/self.uplink
+            self.uplink = 0.8*self.uplink + 0.2*nbytes/latency
+        if(latency - transfer > self.latency_target):
+            self.set_rate(self.rate*self.decrease,
+                'APPEND took %.1f s'%latency)
+        else:
+            self.set_rate(self.rate + self.increase,
+                'APPEND took %.1f s'%latency, always_print = False)
+
+    def failed(self, reason, attempt):
+        """Record a throttled or dropped APPEND, returning False if it
+        should not be retried, otherwise pausing before the retry"""
+        self.nthrottled += 1
+        self.set_rate(self.rate*self.decrease, reason)
+        if(attempt >= self.max_retries):
+            print('Throttle: giving up after %d attempts'%(attempt+1))
+            return False
+        backoff = min(self.max_backoff, 2.0**attempt)
+        print('Throttle: retrying in %.0f s'%backoff)
+        self._sleep(backoff)
+        self.time_waiting += backoff
+        self.nretries += 1
+        self._next_send = self.clock()
+        return True
+
+    def summary(self):
+        return 'throttled %d times, %d retries, %.0f s spent waiting, ' \
+            'final rate %.2f msg/s'%(self.nthrottled, self.nretries,
+                self.time_waiting, self.rate)